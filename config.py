@@ -43,6 +43,98 @@ class Config(object):
     )
     EXECUTION_PATH = os.environ.get('EXECUTION_PATH', None)
 
+    # execution data layout under EXECUTION_PATH: 'segment' (append-only
+    # binary segments per rank) or 'json' (one file per step). Steps stored
+    # as json files stay readable either way.
+    EXECUTION_FORMAT = os.environ.get('EXECUTION_FORMAT', 'segment')
+    EXECUTION_SEGMENT_SIZE = int(
+        os.environ.get('EXECUTION_SEGMENT_SIZE', 256 * 1024 * 1024))  # bytes
+    # ranks whose dictionary and indexes are kept in memory
+    EXECUTION_OPEN_RANKS = int(os.environ.get('EXECUTION_OPEN_RANKS', 1024))
+    # compression of stored execution data: None, 'gzip' or 'zstd'
+    # (see scripts/bench_compression.py for the size/CPU tradeoff)
+    EXECUTION_COMPRESSION = os.environ.get('EXECUTION_COMPRESSION', None)
+    EXECUTION_COMPRESSION_LEVEL = os.environ.get(
+        'EXECUTION_COMPRESSION_LEVEL', None)
+    # time window of the rank-to-rank comm matrix in usec (0: per step)
+    COMM_MATRIX_WINDOW = int(os.environ.get('COMM_MATRIX_WINDOW', 0))
+    # LRU cache of decoded steps, in estimated bytes of memory
+    EXECUTION_CACHE_SIZE = int(
+        os.environ.get('EXECUTION_CACHE_SIZE', 256 * 1024 * 1024))
+
+    # write-behind ingest: acknowledge parsed rows once buffered and flush
+    # them in one transaction per bind when either threshold is reached;
+    # up to INGEST_FLUSH_INTERVAL of acknowledged rows are lost if a
+    # process is killed (see server/ingest.py)
+    INGEST_WRITE_BEHIND = os.environ.get(
+        'INGEST_WRITE_BEHIND', '1').lower() in ('1', 'true', 'yes')
+    INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 5000))  # rows
+    INGEST_FLUSH_INTERVAL = float(
+        os.environ.get('INGEST_FLUSH_INTERVAL', 1.0))  # sec
+
+    # timing spans of the ingest pipeline (see /tasks/traces); created_at
+    # of the payloads is taken in TRACING_CREATED_AT_UNIT seconds
+    TRACING = os.environ.get('TRACING', '1').lower() in ('1', 'true', 'yes')
+    TRACING_CREATED_AT_UNIT = float(
+        os.environ.get('TRACING_CREATED_AT_UNIT', 0.001))
+
+    # admission control of /api/anomalydata and /api/executions: past
+    # ADMISSION_HIGH_WATER queued requests (0: no limit) POSTs get 429 with
+    # a Retry-After hint; executions are shed from ADMISSION_SHED_RATIO of
+    # it. The leases are shared through Redis (None: single process) and
+    # expire after ADMISSION_LEASE, so that crashed workers don't leak them.
+    ADMISSION_HIGH_WATER = int(os.environ.get('ADMISSION_HIGH_WATER', 1000))
+    ADMISSION_SHED_RATIO = float(os.environ.get('ADMISSION_SHED_RATIO', 0.5))
+    ADMISSION_RETRY_AFTER = float(
+        os.environ.get('ADMISSION_RETRY_AFTER', 5))  # sec at high water
+    ADMISSION_REDIS_URL = os.environ.get(
+        'ADMISSION_REDIS_URL', os.environ.get('CELERY_BROKER_URL', 'redis://'))
+    ADMISSION_LEASE = float(os.environ.get('ADMISSION_LEASE', 300))  # sec
+
+    # top/bottom ranking of anomaly statistics: kept in Redis sorted sets so
+    # that all workers share it, or in-process if no URL is given
+    RANKING_REDIS_URL = os.environ.get(
+        'RANKING_REDIS_URL', os.environ.get('CELERY_BROKER_URL', 'redis://'))
+
+    # active query condition is cached per process; a version counter in
+    # Redis tells the other workers to reload it (None: single process)
+    STAT_QUERY_REDIS_URL = os.environ.get(
+        'STAT_QUERY_REDIS_URL',
+        os.environ.get('CELERY_BROKER_URL', 'redis://'))
+
+    # update_stats/update_history emitted at most PUSH_MAX_RATE times per
+    # second per room, pending updates being coalesced (0: no limit)
+    PUSH_MAX_RATE = float(os.environ.get('PUSH_MAX_RATE', 4))
+    # shares the rate of each room between all emitting processes (None:
+    # the limit applies per process)
+    PUSH_REDIS_URL = os.environ.get(
+        'PUSH_REDIS_URL', os.environ.get('CELERY_BROKER_URL', 'redis://'))
+    # let sessions ask for column-oriented msgpack payloads when connecting
+    # (?encoding=msgpack); these events are then encoded both ways
+    PUSH_MSGPACK = os.environ.get(
+        'PUSH_MSGPACK', '1').lower() in ('1', 'true', 'yes')
+    # sessions per msgpack room, shared with the emitting workers so that
+    # nothing is encoded for empty rooms (None: single process)
+    SUBSCRIPTIONS_REDIS_URL = os.environ.get(
+        'SUBSCRIPTIONS_REDIS_URL',
+        os.environ.get('CELERY_BROKER_URL', 'redis://'))
+
+    # steps per bucket of the AnomalyData rollups for the history view
+    ROLLUP_RESOLUTIONS = [
+        int(r) for r in
+        os.environ.get('ROLLUP_RESOLUTIONS', '16,256,4096').split(',') if r
+    ]
+
+    # retention of AnomalyStat/FuncStat snapshots, run in the background
+    # by the web server every RETENTION_INTERVAL seconds (0: disabled).
+    # Opt-in: nothing is deleted unless a policy is set; either may be
+    # None, RETENTION_WINDOW being in the unit of created_at.
+    RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 0))
+    RETENTION_KEEP_SNAPSHOTS = os.environ.get('RETENTION_KEEP_SNAPSHOTS', None)
+    RETENTION_WINDOW = os.environ.get('RETENTION_WINDOW', None)
+    RETENTION_CHUNK_SIZE = int(os.environ.get('RETENTION_CHUNK_SIZE', 1000))
+    RETENTION_VACUUM_PAGES = int(os.environ.get('RETENTION_VACUUM_PAGES', 1000))
+
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -61,6 +153,14 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'db.sqlite')
     CELERY_CONFIG = {'CELERY_ALWAYS_EAGER': True}
     SOCKETIO_MESSAGE_QUEUE = None
+    INGEST_WRITE_BEHIND = False
+    RANKING_REDIS_URL = None
+    STAT_QUERY_REDIS_URL = None
+    RETENTION_INTERVAL = 0
+    PUSH_MAX_RATE = 0
+    ADMISSION_REDIS_URL = None
+    SUBSCRIPTIONS_REDIS_URL = None
+    PUSH_REDIS_URL = None
 
 
 config = {
@@ -65,6 +65,10 @@ class Server(_Server):
                 use_debugger = True
         if use_reloader is None:
             use_reloader = app.debug
+        # old snapshots are deleted in the background by the server only,
+        # not by the maintenance commands
+        from server.retention import retention
+        retention.start()
         socketio.run(app,
                      host=host,
                      port=port,
@@ -93,9 +97,38 @@ def createdb(drop_first=False):
     """Creates the database."""
     if drop_first:
         db.drop_all()
+        from server.ranking import ranking
+        ranking.clear()
+    from server.retention import enable_incremental_vacuum
+    for bind in [None] + list(db.get_app().config['SQLALCHEMY_BINDS']):
+        enable_incremental_vacuum(db.get_engine(bind=bind))
     db.create_all()
 
 
+@manager.command
+def rebuildlatest():
+    """Rebuilds the latest-state tables from the snapshot history."""
+    from server.ingest import rebuild_latest
+    rebuild_latest()
+
+
+@manager.command
+def rebuildrollups():
+    """Rebuilds the AnomalyData rollups from the stored history."""
+    from server.rollup import rebuild_rollups
+    rebuild_rollups(resolutions=db.get_app().config['ROLLUP_RESOLUTIONS'])
+
+
+@manager.command
+def compact(full=False):
+    """Applies the snapshot retention policies and reclaims space."""
+    from server.retention import retention, enable_incremental_vacuum
+    if full:
+        for bind in [None] + list(db.get_app().config['SQLALCHEMY_BINDS']):
+            enable_incremental_vacuum(db.get_engine(bind=bind), full=True)
+    print(retention.run_once())
+
+
 @manager.command
 def test():
     """Runs unit tests."""
@@ -3,6 +3,7 @@ import eventlet
 eventlet.monkey_patch()
 
 from server import create_app, socketio
+from server.retention import retention
 
 if __name__ == "__main__":
 	host=sys.argv[1]
@@ -12,5 +13,6 @@ if __name__ == "__main__":
 	print("port: ", port)
 
 	app = create_app()
+	retention.start()
 	socketio.run(app, host=host, port=port, debug=False, use_reloader=False)
 
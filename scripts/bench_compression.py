@@ -0,0 +1,144 @@
+"""
+Disk size vs CPU time of the execution compression codecs
+
+For synthetic steps of typical sizes, report the stored bytes and the
+write/read times of each layout (json files, segmented store) and codec.
+Read bandwidth of the shared filesystem is what matters for us: a codec
+pays off when (saved bytes / bandwidth) exceeds its extra CPU time.
+
+    python scripts/bench_compression.py [n_calls ...] [--bandwidth MB/s]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from server.compression import zstandard, open_write, open_read  # noqa
+from server.execstore import RankStore  # noqa
+
+
+def generate_step(n_calls, n_funcs=200, rank=0, step=0):
+    """Executions of one step with realistic key/name repetition"""
+    names = ['func_{}::{}'.format(i, 'x' * random.randint(5, 40))
+             for i in range(n_funcs)]
+    ts = 1565000000000000 + step * 1000000
+    execdata = []
+    for i in range(n_calls):
+        fid = random.randint(0, n_funcs - 1)
+        entry = ts + random.randint(0, 1000000)
+        runtime = random.randint(1, 5000)
+        execdata.append({
+            'key': '{}-{}-{}'.format(rank, step, i),
+            'name': names[fid],
+            'pid': 0, 'rid': rank, 'tid': random.randint(0, 3),
+            'fid': fid,
+            'entry': entry, 'exit': entry + runtime,
+            'runtime': runtime, 'exclusive': random.randint(0, runtime),
+            'label': -1 if random.random() < 0.01 else 1,
+            'parent': '{}-{}-{}'.format(rank, step, random.randint(0, i))
+            if i else 'root',
+            'n_children': random.randint(0, 5),
+            'n_messages': 0
+        })
+    commdata = [{
+        'type': 'SEND', 'pid': 0, 'rid': rank, 'tid': 0,
+        'src': rank, 'tar': random.randint(0, 63), 'bytes': 1024, 'tag': 0,
+        'timestamp': ts + i, 'fid': 0, 'name': names[0],
+        'execdata_key': '{}-{}-{}'.format(rank, step, i)
+    } for i in range(n_calls // 20)]
+    return execdata, commdata
+
+
+def timed(f, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_json(path, execdata, commdata, codec, level):
+    filename = os.path.join(path, 'step.json')
+
+    def write():
+        with open_write(filename, codec, level) as f:
+            json.dump({'exec': execdata, 'comm': commdata}, f)
+
+    def read():
+        with open_read(filename, codec) as f:
+            json.load(f)
+
+    t_write = timed(write)
+    return os.path.getsize(filename), t_write, timed(read)
+
+
+def bench_segment(path, execdata, commdata, codec, level):
+    state = {'step': 0}
+
+    def write():
+        # a fresh store each time, so that the string dictionary counts
+        shutil.rmtree(path, ignore_errors=True)
+        RankStore(path, 1 << 40).write(0, execdata, commdata, codec, level)
+
+    def read():
+        RankStore(path, 1 << 40).read(state['step'])
+
+    t_write = timed(write)
+    size = sum(os.path.getsize(os.path.join(path, f))
+               for f in os.listdir(path) if f != 'lock')
+    return size, t_write, timed(read)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('n_calls', type=int, nargs='*',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--bandwidth', type=float, default=200.,
+                        help='filesystem read bandwidth in MB/s')
+    args = parser.parse_args()
+
+    codecs = [(None, None), ('gzip', 1), ('gzip', 6)]
+    if zstandard is not None:
+        codecs += [('zstd', 1), ('zstd', 3), ('zstd', 9)]
+    else:
+        print('zstandard is not installed, skipping zstd')
+
+    random.seed(0)
+    root = tempfile.mkdtemp()
+    try:
+        print('{:>8} {:>8} {:>10} {:>12} {:>10} {:>10} {:>10} {:>10}'.format(
+            'calls', 'layout', 'codec', 'bytes', 'ratio',
+            'write ms', 'read ms', 'load ms'))
+        for n_calls in args.n_calls:
+            execdata, commdata = generate_step(n_calls)
+            for layout, bench in (('json', bench_json),
+                                  ('segment', bench_segment)):
+                base = None
+                for codec, level in codecs:
+                    path = os.path.join(root, layout)
+                    os.makedirs(path, exist_ok=True)
+                    size, t_write, t_read = bench(
+                        path, execdata, commdata, codec, level)
+                    shutil.rmtree(path, ignore_errors=True)
+                    base = base or size
+                    # read time plus transfer time at the given bandwidth
+                    t_load = t_read + size / (args.bandwidth * 1e6)
+                    print('{:>8} {:>8} {:>10} {:>12} {:>10.2f} {:>10.1f} '
+                          '{:>10.1f} {:>10.1f}'.format(
+                              n_calls, layout,
+                              '{}-{}'.format(codec, level) if codec else '-',
+                              size, base / size, t_write * 1e3,
+                              t_read * 1e3, t_load * 1e3))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
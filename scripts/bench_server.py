@@ -0,0 +1,315 @@
+"""
+Ingest and query benchmark of the visualization server
+
+Runs the server fully in-process: sqlite databases in a temporary
+directory, eager Celery tasks as in TestingConfig and Socket.IO pushes
+sent to a null emitter (coalesced and encoded, but not transmitted).
+The routes are driven through the Flask test client at the given number
+of ranks, functions and steps:
+
+    new_anomalydata         POST /api/anomalydata, all ranks of a step
+    new_executions          POST /api/executions, one (rank, step)
+    get_anomalystats        GET  /api/get_anomalystats
+    get_funcstats           GET  /api/get_funcstats
+    query_history           POST /events/query_history, all ranks
+    query_executions_file   GET  /events/query_executions_file
+
+and the throughput (requests per second of wall-clock time over the run)
+and latency percentiles of each are reported. With --save the results
+are written as a JSON baseline; with --compare they are checked against
+a baseline, and the exit status is 1 if an operation got slower than
+--tolerance allows.
+
+    python scripts/bench_server.py [--ranks N] [--funcs N] [--steps N]
+        [--calls N] [--exec-ranks N] [--repeat N] [--seed N]
+        [--save FILE] [--compare FILE] [--tolerance 0.2]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from config import config, TestingConfig  # noqa
+from bench_compression import generate_step  # noqa
+
+
+# per-operation numbers compared against the baseline, and whether a
+# larger value is better
+COMPARED = (('ops_per_second', True), ('p50_ms', False), ('p99_ms', False))
+
+
+def bench_config(root):
+    """TestingConfig with its databases and executions under root"""
+    def sqlite(name):
+        return 'sqlite:///' + os.path.join(root, name + '.sqlite')
+
+    class BenchConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = sqlite('main')
+        SQLALCHEMY_BINDS = {
+            bind: sqlite(bind)
+            for bind in ('anomaly_stats', 'anomaly_data', 'func_stats')
+        }
+        EXECUTION_PATH = os.path.join(root, 'executions')
+        ADMISSION_HIGH_WATER = 0
+        PUSH_MAX_RATE = 0
+
+    return BenchConfig
+
+
+def random_stats():
+    return {
+        'count': random.randint(1, 100),
+        'accumulate': random.random() * 100,
+        'minimum': random.random(),
+        'maximum': random.random() * 100,
+        'mean': random.random() * 50,
+        'stddev': random.random() * 10,
+        'skewness': random.random() - 0.5,
+        'kurtosis': random.random() - 0.5
+    }
+
+
+def anomaly_payload(n_ranks, n_funcs, step):
+    ts = int(time.time() * 1000)
+    return {
+        'created_at': ts,
+        'anomaly': [{
+            'key': '0:{}'.format(rank),
+            'stats': random_stats(),
+            'data': [{
+                'app': 0, 'rank': rank, 'step': step,
+                'min_timestamp': ts + random.randint(0, 1000),
+                'max_timestamp': ts + random.randint(1000, 2000),
+                'n_anomalies': random.randint(0, 100),
+                'stat_id': '0:{}'.format(rank)
+            }]
+        } for rank in range(n_ranks)],
+        'func': [{
+            'fid': fid,
+            'name': 'func_{}'.format(fid),
+            'stats': random_stats(),
+            'inclusive': random_stats(),
+            'exclusive': random_stats()
+        } for fid in range(n_funcs)]
+    }
+
+
+def percentile(samples, q):
+    """q-quantile of sorted samples (nearest rank)"""
+    i = min(max(int(round(q * len(samples) + 0.5)) - 1, 0), len(samples) - 1)
+    return samples[i]
+
+
+def summarize(samples, elapsed, extra=None):
+    """Throughput over the wall-clock time of the run, and latencies"""
+    samples = sorted(samples)
+    d = {
+        'n': len(samples),
+        'ops_per_second': len(samples) / elapsed if elapsed else 0.,
+        'mean_ms': sum(samples) / len(samples) * 1e3,
+        'p50_ms': percentile(samples, 0.5) * 1e3,
+        'p90_ms': percentile(samples, 0.9) * 1e3,
+        'p99_ms': percentile(samples, 0.99) * 1e3,
+        'max_ms': samples[-1] * 1e3
+    }
+    d.update(extra or {})
+    return d
+
+
+class Bench(object):
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.results = {}
+
+    def run(self, name, requests, extra=None):
+        """Time each request (a callable returning a response) and the run"""
+        samples = []
+        start = time.perf_counter()
+        for request in requests:
+            t0 = time.perf_counter()
+            rv = request()
+            rv.get_data()  # consume streamed responses
+            samples.append(time.perf_counter() - t0)
+            if rv.status_code >= 400:
+                raise RuntimeError('{}: status {}'.format(
+                    name, rv.status_code))
+        elapsed = time.perf_counter() - start
+        self.results[name] = summarize(samples, elapsed, extra)
+
+    def post(self, url, data):
+        body = json.dumps(data)
+        return lambda: self.client.post(
+            url, data=body, content_type='application/json')
+
+    def get(self, url):
+        return lambda: self.client.get(url)
+
+    def ingest(self):
+        a = self.args
+        payloads = [anomaly_payload(a.ranks, a.funcs, step)
+                    for step in range(a.steps)]
+        self.run('new_anomalydata',
+                 [self.post('/api/anomalydata', p) for p in payloads],
+                 {'ranks': a.ranks, 'funcs': a.funcs})
+
+        requests = []
+        for step in range(a.steps):
+            for rank in range(a.exec_ranks):
+                execdata, commdata = generate_step(a.calls, a.funcs,
+                                                   rank, step)
+                requests.append(self.post('/api/executions', {
+                    'app': 0, 'rank': rank, 'step': step,
+                    'exec': execdata, 'comm': commdata
+                }))
+        self.run('new_executions', requests, {'calls': a.calls})
+
+    def query(self):
+        a = self.args
+        n = a.repeat
+        self.run('get_anomalystats',
+                 [self.get('/api/get_anomalystats')] * n)
+        self.run('get_funcstats', [self.get('/api/get_funcstats')] * n)
+        self.run('query_history', [
+            self.post('/events/query_history', {
+                'qRanks': list(range(a.ranks)),
+                'last_step': random.randint(0, a.steps - 1)
+            }) for _ in range(n)])
+        self.run('query_executions_file', [
+            self.get('/events/query_executions_file?pid=0&rid={}&step={}'
+                     .format(random.randrange(a.exec_ranks),
+                             random.randrange(a.steps)))
+            for _ in range(n)])
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against the baseline, return the regressions"""
+    regressions = []
+    print('\n{:<24} {:<16} {:>12} {:>12} {:>8}'.format(
+        'operation', 'metric', 'baseline', 'current', 'change'))
+    for name, d in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        for metric, higher_is_better in COMPARED:
+            b, c = base.get(metric), d.get(metric)
+            if not b or c is None:
+                continue
+            change = c / b - 1.
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag = ' !'
+                regressions.append((name, metric, change))
+            print('{:<24} {:<16} {:>12.3f} {:>12.3f} {:>+7.1%}{}'.format(
+                name, metric, b, c, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ingest and query routes in-process')
+    parser.add_argument('--ranks', type=int, default=100)
+    parser.add_argument('--funcs', type=int, default=50)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--calls', type=int, default=1000,
+                        help='executions per (rank, step)')
+    parser.add_argument('--exec-ranks', type=int, default=4,
+                        help='ranks posting executions')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='requests per query operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    root = tempfile.mkdtemp()
+    try:
+        # the Celery tasks build their app from SERVER_CONFIG
+        config['bench'] = bench_config(root)
+        os.environ['SERVER_CONFIG'] = 'bench'
+
+        import server.events
+        from server import create_app, db
+        from server.emitter import PushScheduler
+        from server.models import AnomalyStatQuery
+        from server.statquery import stat_query
+        from server.tracing import tracer
+
+        app = create_app('bench')
+        with app.app_context():
+            db.create_all()
+            import server.wsgi_aux  # noqa: F401, before changing singletons
+
+            # pushes go through a scheduler but not over the wire
+            n_pushed = []
+            server.events.push_scheduler = PushScheduler(
+                app, emit=lambda event, data, **kwargs: n_pushed.append(event))
+
+            # every rank is watched, so that history is pushed too
+            q = AnomalyStatQuery.create({
+                'nQueries': 5, 'statKind': 'stddev',
+                'ranks': [(0, rank) for rank in range(args.ranks)]})
+            db.session.add(q)
+            db.session.commit()
+            stat_query.invalidate(q)
+            tracer.clear()
+
+            bench = Bench(app.test_client(), args)
+            bench.ingest()
+            bench.query()
+
+        print('{:<24} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'operation', 'n', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms',
+            'max ms'))
+        for name, d in bench.results.items():
+            print('{:<24} {:>6} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f} '
+                  '{:>10.2f}'.format(name, d['n'], d['ops_per_second'],
+                                     d['p50_ms'], d['p90_ms'], d['p99_ms'],
+                                     d['max_ms']))
+        print('{} pushes'.format(len(n_pushed)))
+
+        report = {
+            'params': {k: v for k, v in vars(args).items()
+                       if k not in ('save', 'compare', 'tolerance')},
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'created_at': int(time.time()),
+            'results': bench.results,
+            'spans': tracer.stats()
+        }
+
+        status = 0
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+            if baseline.get('params') != report['params']:
+                print('warning: baseline parameters differ: {}'.format(
+                    baseline.get('params')))
+            regressions = compare(bench.results, baseline, args.tolerance)
+            if len(regressions):
+                print('\n{} regression(s) beyond {:.0%}'.format(
+                    len(regressions), args.tolerance))
+                status = 1
+
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            print('saved to {}'.format(args.save))
+        return status
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""
+Load generator emulating the in-situ AD modules
+
+N AD ranks are spread over worker processes. Each rank runs its steps
+every --interval seconds and posts, per step, what an AD module sends:
+
+- /api/anomalydata: its anomaly statistics (running over its steps), the
+  AnomalyData of the step and the statistics of the functions it ran
+- /api/executions: the executions and communications of the step, every
+  --exec-every steps (0: never)
+
+The load is open-loop: requests are sent on schedule whatever the server
+does, by a pool of --connections threads per process, each with its own
+keep-alive session (--no-keep-alive opens a connection per request).
+--burstiness sets how aligned the ranks are: 1 sends all ranks at the
+start of each step, like MPI ranks finishing a step together, 0 spreads
+them evenly over the interval. The latency is measured both from the
+send (service time) and from the scheduled time, which also counts the
+time a request waited for a free connection.
+
+With --ramp, the load runs in stages at the given multiples of the rate,
+so that the saturation point shows as the stage where the achieved rate
+falls behind the target or the latency takes off.
+
+    python scripts/load_ad.py [--url http://127.0.0.1:5000] [--ranks N]
+        [--processes N] [--connections N] [--interval SEC]
+        [--duration SEC] [--burstiness 0..1] [--funcs N] [--calls N]
+        [--exec-every N] [--ramp 1,2,4] [--honor-retry-after]
+
+Payloads are generated here without importing the server, so the script
+only needs requests and runstats on the machine running it.
+"""
+import argparse
+import heapq
+import multiprocessing
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from runstats import Statistics
+
+
+STAT_FIELDS = ('count', 'accumulate', 'minimum', 'maximum', 'mean',
+               'stddev', 'skewness', 'kurtosis')
+
+
+def timestamp():
+    return int(round(time.time() * 1000))
+
+
+def stats_dict(s: Statistics, total):
+    """AnomalyStat/FuncStat statistics of running Statistics"""
+    n = len(s)
+    d = {
+        'count': n,
+        'accumulate': total,
+        'minimum': s.minimum() if n else 0.,
+        'maximum': s.maximum() if n else 0.,
+        'mean': s.mean() if n else 0.,
+        'stddev': 0., 'skewness': 0., 'kurtosis': 0.
+    }
+    try:
+        d.update(stddev=s.stddev(), skewness=s.skewness(),
+                 kurtosis=s.kurtosis())
+    except ZeroDivisionError:
+        pass
+    return d
+
+
+def random_func_stats():
+    return {k: random.random() * 100 for k in STAT_FIELDS}
+
+
+class ADRank(object):
+    """State of one emulated AD module"""
+
+    def __init__(self, app, rank, n_funcs, n_calls):
+        self.app = app
+        self.rank = rank
+        self.n_funcs = n_funcs
+        self.n_calls = n_calls
+        self.mean = float(random.randint(0, 50))
+        self.stddev = float(random.randint(1, 10))
+        self.stats = Statistics()
+        self.total = 0.
+
+    def anomaly_payload(self, step):
+        n = max(int(random.normalvariate(self.mean, self.stddev)), 0)
+        self.stats.push(n)
+        self.total += n
+        ts = timestamp()
+        funcs = random.sample(range(self.n_funcs),
+                              min(self.n_funcs, random.randint(1, 20)))
+        return {
+            'created_at': ts,
+            'anomaly': [{
+                'key': '{}:{}'.format(self.app, self.rank),
+                'stats': stats_dict(self.stats, self.total),
+                'data': [{
+                    'app': self.app,
+                    'rank': self.rank,
+                    'step': step,
+                    'min_timestamp': ts - random.randint(500, 1000),
+                    'max_timestamp': ts,
+                    'n_anomalies': n,
+                    'stat_id': '{}:{}'.format(self.app, self.rank)
+                }]
+            }],
+            'func': [{
+                'fid': fid,
+                'name': 'func_{}'.format(fid),
+                'stats': random_func_stats(),
+                'inclusive': random_func_stats(),
+                'exclusive': random_func_stats()
+            } for fid in funcs]
+        }
+
+    def execution_payload(self, step):
+        ts = timestamp() * 1000  # usec
+        execdata = []
+        for i in range(self.n_calls):
+            fid = random.randrange(self.n_funcs)
+            entry = ts + random.randint(0, 1000000)
+            runtime = random.randint(1, 5000)
+            execdata.append({
+                'key': '{}-{}-{}'.format(self.rank, step, i),
+                'name': 'func_{}'.format(fid),
+                'pid': self.app, 'rid': self.rank,
+                'tid': random.randint(0, 3), 'fid': fid,
+                'entry': entry, 'exit': entry + runtime,
+                'runtime': runtime,
+                'exclusive': random.randint(0, runtime),
+                'label': -1 if random.random() < 0.01 else 1,
+                'parent': '{}-{}-{}'.format(self.rank, step,
+                                            random.randint(0, i - 1))
+                if i else 'root',
+                'n_children': random.randint(0, 5),
+                'n_messages': 0
+            })
+        commdata = [{
+            'type': 'SEND', 'pid': self.app, 'rid': self.rank, 'tid': 0,
+            'src': self.rank, 'tar': random.randint(0, 63), 'bytes': 1024,
+            'tag': 0, 'timestamp': ts + i, 'fid': 0, 'name': 'func_0',
+            'execdata_key': '{}-{}-{}'.format(self.rank, step, i)
+        } for i in range(self.n_calls // 20)]
+        return {'app': self.app, 'rank': self.rank, 'step': step,
+                'exec': execdata, 'comm': commdata}
+
+
+class Recorder(object):
+    """Outcomes of the requests of one process, per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.codes = defaultdict(Counter)
+        self.latency = defaultdict(list)
+        self.lag = defaultdict(list)
+
+    def add(self, endpoint, code, latency, lag):
+        with self._lock:
+            self.codes[endpoint][code] += 1
+            self.latency[endpoint].append(latency)
+            self.lag[endpoint].append(lag)
+
+    def to_dict(self):
+        return {
+            'codes': {k: dict(v) for k, v in self.codes.items()},
+            'latency': dict(self.latency),
+            'lag': dict(self.lag)
+        }
+
+
+def run_process(args, ranks, interval, duration, seed):
+    """Emulate the given ranks for `duration` seconds, return the results"""
+    random.seed(seed)
+    local = threading.local()
+    recorder = Recorder()
+    pause = {'until': 0.}  # Retry-After told by the server
+
+    def session():
+        s = getattr(local, 'session', None)
+        if s is None:
+            s = local.session = requests.Session()
+            if not args.keep_alive:
+                s.headers['Connection'] = 'close'
+        return s
+
+    def send(endpoint, payload, scheduled):
+        if args.honor_retry_after and time.time() < pause['until']:
+            recorder.add(endpoint, 'deferred', 0., time.time() - scheduled)
+            return
+        t0 = time.time()
+        try:
+            rv = session().post(args.url + endpoint, json=payload,
+                                timeout=args.timeout)
+            code = rv.status_code
+            if code == 429:
+                retry = float(rv.headers.get('Retry-After', 1))
+                pause['until'] = max(pause['until'], time.time() + retry)
+        except requests.RequestException as e:
+            code = type(e).__name__
+        t1 = time.time()
+        recorder.add(endpoint, code, t1 - t0, t1 - scheduled)
+
+    ads = [ADRank(args.app, rank, args.funcs, args.calls) for rank in ranks]
+
+    # (due time, rank index, step) of the next step of each rank
+    start = time.time() + 0.1
+    queue = [(start + (1. - args.burstiness) * random.random() * interval,
+              i, 0) for i in range(len(ads))]
+    heapq.heapify(queue)
+
+    with ThreadPoolExecutor(args.connections) as pool:
+        while len(queue):
+            due, i, step = heapq.heappop(queue)
+            if due >= start + duration:
+                continue
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            ad = ads[i]
+            pool.submit(send, '/api/anomalydata',
+                        ad.anomaly_payload(step), due)
+            if args.exec_every > 0 and step % args.exec_every == 0:
+                pool.submit(send, '/api/executions',
+                            ad.execution_payload(step), due)
+            heapq.heappush(queue, (due + interval, i, step + 1))
+
+    return recorder.to_dict()
+
+
+def percentile(samples, q):
+    """q-quantile of sorted samples (nearest rank)"""
+    if not len(samples):
+        return 0.
+    i = min(max(int(round(q * len(samples) + 0.5)) - 1, 0), len(samples) - 1)
+    return samples[i]
+
+
+def run_stage(args, interval):
+    """Run all processes at the given step interval and merge their results"""
+    ranks = list(range(args.ranks))
+    chunks = [ranks[p::args.processes] for p in range(args.processes)]
+    jobs = [(args, chunk, interval, args.duration, args.seed + p)
+            for p, chunk in enumerate(chunks) if len(chunk)]
+
+    t0 = time.time()
+    with multiprocessing.Pool(len(jobs)) as pool:
+        results = pool.starmap(run_process, jobs)
+    elapsed = time.time() - t0
+
+    codes = defaultdict(Counter)
+    latency = defaultdict(list)
+    lag = defaultdict(list)
+    for r in results:
+        for endpoint, c in r['codes'].items():
+            codes[endpoint].update(c)
+        for endpoint, v in r['latency'].items():
+            latency[endpoint].extend(v)
+        for endpoint, v in r['lag'].items():
+            lag[endpoint].extend(v)
+    return codes, latency, lag, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Emulate in-situ AD modules posting to the server')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--app', type=int, default=0)
+    parser.add_argument('--ranks', type=int, default=100)
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--connections', type=int, default=8,
+                        help='concurrent connections per process')
+    parser.add_argument('--interval', type=float, default=1.,
+                        help='seconds between the steps of a rank')
+    parser.add_argument('--duration', type=float, default=30.,
+                        help='seconds per stage')
+    parser.add_argument('--burstiness', type=float, default=0.,
+                        help='0: ranks spread over the interval, '
+                             '1: all ranks at once')
+    parser.add_argument('--funcs', type=int, default=100)
+    parser.add_argument('--calls', type=int, default=1000,
+                        help='executions per (rank, step)')
+    parser.add_argument('--exec-every', type=int, default=1,
+                        help='post executions every N steps (0: never)')
+    parser.add_argument('--ramp', default='1',
+                        help='comma-separated multiples of the rate')
+    parser.add_argument('--no-keep-alive', dest='keep_alive',
+                        action='store_false')
+    parser.add_argument('--honor-retry-after', action='store_true',
+                        help='skip sending while a 429 Retry-After lasts')
+    parser.add_argument('--timeout', type=float, default=30.)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+    args.burstiness = min(max(args.burstiness, 0.), 1.)
+
+    print('{:>6} {:<18} {:>10} {:>10} {:>8} {:>9} {:>9} {:>9} {:>9}  {}'
+          .format('stage', 'endpoint', 'target/s', 'achieved', 'ok %',
+                  'p50 ms', 'p99 ms', 'max ms', 'lag p99', 'codes'))
+    for multiple in [float(m) for m in args.ramp.split(',') if m]:
+        interval = args.interval / multiple
+        codes, latency, lag, elapsed = run_stage(args, interval)
+        target = args.ranks / interval
+        for endpoint in sorted(codes):
+            n = sum(codes[endpoint].values())
+            n_ok = sum(v for k, v in codes[endpoint].items()
+                       if isinstance(k, int) and k < 300)
+            lat = sorted(latency[endpoint])
+            lags = sorted(lag[endpoint])
+            if endpoint == '/api/executions':
+                endpoint_target = target / args.exec_every
+            else:
+                endpoint_target = target
+            print('{:>6} {:<18} {:>10.1f} {:>10.1f} {:>8.1f} {:>9.1f} '
+                  '{:>9.1f} {:>9.1f} {:>9.1f}  {}'.format(
+                      'x{:g}'.format(multiple), endpoint, endpoint_target,
+                      n_ok / elapsed, 100. * n_ok / n if n else 0.,
+                      percentile(lat, 0.5) * 1e3,
+                      percentile(lat, 0.99) * 1e3,
+                      (lat[-1] if len(lat) else 0.) * 1e3,
+                      percentile(lags, 0.99) * 1e3,
+                      ' '.join('{}:{}'.format(k, v) for k, v in
+                               sorted(codes[endpoint].items(),
+                                      key=lambda kv: str(kv[0])))))
+
+
+if __name__ == '__main__':
+    main()
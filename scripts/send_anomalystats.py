@@ -8,6 +8,9 @@ pseudo_ad.py :
   given [mean, stdandard deviation] and send to parameter server.
 - And, the (# anomalies)
 
+Its payload predates the current /api/anomalydata format; see
+scripts/load_ad.py for a multi-process load generator with anomaly,
+function and execution payloads.
 """
 import requests
 import time
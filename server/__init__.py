@@ -35,6 +35,47 @@ def create_app(config_name=None, main=True):
 
     # Initialize flask extensions
     db.init_app(app)
+
+    # Initialize write-behind ingest queue
+    from .ingest import ingest_queue
+    ingest_queue.init_app(app)
+
+    # Initialize top/bottom ranking of anomaly statistics
+    from .ranking import ranking
+    ranking.init_app(app)
+
+    # Initialize cache of the active query condition
+    from .statquery import stat_query
+    stat_query.init_app(app)
+
+    # Initialize cache of decoded execution steps
+    from .execcache import step_cache
+    step_cache.init_app(app)
+
+    # Initialize timing spans of the ingest pipeline
+    from .tracing import tracer
+    tracer.init_app(app)
+
+    # Initialize request metrics
+    from .stats import metrics
+    metrics.init_app(app)
+
+    # Initialize admission control of the ingest routes
+    from .admission import admission
+    admission.init_app(app)
+
+    # Initialize counts of the Socket.IO sessions per encoded room
+    from .subscriptions import subscriptions
+    subscriptions.init_app(app)
+
+    # Initialize coalescing/rate limiting of Socket.IO pushes
+    from .emitter import push_scheduler
+    push_scheduler.init_app(app)
+
+    # Initialize retention of old snapshots; the background loop is
+    # started by the serving entrypoints only (see retention.start)
+    from .retention import retention
+    retention.init_app(app)
     if main:
         # Initialize socketio server and attach it to the message queue, so
         # that everything works even when there are multiple servers or
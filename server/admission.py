@@ -0,0 +1,234 @@
+"""
+Admission control of the ingest routes
+
+Each POST to /api/anomalydata or /api/executions takes a lease before it
+is handed to Celery. Past ADMISSION_HIGH_WATER leases, new requests are
+answered with 429 and a Retry-After hint instead of piling up in the
+broker, so that the AD modules can back off. Low-priority work
+(executions) is shed earlier, from ADMISSION_SHED_RATIO *
+ADMISSION_HIGH_WATER, to keep room for the stats.
+
+With ADMISSION_REDIS_URL, the leases are kept in Redis sorted sets shared
+by all web servers and workers: a lease is taken atomically (check and
+add in one script) by the web server, handed to the Celery task and
+released by the worker once done. Leases expire after ADMISSION_LEASE
+seconds, so the slots of a crashed worker come back by themselves.
+
+Without Redis, the leases are counted in-process and released by the
+same process at the end of the request. This bounds the requests being
+handled by this process (including the tasks run eagerly), not the depth
+of a broker shared with separate workers.
+"""
+import math
+import threading
+import time
+import uuid
+from functools import wraps
+
+from flask import g, jsonify
+
+
+# work class -> priority, higher priorities being shed first
+WORK_CLASSES = {
+    'anomalydata': 0,
+    'executions': 1
+}
+
+# KEYS: lease sets of all the work classes
+# ARGV: now, limit, index of the key to add to, lease id, expiry, ttl
+ACQUIRE_SCRIPT = """
+local total = 0
+for _, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[1])
+    total = total + redis.call('ZCARD', key)
+end
+if total >= tonumber(ARGV[2]) then
+    return 0
+end
+local key = KEYS[tonumber(ARGV[3])]
+redis.call('ZADD', key, ARGV[5], ARGV[4])
+redis.call('EXPIRE', key, ARGV[6])
+return 1
+"""
+
+
+class AdmissionControl(object):
+    """Bound the ingest work queued for the Celery workers"""
+
+    def __init__(self, app=None):
+        self.high_water = 0
+        self.shed_ratio = 1.
+        self.retry_after = 1.
+        self.lease = 300.
+        self._redis = None
+        self._acquire = None
+        self._key = 'chimbuko:admission:{}'
+
+        self._lock = threading.Lock()
+        self._depth = {c: 0 for c in WORK_CLASSES}
+        self._stats = {c: {'n_admitted': 0, 'n_rejected': 0}
+                       for c in WORK_CLASSES}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.high_water = int(app.config.get('ADMISSION_HIGH_WATER', 0))
+        self.shed_ratio = float(app.config.get('ADMISSION_SHED_RATIO', 1.))
+        self.retry_after = float(app.config.get('ADMISSION_RETRY_AFTER', 1.))
+        self.lease = float(app.config.get('ADMISSION_LEASE', 300.))
+        url = app.config.get('ADMISSION_REDIS_URL', None)
+        if url is not None:
+            import redis
+            self._redis = redis.StrictRedis.from_url(url)
+            self._acquire = self._redis.register_script(ACQUIRE_SCRIPT)
+        else:
+            self._redis = None
+            self._acquire = None
+        app.teardown_request(self._teardown)
+
+    @property
+    def enabled(self):
+        return self.high_water > 0
+
+    @property
+    def shared(self):
+        """True if the leases are released by the Celery workers"""
+        return self._redis is not None
+
+    def _keys(self):
+        return [self._key.format(c) for c in WORK_CLASSES]
+
+    def depth(self):
+        """Return the leases held per work class"""
+        if self._redis is None:
+            with self._lock:
+                return dict(self._depth)
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for key in self._keys():
+                pipe.zcount(key, time.time(), '+inf')
+            values = pipe.execute()
+        except Exception as e:
+            print('Exception on admission depth: ', e)
+            return {c: 0 for c in WORK_CLASSES}
+        return {c: int(v) for c, v in zip(WORK_CLASSES, values)}
+
+    def limit(self, work_class):
+        """Number of leases from which work of this class is rejected"""
+        if WORK_CLASSES[work_class] > 0:
+            return max(int(self.high_water * self.shed_ratio), 1)
+        return self.high_water
+
+    def admit(self, work_class):
+        """
+        Take a lease if there is room: return (work_class, lease id), or
+        None if the request has to be rejected ((None, None) if admission
+        control is disabled)
+        """
+        if not self.enabled:
+            return None, None
+        limit = self.limit(work_class)
+
+        if self._redis is None:
+            with self._lock:
+                admitted = sum(self._depth.values()) < limit
+                if admitted:
+                    self._depth[work_class] += 1
+            lease = (work_class, None)
+        else:
+            lease = (work_class, uuid.uuid4().hex)
+            now = time.time()
+            try:
+                admitted = bool(self._acquire(keys=self._keys(), args=[
+                    now, limit, list(WORK_CLASSES).index(work_class) + 1,
+                    lease[1], now + self.lease, int(math.ceil(self.lease))]))
+            except Exception as e:
+                # don't turn a Redis outage into an ingest outage
+                print('Exception on admission: ', e)
+                admitted = True
+
+        with self._lock:
+            key = 'n_admitted' if admitted else 'n_rejected'
+            self._stats[work_class][key] += 1
+        return lease if admitted else None
+
+    def release(self, lease):
+        """Give a lease back once the work is done"""
+        if lease is None:
+            return
+        work_class, lease_id = lease
+        if work_class not in WORK_CLASSES:
+            return
+        if lease_id is None:
+            with self._lock:
+                self._depth[work_class] = max(self._depth[work_class] - 1, 0)
+            return
+        if self._redis is None:
+            return
+        try:
+            self._redis.zrem(self._key.format(work_class), lease_id)
+        except Exception as e:
+            print('Exception on admission release: ', e)
+
+    def hand_over(self):
+        """
+        Return the lease of the current request for the Celery task to
+        release, if the leases are shared; else it stays with the request
+        """
+        lease = getattr(g, 'admission_lease', None)
+        if lease is None or lease[1] is None:
+            return None
+        g.admission_lease = None
+        return lease
+
+    def _teardown(self, exc):
+        # leases not handed over to a task end with the request
+        lease = g.pop('admission_lease', None)
+        if lease is not None:
+            self.release(lease)
+
+    def retry_hint(self):
+        """Seconds to wait before retrying, growing with the queue depth"""
+        depth = sum(self.depth().values())
+        return max(int(math.ceil(
+            self.retry_after * depth / max(self.high_water, 1))), 1)
+
+    def stats(self):
+        """Return the queue depth and admission counters per work class"""
+        depth = self.depth()
+        with self._lock:
+            classes = {c: dict(self._stats[c], depth=depth[c],
+                               limit=self.limit(c))
+                       for c in WORK_CLASSES}
+        return {
+            'enabled': self.enabled,
+            'shared': self.shared,
+            'high_water': self.high_water,
+            'depth': sum(depth.values()),
+            'classes': classes
+        }
+
+
+admission = AdmissionControl()
+
+
+def admission_control(work_class):
+    """
+    Decorator of a make_async route: reject the request with 429 when the
+    queue is too deep, else hold a lease for it
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if getattr(g, 'in_celery', False):
+                return f(*args, **kwargs)
+            lease = admission.admit(work_class)
+            if lease is None:
+                rv = jsonify({'error': 'too many queued requests'})
+                return rv, 429, {'Retry-After': str(admission.retry_hint())}
+            if lease[0] is not None:
+                g.admission_lease = lease
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
@@ -1,17 +1,34 @@
 from flask import request, jsonify, abort, current_app
 
 from .. import db
-from ..models import AnomalyStat, AnomalyData, FuncStat, AnomalyStatQuery
+from ..models import AnomalyStat, AnomalyStatLatest, AnomalyData, \
+    FuncStat, FuncStatLatest
 from . import api
 from ..tasks import make_async
+from ..admission import admission_control
+from ..tracing import tracer
 from ..utils import timestamp, url_for
 from requests import post
 from ..events import push_data
+from ..subscriptions import rank_room
+from ..ingest import ingest_queue
+from ..ranking import ranking
+from ..statquery import stat_query
+from ..rollup import query_history
 
 from sqlalchemy.exc import IntegrityError
 from runstats import Statistics
 from sqlalchemy import func, and_
 
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+# content types accepted for the columnar (msgpack) ingest format
+MSGPACK_MIMETYPES = ('application/x-msgpack', 'application/msgpack')
+
 
 def process_on_anomaly(data:list, ts):
     """
@@ -73,72 +90,87 @@ def process_on_func(data:list, ts):
     return func_stat
 
 
-def delete_old_anomaly():
-    subq = db.session.query(
-        AnomalyStat.app,
-        AnomalyStat.rank,
-        func.max(AnomalyStat.created_at).label('max_ts')
-    ).group_by(AnomalyStat.app, AnomalyStat.rank).subquery('t2')
+def valid_columns(columns, required=()):
+    """
+    True if columns is a column batch whose arrays all have the same
+    length, holding the required columns unless it is empty
+    """
+    if not isinstance(columns, dict):
+        return False
+    if not all(isinstance(v, list) for v in columns.values()):
+        return False
+    lengths = {len(v) for v in columns.values()}
+    if len(lengths) > 1:
+        return False
+    if len(lengths) and lengths.pop() > 0:
+        return all(k in columns for k in required)
+    return True
+
 
-    ret = [ [d.id, d.key_ts] for d in db.session.query(AnomalyStat).join(
-        subq,
-        and_(
-            AnomalyStat.app == subq.c.app,
-            AnomalyStat.rank == subq.c.rank,
-            AnomalyStat.created_at < subq.c.max_ts
-        )
-    ).all()]
+def table_columns(model, columns: dict):
+    """Keep only the columns that exist in the model's table"""
+    names = model.__table__.columns.keys()
+    return {k: v for k, v in columns.items() if k in names and k != 'id'}
 
-    ids = [q[0] for q in ret]
-    keys = [q[1] for q in ret]
 
-    db.engine.execute(
-        AnomalyStat.__table__.delete().where(AnomalyStat.id.in_(ids))
-    )
-    # db.engine.execute(
-    #     Stat.__table__.delete().where(Stat.anomalystat_key.in_(keys))
-    # )
+def process_on_anomaly_columns(stat_columns: dict, data_columns: dict, ts):
+    """
+    process on columnar anomaly data before adding to database
+    """
+    stat_columns = table_columns(AnomalyStat, stat_columns)
+    data_columns = table_columns(AnomalyData, data_columns)
+
+    n = len(stat_columns.get('rank', []))
+    if n:
+        keys = ['{}:{}'.format(app, rank) for app, rank in
+                zip(stat_columns['app'], stat_columns['rank'])]
+        stat_columns.update({
+            'key': keys,
+            'key_ts': ['{}:{}'.format(key, ts) for key in keys],
+            'created_at': [ts] * n
+        })
+    return stat_columns, data_columns
 
 
-def delete_old_func():
-    subq = db.session.query(
-        FuncStat.fid,
-        func.max(FuncStat.created_at).label('max_ts')
-    ).group_by(FuncStat.fid).subquery('t2')
+def process_on_func_columns(func_columns: dict, ts):
+    """
+    process on columnar function statistics before adding to database
+    """
+    func_columns = table_columns(FuncStat, func_columns)
 
-    ret = [[d.id, d.key_ts] for d in db.session.query(FuncStat).join(
-        subq,
-        and_(
-            FuncStat.fid == subq.c.fid,
-            FuncStat.created_at < subq.c.max_ts
-        )
-    ).all()]
+    n = len(func_columns.get('fid', []))
+    if n:
+        func_columns.update({
+            'key_ts': ['{}:{}'.format(fid, ts) for fid in func_columns['fid']],
+            'created_at': [ts] * n
+        })
+    return func_columns
 
-    ids = [q[0] for q in ret]
-    keys = list(set([q[1] for q in ret]))
 
-    db.engine.execute(
-        FuncStat.__table__.delete().where(FuncStat.id.in_(ids))
-    )
-    # db.engine.execute(
-    #     Stat.__table__.delete().where(Stat.funcstat_key.in_(keys))
-    # )
+def column_rows(columns: dict, indices):
+    """Build row dictionaries for the selected indices of a column batch"""
+    return [{k: v[i] for k, v in columns.items()} for i in indices]
 
 
-def push_anomaly_stat(q, anomaly_stats:list):
+def push_anomaly_stat(q, anomaly_stats:list, columns:dict=None):
 
     # query arguments
     nQueries = q.nQueries
     statKind = q.statKind
 
-    anomaly_stats.sort(key=lambda d: d[statKind], reverse=True)
+    # the ranking holds the latest statistics of every rank, so that the
+    # top/bottom ranks are the extremes of the whole job, not of this batch
+    if anomaly_stats is not None:
+        ranking.update(anomaly_stats)
+    if columns is not None:
+        ranking.update_columns(columns)
 
     top_stats = []
     bottom_stats = []
-    if anomaly_stats is not None and len(anomaly_stats):
-        nQueries = min(nQueries, len(anomaly_stats))
-        top_stats = anomaly_stats[:nQueries]
-        bottom_stats = anomaly_stats[-nQueries:]
+    if len(ranking):
+        nQueries = min(nQueries, len(ranking))
+        top_stats = ranking.top(statKind, nQueries)
+        bottom_stats = ranking.bottom(statKind, nQueries)
 
     # ---------------------------------------------------
     # processing data for the front-end
@@ -162,18 +194,25 @@ def push_anomaly_stat(q, anomaly_stats:list):
 
 
 def push_anomaly_data(q, anomaly_data:list):
-    q = q.to_dict()
-    ranks = q.get('ranks', [])
+    ranks = q.ranks  # set of (app, rank) watched by any session
 
     if len(ranks) == 0:
         return
 
-    selected = list(filter(lambda d: d['rank'] in ranks, anomaly_data))
-    selected.sort(key=lambda d: d['min_timestamp'])
-    push_data(selected, 'update_history')
+    # one emit per (app, rank) room, reaching the sessions watching it
+    rooms = {}
+    for d in anomaly_data:
+        member = (d.get('app', 0), d['rank'])
+        if member in ranks:
+            rooms.setdefault(member, []).append(d)
+
+    for (app, rank), selected in rooms.items():
+        selected.sort(key=lambda d: d['min_timestamp'])
+        push_data(selected, 'update_history', room=rank_room(app, rank))
 
 
 @api.route('/anomalydata', methods=['POST'])
+@admission_control('anomalydata')
 @make_async
 def new_anomalydata():
     """
@@ -223,6 +262,9 @@ def new_anomalydata():
 
     """
     # print('new_anomalydata')
+    if request.mimetype in MSGPACK_MIMETYPES:
+        return new_anomalydata_columns()
+
     data = request.get_json() or {}
 
     ts = data.get('created_at', None)
@@ -230,61 +272,148 @@ def new_anomalydata():
         abort(400)
 
     # print('processing...')
-    anomaly_stat, anomaly_data = \
-        process_on_anomaly(data.get('anomaly', []), ts)
-    func_stat = process_on_func(data.get('func', []), ts)
+    with tracer.span('anomalydata.process'):
+        anomaly_stat, anomaly_data = \
+            process_on_anomaly(data.get('anomaly', []), ts)
+        func_stat = process_on_func(data.get('func', []), ts)
 
     # print('update db...')
     try:
-        if len(anomaly_stat):
-            db.get_engine(app=current_app, bind='anomaly_stats').execute(
-                AnomalyStat.__table__.insert(), anomaly_stat
-            )
-            db.get_engine(app=current_app, bind='anomaly_data').execute(
-                AnomalyData.__table__.insert(), anomaly_data
-            )
-        if len(func_stat):
-            db.get_engine(app=current_app, bind='func_stats').execute(
-                FuncStat.__table__.insert(), func_stat
-            )
+        # rows are committed in one transaction per bind; in write-behind
+        # mode they are acknowledged once queued and committed with the
+        # rows of the following requests (see server/ingest.py)
+        with tracer.span('anomalydata.put.anomaly_stats'):
+            ingest_queue.put('anomaly_stats', anomaly_stat)
+        with tracer.span('anomalydata.put.anomaly_data'):
+            ingest_queue.put('anomaly_data', anomaly_data)
+        with tracer.span('anomalydata.put.func_stats'):
+            ingest_queue.put('func_stats', func_stat)
+
+        # old snapshots are deleted in the background by the retention
+        # service (see server/retention.py), not on the request path
+    except Exception as e:
+        print('Exception on anomalydata ingest: ', e)
+        abort(500)
 
-        # although we have defined models to enable cascased delete operation,
-        # it actually didn't work. The reason is that we do the bulk insertion
-        # to get performance and, for now, I couldn't figure out how to define
-        # backreference in the above bulk insertion. So that, we do delete
-        # Stat rows manually (but using bulk deletion)
+    try:
+        with tracer.span('anomalydata.stat_query'):
+            q = stat_query.get()
 
-        # currently this is error prone!!!
+        if len(anomaly_stat):
+            with tracer.span('anomalydata.push_stats'):
+                push_anomaly_stat(q, anomaly_stat)
+
+        if len(anomaly_data):
+            with tracer.span('anomalydata.push_history'):
+                push_anomaly_data(q, anomaly_data)
 
-        #delete_old_anomaly()
-        #delete_old_func()
     except Exception as e:
         print(e)
 
+    tracer.since('anomalydata.end_to_end', ts)
+
+    # todo: make information output with Location
+    return jsonify({}), 201
+
+
+def new_anomalydata_columns():
+    """
+    Register anomaly data sent as a columnar msgpack body
+    (Content-Type: application/x-msgpack)
+
+    - structure
+    {
+        "created_at": (integer),
+        "anomaly": {                 // AnomalyStat, one entry per rank
+            "app": [(integer)],
+            "rank": [(integer)],
+            "count": [(integer)],
+            "accumulate": [(float)],
+            ...                      // minimum, maximum, mean, stddev,
+                                     // skewness, kurtosis
+        },
+        "data": {                    // AnomalyData, one entry per step
+            "app": [(integer)],
+            "rank": [(integer)],
+            "step": [(integer)],
+            "min_timestamp": [(integer)],
+            "max_timestamp": [(integer)],
+            "n_anomalies": [(integer)]
+        },
+        "func": {                    // FuncStat, one entry per function
+            "fid": [(integer)],
+            "name": [(string)],
+            "a_count": [(integer)],  // a_: anomaly, i_: inclusive,
+            ...                      // e_: exclusive statistics
+        }
+    }
+
+    All arrays of an object must have the same length, and a non-empty
+    object must hold its key arrays: app and rank (anomaly), rank and step
+    (data), fid (func); 400 otherwise.
+    Rows are only built for the database and for the ranks that are
+    pushed.
+    """
+    if msgpack is None:
+        abort(415)
+
     try:
-        # get query condition from database
-        q = AnomalyStatQuery.query. \
-            order_by(AnomalyStatQuery.created_at.desc()).first()
-
-        if q is None:
-            q = AnomalyStatQuery.create({
-                'nQueries': 5,
-                'statKind': 'stddev',
-                'ranks': []
-            })
-            db.session.add(q)
-            db.session.commit()
+        data = msgpack.unpackb(request.get_data(), raw=False) or {}
+    except Exception as e:
+        print('Exception on msgpack decoding: ', e)
+        abort(400)
+    if not isinstance(data, dict):
+        abort(400)
 
-        if len(anomaly_stat):
-            push_anomaly_stat(q, anomaly_stat)
+    ts = data.get('created_at', None)
+    if ts is None:
+        abort(400)
+    if not valid_columns(data.get('anomaly', {}), ('app', 'rank')) or \
+            not valid_columns(data.get('data', {}), ('rank', 'step')) or \
+            not valid_columns(data.get('func', {}), ('fid',)):
+        abort(400)
 
-        if len(anomaly_data):
-            push_anomaly_data(q, anomaly_data)
+    with tracer.span('anomalydata.process'):
+        stat_columns, data_columns = process_on_anomaly_columns(
+            data.get('anomaly', {}), data.get('data', {}), ts)
+        func_columns = process_on_func_columns(data.get('func', {}), ts)
+
+    try:
+        with tracer.span('anomalydata.put.anomaly_stats'):
+            ingest_queue.put_columns('anomaly_stats', stat_columns)
+        with tracer.span('anomalydata.put.anomaly_data'):
+            ingest_queue.put_columns('anomaly_data', data_columns)
+        with tracer.span('anomalydata.put.func_stats'):
+            ingest_queue.put_columns('func_stats', func_columns)
+    except Exception as e:
+        print('Exception on anomalydata ingest: ', e)
+        abort(500)
+
+    try:
+        with tracer.span('anomalydata.stat_query'):
+            q = stat_query.get()
+
+        n = len(stat_columns.get('rank', []))
+        if n:
+            with tracer.span('anomalydata.push_stats'):
+                push_anomaly_stat(q, None, stat_columns)
+
+        ranks = q.ranks
+        if len(ranks):
+            data_ranks = data_columns.get('rank', [])
+            data_apps = data_columns.get('app') or [0] * len(data_ranks)
+            selected = [
+                i for i, member in enumerate(zip(data_apps, data_ranks))
+                if member in ranks]
+            if len(selected):
+                with tracer.span('anomalydata.push_history'):
+                    push_anomaly_data(q, column_rows(data_columns, selected))
 
     except Exception as e:
         print(e)
 
-    # todo: make information output with Location
+    tracer.since('anomalydata.end_to_end', ts)
+
     return jsonify({}), 201
 
 
@@ -297,33 +426,10 @@ def get_anomalystats():
                  application index is 0 and rank index is 0.
     - return 400 error if there are no available statistics
     """
-    # get query condition from database
-    query = AnomalyStatQuery.query. \
-        order_by(AnomalyStatQuery.created_at.desc()).first()
-
-    if query is None:
-        query = AnomalyStatQuery.create({
-            'nQueries': 5,
-            'statKind': 'stddev',
-            'ranks': []
-        })
-        db.session.add(query)
-        db.session.commit()
+    # get query condition
+    query = stat_query.get()
 
-    subq = db.session.query(
-        AnomalyStat.app,
-        AnomalyStat.rank,
-        func.max(AnomalyStat.created_at).label('max_ts')
-    ).group_by(AnomalyStat.app, AnomalyStat.rank).subquery('t2')
-
-    stats = db.session.query(AnomalyStat).join(
-        subq,
-        and_(
-            AnomalyStat.app == subq.c.app,
-            AnomalyStat.rank == subq.c.rank,
-            AnomalyStat.created_at == subq.c.max_ts
-        )
-    ).all()
+    stats = AnomalyStatLatest.query.all()
 
     push_anomaly_stat(query, [st.to_dict() for st in stats])
     return jsonify({}), 200
@@ -354,17 +460,7 @@ def run_simulation():
             )
             data = [d.to_dict() for d in data.all()]
 
-            q = AnomalyStatQuery.query. \
-                order_by(AnomalyStatQuery.created_at.desc()).first()
-
-            if q is None:
-                q = AnomalyStatQuery.create({
-                    'nQueries': 5,
-                    'statKind': 'stddev',
-                    'ranks': []
-                })
-                db.session.add(q)
-                db.session.commit()
+            q = stat_query.get()
 
             # print("ts: {}, data: {}", ts, len(data))
             if len(data):
@@ -404,26 +500,46 @@ def get_anomalydata():
     return jsonify([dd.to_dict() for dd in data])
 
 
+@api.route('/get_anomalyhistory', methods=['GET'])
+def get_anomalyhistory():
+    """
+    Return the anomaly history of a rank with at least `points` entries,
+    using the coarsest available resolution (steps per entry)
+    - required:
+        app: application index
+        rank: rank index
+    - options
+        points: number of points to display, default 500
+        min_step: first step, default the first stored step
+        max_step: last step, default the last stored step
+    """
+    app = request.args.get('app', None)
+    rank = request.args.get('rank', None)
+    if app is None or rank is None:
+        abort(400)
+
+    points = int(request.args.get('points', 500))
+    min_step = request.args.get('min_step', None)
+    max_step = request.args.get('max_step', None)
+
+    resolution, data = query_history(
+        int(app), int(rank), points,
+        None if min_step is None else int(min_step),
+        None if max_step is None else int(max_step),
+        current_app.config.get('ROLLUP_RESOLUTIONS', ())
+    )
+    return jsonify({'resolution': resolution, 'data': data})
+
+
 @api.route('/get_funcstats', methods=['GET'])
 def get_funcstats():
     fid = request.args.get('fid', default=None)
 
-    subq = db.session.query(
-        FuncStat.fid,
-        func.max(FuncStat.created_at).label('max_ts')
-    ).group_by(FuncStat.fid).subquery('t2')
-
-    q = db.session.query(FuncStat).join(
-        subq,
-        and_(
-            FuncStat.fid == subq.c.fid,
-            FuncStat.created_at == subq.c.max_ts
-        )
-    )
+    q = FuncStatLatest.query
 
     if fid is None:
         stats = q.all()
     else:
-        stats = q.filter(FuncStat.fid == int(fid)).all()
+        stats = q.filter(FuncStatLatest.fid == int(fid)).all()
 
     return jsonify([st.to_dict() for st in stats])
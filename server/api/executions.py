@@ -2,12 +2,20 @@ from flask import request, abort, jsonify, json, current_app
 import os
 from .. import db
 from ..tasks import make_async
+from ..admission import admission_control
+from ..utils import stream_json, stream_ndjson, wants_ndjson
+from ..pagination import keyset_page, InvalidCursor
+from ..commmatrix import update_matrix
 from ..models import ExecData, CommData
+from ..execstore import execution_store
+from ..execcache import step_cache
+from ..compression import EXTENSIONS, resolve_codec, open_write
 
 from . import api
 
 
 @api.route('/executions', methods=['POST'])
+@admission_control('executions')
 @make_async
 def new_executions():
     """
@@ -62,20 +70,37 @@ def new_executions():
         path = current_app.config.get('EXECUTION_PATH', None)
 
         if all(v is not None for v in [app, rank, step, path]):
-            path = os.path.join(
-                path,
-                '{}'.format(app),
-                '{}'.format(rank)
-            )
-            if not os.path.exists(path):
-                os.makedirs(path)
-
-            with open(os.path.join(path, '{}.json'.format(step)), 'w') as f:
-                json.dump(data, f)
+            if execution_store.enabled:
+                execution_store.write_step(app, rank, step,
+                                           data.get('exec', []),
+                                           data.get('comm', []))
+            else:
+                path = os.path.join(
+                    path,
+                    '{}'.format(app),
+                    '{}'.format(rank)
+                )
+                if not os.path.exists(path):
+                    os.makedirs(path)
+
+                codec = resolve_codec(
+                    current_app.config.get('EXECUTION_COMPRESSION'))
+                filename = os.path.join(path, '{}.json{}'.format(
+                    step, EXTENSIONS[codec]))
+                with open_write(filename, codec, current_app.config.get(
+                        'EXECUTION_COMPRESSION_LEVEL')) as f:
+                    json.dump(data, f)
+
+            step_cache.invalidate(app, rank, step)
 
             # with open(os.path.join(path, 'comm-{}.json'.format(step)), 'w') as f:
             #     json.dump(commdata, f)
 
+        # rank-to-rank traffic of the step
+        if all(v is not None for v in [app, rank, step]):
+            update_matrix(app, rank, step, data.get('comm', []),
+                          current_app.config.get('COMM_MATRIX_WINDOW', 0))
+
 
         # if len(execdata):
         #     db.engine.execute(ExecData.__table__.insert(), execdata)
@@ -102,11 +127,22 @@ def get_executions():
         with_comm: 1 or (0)
         pid: program index, default None
         rid: rank index, default None
+        format: (json) | ndjson, or Accept: application/x-ndjson
+        limit: page size, default None (all)
+        cursor: X-Next-Cursor header of the previous page
+
+    The response is streamed as chunked JSON (or NDJSON). Pages are ordered
+    by (entry, id); the X-Next-Cursor header is set if there are more.
     """
     min_ts = request.args.get('min_ts', None)
     if min_ts is None:
         abort(400)
 
+    limit = request.args.get('limit', None, type=int)
+    cursor = request.args.get('cursor', None)
+    if limit is not None and limit <= 0:
+        abort(400)
+
     # parse options
     max_ts = request.args.get('max_ts', None)
     order = request.args.get('order', 'asc')
@@ -124,9 +160,21 @@ def get_executions():
     if rid is not None:
         execdata = execdata.filter(ExecData.rid == rid)
 
-    if order == 'asc':
-        execdata = execdata.order_by(ExecData.entry.asc())
-    else:
-        execdata = execdata.order_by(ExecData.entry.desc())
+    try:
+        execdata, next_cursor = keyset_page(
+            execdata, ExecData, order, cursor, limit)
+    except InvalidCursor:
+        abort(400)
 
-    return jsonify([d.to_dict(with_comm) for d in execdata.all()])
+    # without a limit, rows are fetched and encoded in chunks while the
+    # response streams
+    if limit is None:
+        execdata = execdata.yield_per(1000)
+    rows = (d.to_dict(with_comm) for d in execdata)
+    if wants_ndjson():
+        rv = stream_ndjson(rows)
+    else:
+        rv = stream_json(rows)
+    if next_cursor is not None:
+        rv.headers['X-Next-Cursor'] = next_cursor
+    return rv
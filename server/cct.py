@@ -0,0 +1,188 @@
+"""
+Calling-context tree (CCT) aggregation of execution data
+
+Executions only carry the key of their parent. The CCT merges them by
+function-name path from the root, e.g. main/solve/MPI_Send, with per
+node call count, inclusive (runtime) and exclusive totals and the number
+of anomalous calls (label -1). The root node holds the totals of the
+step. Trees of several steps or ranks are merged node by node.
+
+Call stacks can be deep, so the tree is walked with explicit stacks
+rather than by recursion.
+"""
+import json
+
+# pieces of JSON text joined per chunk yielded by iter_json
+CHUNK_SIZE = 1000
+
+
+class CCTNode(object):
+    __slots__ = ('name', 'count', 'inclusive', 'exclusive', 'n_anomalies',
+                 'children')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.inclusive = 0
+        self.exclusive = 0
+        self.n_anomalies = 0
+        self.children = {}
+
+    def child(self, name):
+        node = self.children.get(name)
+        if node is None:
+            node = CCTNode(name)
+            self.children[name] = node
+        return node
+
+    def add(self, d: dict):
+        self.count += 1
+        self.inclusive += d.get('runtime') or 0
+        self.exclusive += d.get('exclusive') or 0
+        if d.get('label') == -1:
+            self.n_anomalies += 1
+
+    def merge(self, other):
+        """Add the totals of another tree to this one"""
+        stack = [(self, other)]
+        while stack:
+            node, other = stack.pop()
+            node.count += other.count
+            node.inclusive += other.inclusive
+            node.exclusive += other.exclusive
+            node.n_anomalies += other.n_anomalies
+            for name, c in other.children.items():
+                stack.append((node.child(name), c))
+        return self
+
+    def size(self):
+        n = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            n += 1
+            stack.extend(node.children.values())
+        return n
+
+    def fields(self, path=()):
+        """The totals of this node, without its children"""
+        return {
+            'name': self.name,
+            'path': '/'.join(path),
+            'count': self.count,
+            'inclusive': self.inclusive,
+            'exclusive': self.exclusive,
+            'n_anomalies': self.n_anomalies,
+            'n_children': len(self.children)
+        }
+
+    def sorted_children(self):
+        return sorted(self.children.values(), key=lambda c: -c.inclusive)
+
+    def to_dict(self, max_depth=None, path=()):
+        stack = [(self, max_depth, path, None)]
+        root = None
+        while stack:
+            node, depth, path, parent = stack.pop()
+            if node.name is not None:
+                path = path + (node.name,)
+            d = node.fields(path)
+            if parent is None:
+                root = d
+            else:
+                parent.append(d)
+            if depth is None or depth > 0:
+                d['children'] = []
+                depth = None if depth is None else depth - 1
+                stack.extend((c, depth, path, d['children'])
+                             for c in reversed(node.sorted_children()))
+        return root
+
+    def iter_json(self, max_depth=None):
+        """
+        Yield the tree as JSON text, a chunk of nodes at a time (the json
+        module recurses over nested values, deep trees would overflow it)
+        """
+        stack = [(self, max_depth, ())]
+        chunk = []
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                chunk.append(item)
+                continue
+            node, depth, path = item
+            if node.name is not None:
+                path = path + (node.name,)
+            text = json.dumps(node.fields(path))
+            if depth is None or depth > 0:
+                depth = None if depth is None else depth - 1
+                chunk.append(text[:-1] + ', "children": [')
+                stack.append(']}')
+                children = node.sorted_children()
+                for i in range(len(children) - 1, -1, -1):
+                    stack.append((children[i], depth, path))
+                    if i > 0:
+                        stack.append(', ')
+            else:
+                chunk.append(text)
+            if len(chunk) >= CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+        if len(chunk):
+            yield ''.join(chunk)
+
+def function_name(d: dict):
+    name = d.get('name')
+    return name if name is not None else 'fid:{}'.format(d.get('fid'))
+
+
+def build_cct(execdata: list):
+    """
+    Build the CCT of the executions of one step. Calls whose parent isn't
+    in the step (e.g. it started in a previous step) hang from the root.
+    """
+    root = CCTNode(None)
+    by_key = {d['key']: d for d in execdata if d.get('key') is not None}
+    node_of = {}
+
+    def resolve(d):
+        # walk up to the first resolved ancestor, then assign the nodes
+        # down the chain
+        chain = []
+        while True:
+            key = d.get('key')
+            if key in node_of:
+                node = node_of[key]
+                break
+            chain.append(d)
+            parent = by_key.get(d.get('parent'))
+            if parent is None or parent is d or len(chain) > len(by_key):
+                node = root
+                break
+            d = parent
+        for d in reversed(chain):
+            node = node.child(function_name(d))
+            if d.get('key') is not None:
+                node_of[d['key']] = node
+        return node
+
+    for d in execdata:
+        key = d.get('key')
+        node = node_of.get(key) if key is not None else None
+        if node is None:
+            node = resolve(d)
+        node.add(d)
+        # the root holds the totals of all calls
+        root.add(d)
+
+    # ... but its inclusive time is the one of the top-level calls
+    root.inclusive = sum(c.inclusive for c in root.children.values())
+    return root
+
+
+def merge_cct(trees):
+    """Merge the CCTs of several steps/ranks into a new tree"""
+    root = CCTNode(None)
+    for tree in trees:
+        root.merge(tree)
+    return root
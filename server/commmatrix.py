@@ -0,0 +1,98 @@
+"""
+Rank-to-rank communication matrix
+
+The comm records of each step posted to /api/executions are aggregated
+into messages and bytes per (src, tar), per time window of
+COMM_MATRIX_WINDOW usec (0: one window per step), and stored in the
+CommMatrix table. A rewritten step replaces its rows. Queries sum the
+rows of some steps or of a time range, optionally per window, and return
+the heaviest pairs first.
+"""
+from sqlalchemy import and_, func
+
+from . import db
+from .models import CommMatrix
+
+
+def aggregate(commdata: list, width=0):
+    """Sum comm records per (type, window, src, tar)"""
+    cells = {}
+    for d in commdata:
+        ts = d.get('timestamp') or 0
+        window = int(ts // width) if width else 0
+        key = (d.get('type') or '', window, d.get('src'), d.get('tar'))
+        size = d.get('bytes', d.get('size')) or 0
+        c = cells.get(key)
+        if c is None:
+            cells[key] = [1, size, ts, ts]
+            continue
+        c[0] += 1
+        c[1] += size
+        c[2] = min(c[2], ts)
+        c[3] = max(c[3], ts)
+    return cells
+
+
+def update_matrix(app, rank, step, commdata: list, width=0, flask_app=None):
+    """Replace the matrix rows of a step reported by a rank"""
+    table = CommMatrix.__table__
+    rows = [{
+        'app': app, 'rank': rank, 'step': step, 'type': type,
+        'window': window, 'src': src, 'tar': tar,
+        'n_messages': n, 'bytes': size,
+        'min_timestamp': t0, 'max_timestamp': t1
+    } for (type, window, src, tar), (n, size, t0, t1)
+        in aggregate(commdata, width).items()]
+
+    engine = db.get_engine(app=flask_app)
+    with engine.begin() as conn:
+        conn.execute(table.delete().where(and_(
+            table.c.app == app, table.c.rank == rank, table.c.step == step)))
+        if len(rows):
+            conn.execute(table.insert(), rows)
+    return len(rows)
+
+
+def query_matrix(app, steps=None, min_ts=None, max_ts=None, type='SEND',
+                 ranks=None, by_window=False, top=None):
+    """
+    Return the (src, tar) pairs with their messages and bytes, heaviest
+    first, summed over the given steps and/or the windows overlapping
+    [min_ts, max_ts] (and per window if by_window)
+    """
+    keys = [CommMatrix.src, CommMatrix.tar]
+    if by_window:
+        keys.append(CommMatrix.window)
+    n_bytes = func.sum(CommMatrix.bytes).label('bytes')
+    query = db.session.query(
+        *keys,
+        func.sum(CommMatrix.n_messages).label('n_messages'),
+        n_bytes,
+        func.min(CommMatrix.min_timestamp).label('min_timestamp'),
+        func.max(CommMatrix.max_timestamp).label('max_timestamp')
+    ).filter(CommMatrix.app == app)
+
+    if type is not None:
+        query = query.filter(CommMatrix.type == type)
+    if steps is not None:
+        query = query.filter(CommMatrix.step.in_(steps))
+    if ranks is not None:
+        query = query.filter(CommMatrix.rank.in_(ranks))
+    if min_ts is not None:
+        query = query.filter(CommMatrix.max_timestamp >= min_ts)
+    if max_ts is not None:
+        query = query.filter(CommMatrix.min_timestamp <= max_ts)
+
+    query = query.group_by(*keys).order_by(n_bytes.desc(), *keys)
+    if top is not None:
+        query = query.limit(top)
+
+    return [{
+        'src': r.src,
+        'tar': r.tar,
+        'window': r.window if by_window else None,
+        'n_messages': r.n_messages,
+        'bytes': r.bytes,
+        'min_timestamp': r.min_timestamp,
+        'max_timestamp': r.max_timestamp
+    } for r in query]
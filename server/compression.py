@@ -0,0 +1,90 @@
+"""
+Compression of stored execution data
+
+EXECUTION_COMPRESSION selects the codec used by new_executions: None,
+'gzip' (standard library) or 'zstd' (needs the zstandard package, falls
+back to gzip without it). Data is always read with the codec it was
+written with.
+"""
+import gzip
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+# codec name -> id stored in the segment index
+CODECS = {None: 0, 'gzip': 1, 'zstd': 2}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+
+# codec name -> file extension of json steps
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+
+_warned = False
+
+
+def resolve_codec(name):
+    """Return a usable codec name for the configured one"""
+    global _warned
+    if name in ('', 'none', 'None'):
+        name = None
+    if name not in CODECS:
+        raise ValueError('unknown compression: {}'.format(name))
+    if name == 'zstd' and zstandard is None:
+        if not _warned:
+            print('zstandard is not installed, using gzip compression')
+            _warned = True
+        return 'gzip'
+    return name
+
+
+def _level(codec, level):
+    return DEFAULT_LEVELS.get(codec) if level is None else int(level)
+
+
+def compress(data: bytes, codec, level=None):
+    if codec is None:
+        return data
+    if codec == 'gzip':
+        return zlib.compress(data, _level(codec, level))
+    return zstandard.ZstdCompressor(level=_level(codec, level)).compress(data)
+
+
+def decompress(data: bytes, codec):
+    if codec is None:
+        return data
+    if codec == 'gzip':
+        return zlib.decompress(data)
+    if zstandard is None:
+        raise RuntimeError('zstandard is required to read zstd data')
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def open_write(path, codec, level=None):
+    """Open a file for writing text through a streaming compressor"""
+    if codec is None:
+        return open(path, 'w')
+    if codec == 'gzip':
+        return gzip.open(path, 'wt', compresslevel=_level(codec, level))
+    f = open(path, 'wb')
+    writer = zstandard.ZstdCompressor(
+        level=_level(codec, level)).stream_writer(f)
+    return io.TextIOWrapper(writer, encoding='utf-8')
+
+
+def open_read(path, codec):
+    """Open a file for reading text through a streaming decompressor"""
+    if codec is None:
+        return open(path)
+    if codec == 'gzip':
+        return gzip.open(path, 'rt')
+    if zstandard is None:
+        raise RuntimeError('zstandard is required to read zstd data')
+    f = open(path, 'rb')
+    reader = zstandard.ZstdDecompressor().stream_reader(f)
+    return io.TextIOWrapper(reader, encoding='utf-8')
@@ -0,0 +1,261 @@
+"""
+Coalescing and rate limiting of Socket.IO pushes
+
+Every ingest POST used to emit its own update_stats/update_history, so
+with many ranks posting the browser gets more small messages than it can
+render. Pushes of the events in COALESCED_EVENTS go through a scheduler
+that emits at most PUSH_MAX_RATE messages per second per (event, room):
+the first push of a quiet period is emitted right away, the following
+ones are held and coalesced until the next flush. Pending history rows
+are merged (the latest row of a step wins) and pending stats are replaced
+by the latest ones. Other events, and all events if PUSH_MAX_RATE is 0,
+are emitted immediately.
+
+The web servers and workers all emit through the message queue, so with
+PUSH_REDIS_URL the rate is enforced across processes: an emit first takes
+a Redis key of its (event, room) that expires after the interval, and a
+process that doesn't get it holds the push as pending. Without Redis the
+limit applies per emitting process.
+
+With PUSH_MSGPACK, sessions may ask for binary payloads when connecting
+(?encoding=msgpack). The events in BINARY_EVENTS are then emitted as JSON
+to the json rooms and, if a msgpack session listens to the room (see
+Subscriptions.listened), as column-oriented msgpack to the msgpack room
+(see subscriptions.encoding_room). In the binary payloads, every
+list of records becomes {COLUMNS_KEY: n, field: [values], ...}, so the
+field names are sent once per list instead of once per record.
+"""
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+from . import socketio
+from .subscriptions import ENCODINGS, encoding_room, subscriptions
+from .tracing import tracer
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+def merge_rows(pending: list, rows: list):
+    """Merge history rows, one per (app, rank, step), by min_timestamp"""
+    merged = OrderedDict()
+    for d in pending + rows:
+        merged[(d.get('app'), d.get('rank'), d.get('step'))] = d
+    return sorted(merged.values(), key=lambda d: d['min_timestamp'])
+
+
+# event -> merge function of two pending payloads (None: keep the latest)
+COALESCED_EVENTS = {
+    'update_stats': None,
+    'update_history': merge_rows
+}
+
+
+# events sent as msgpack to the sessions asking for it
+BINARY_EVENTS = ('update_stats', 'update_history', 'updated_data')
+
+# marks a list of records turned into columns, holding its length
+COLUMNS_KEY = '__columns__'
+
+
+def to_columns(data):
+    """Recursively turn the lists of records (dicts) into field arrays"""
+    if isinstance(data, dict):
+        return {k: to_columns(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        if len(data) and all(isinstance(d, dict) for d in data):
+            fields = OrderedDict()
+            for d in data:
+                for k in d:
+                    fields[k] = None
+            columns = {k: to_columns([d.get(k) for d in data])
+                       for k in fields}
+            columns[COLUMNS_KEY] = len(data)
+            return columns
+        return [to_columns(v) for v in data]
+    return data
+
+
+def pack_columns(data):
+    """Encode a payload as column-oriented msgpack"""
+    return msgpack.packb(to_columns(data), use_bin_type=True)
+
+
+class PushScheduler(object):
+    """Hold and coalesce pushes so that each room gets a bounded rate"""
+
+    def __init__(self, app=None, emit=None):
+        self.max_rate = 0
+        self.binary = False
+        self._emit = emit
+
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # (namespace, event, room) -> data
+        self._last = {}                # (namespace, event, room) -> time
+        self._thread = None
+        self._registered = False
+        self._redis = None
+        self._key = 'chimbuko:push:{}:{}:{}'
+
+        self._stats = {
+            'n_pushed': 0,
+            'n_emitted': 0,
+            'n_merged': 0,
+            'n_dropped': 0,
+            'n_errors': 0,
+            'n_deferred': 0,
+            'msgpack_bytes': 0
+        }
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_rate = float(app.config.get('PUSH_MAX_RATE', 0) or 0)
+        self.binary = bool(app.config.get('PUSH_MSGPACK', False)) and \
+            msgpack is not None
+        url = app.config.get('PUSH_REDIS_URL', None)
+        if url is not None:
+            import redis
+            self._redis = redis.StrictRedis.from_url(url)
+        else:
+            self._redis = None
+        if not self._registered:
+            atexit.register(self.flush)
+            self._registered = True
+
+    @property
+    def interval(self):
+        """Minimum time between two emits of the same (event, room)"""
+        return 1. / self.max_rate if self.max_rate > 0 else 0.
+
+    def _acquire(self, key):
+        """Take the emit slot of (namespace, event, room) for an interval"""
+        if self._redis is None:
+            return True
+        try:
+            return bool(self._redis.set(
+                self._key.format(*key), 1, nx=True,
+                px=max(int(self.interval * 1000), 1)))
+        except Exception as e:
+            print('Exception on push rate: ', e)
+            return True
+
+    def _defer(self, key, data):
+        """Hold data of which another process emitted the last update"""
+        with self._lock:
+            self._stats['n_deferred'] += 1
+            if key in self._pending:
+                # older than what was pushed meanwhile
+                merge = COALESCED_EVENTS[key[1]]
+                if merge is not None:
+                    self._pending[key] = merge(data, self._pending[key])
+            else:
+                self._pending[key] = data
+            self._ensure_thread()
+
+    def push(self, event, data, namespace='/events', room=None):
+        key = (namespace, event, room)
+        with self._lock:
+            self._stats['n_pushed'] += 1
+            limited = self.max_rate > 0 and event in COALESCED_EVENTS
+            if limited:
+                now = time.time()
+                if key in self._pending:
+                    merge = COALESCED_EVENTS[event]
+                    if merge is None:
+                        self._pending[key] = data
+                        self._stats['n_dropped'] += 1
+                    else:
+                        self._pending[key] = merge(self._pending[key], data)
+                        self._stats['n_merged'] += 1
+                    return
+                if now - self._last.get(key, 0) < self.interval:
+                    self._pending[key] = data
+                    self._ensure_thread()
+                    return
+                self._last[key] = now
+        if limited and not self._acquire(key):
+            self._defer(key, data)
+            return
+        self._send(key, data)
+
+    def flush(self, due_only=False):
+        """
+        Emit the pending pushes (only those whose interval has passed and
+        whose slot is free, if due_only)
+        """
+        now = time.time()
+        with self._lock:
+            keys = [
+                key for key in self._pending
+                if not due_only or
+                now - self._last.get(key, 0) >= self.interval
+            ]
+            ready = [(key, self._pending.pop(key)) for key in keys]
+            for key in keys:
+                self._last[key] = now
+        for key, data in ready:
+            if due_only and not self._acquire(key):
+                self._defer(key, data)
+                continue
+            self._send(key, data)
+
+    def encodings(self):
+        """Payload encodings the sessions may ask for"""
+        return ENCODINGS if self.binary else ENCODINGS[:1]
+
+    def _send(self, key, data):
+        namespace, event, room = key
+        targets = [(room, data)]
+        if self.binary and event in BINARY_EVENTS:
+            targets = [(encoding_room(room, 'json'), data)]
+            if subscriptions.listened(room, 'msgpack'):
+                targets.append((encoding_room(room, 'msgpack'), None))
+        emit = self._emit or socketio.emit
+        for room, payload in targets:
+            try:
+                if payload is None:
+                    payload = pack_columns(data)
+                    with self._lock:
+                        self._stats['msgpack_bytes'] += len(payload)
+                with tracer.span('push.emit.{}'.format(event)):
+                    emit(event, payload, namespace=namespace, room=room)
+            except Exception as e:
+                print('Exception on push ({}): '.format(event), e)
+                with self._lock:
+                    self._stats['n_errors'] += 1
+                continue
+            with self._lock:
+                self._stats['n_emitted'] += 1
+
+    def _ensure_thread(self):
+        # called with the lock held
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name='push-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(max(self.interval / 2., 0.01))
+            self.flush(due_only=True)
+
+    def stats(self):
+        """Return counters of pushes emitted, merged and dropped"""
+        with self._lock:
+            d = dict(self._stats)
+            d.update({
+                'n_pending': len(self._pending),
+                'max_rate': self.max_rate,
+                'encodings': list(self.encodings())
+            })
+        return d
+
+
+push_scheduler = PushScheduler()
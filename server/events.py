@@ -1,10 +1,26 @@
+import heapq
+import itertools
 import os
 from flask import g, session, Blueprint, current_app, request, jsonify, abort, json
+from flask import Response, stream_with_context
+
+from flask_socketio import emit, join_room, leave_room
 
 from . import db, socketio, celery
-from .models import AnomalyStat, AnomalyData, AnomalyStatQuery, ExecData, CommData
+from .models import AnomalyData, AnomalyStatQuery, ExecData, CommData
+
+from .statquery import stat_query
+from .execstore import execution_store, ListView, subtree
+from .execcache import step_cache, CachedStep
+from .compression import EXTENSIONS, open_read
+from .utils import stream_json, stream_ndjson, wants_ndjson
+from .pagination import keyset_page, decode_cursor, InvalidCursor
+from .cct import merge_cct
+from .commmatrix import query_matrix
+from .subscriptions import subscriptions, rank_room, encoding_room
+from .emitter import push_scheduler
 
-from sqlalchemy import func, and_
+from sqlalchemy import and_, bindparam
 
 events = Blueprint('events', __name__)
 
@@ -17,9 +33,50 @@ def push_model(model, namespace='/events'):
     }, namespace=namespace)
 
 
-def push_data(data, event='updated_data',  namespace='/events'):
-    """Push the data to all connected Socket.IO clients."""
-    socketio.emit(event, data, namespace=namespace)
+def push_data(data, event='updated_data',  namespace='/events', room=None):
+    """
+    Push the data to all connected Socket.IO clients, or to a room.
+    Frequent events are coalesced and rate limited (see emitter.py).
+    """
+    push_scheduler.push(event, data, namespace=namespace, room=room)
+
+
+# number of ranks per IN (...) clause, below the sqlite variable limit
+HISTORY_CHUNK_SIZE = 500
+
+# the statement is compiled once and reused for every request
+_history_query = AnomalyData.__table__.select().where(
+    and_(
+        AnomalyData.app == bindparam('app'),
+        AnomalyData.rank.in_(bindparam('ranks', expanding=True)),
+        AnomalyData.step == bindparam('step')
+    )
+).order_by(AnomalyData.id)
+_history_cache = {}
+
+
+def load_history(app, ranks: list, step):
+    """
+    Return the AnomalyData rows of the given ranks at the given step,
+    keyed by rank, with one query per HISTORY_CHUNK_SIZE ranks
+    """
+    engine = db.get_engine(app=current_app, bind='anomaly_data')
+
+    rows = {}
+    ranks = list(set(ranks))
+    with engine.connect() as conn:
+        conn = conn.execution_options(compiled_cache=_history_cache)
+        for i in range(0, len(ranks), HISTORY_CHUNK_SIZE):
+            result = conn.execute(_history_query, {
+                'app': app,
+                'ranks': ranks[i:i + HISTORY_CHUNK_SIZE],
+                'step': step
+            })
+            keys = result.keys()
+            for r in result.fetchall():
+                d = dict(zip(keys, r))
+                rows[d['rank']] = d
+    return rows
 
 
 @events.route('/query_history', methods=['POST'])
@@ -27,7 +84,7 @@ def get_history():
     q = request.get_json() or {}
 
     app = 0
-    ranks = q.get('qRanks', [])
+    ranks = [int(rank) for rank in q.get('qRanks', [])]
     step = q.get('last_step', 0)
     if step is None:
         step = -1
@@ -41,35 +98,15 @@ def get_history():
     }
     step += 1
 
-    payload = []
-    for rank in ranks:
-        rank = int(rank)
-
-        stat = AnomalyStat.query.filter(
-            and_(
-                AnomalyStat.app == app,
-                AnomalyStat.rank == rank
-            )
-        ).order_by(
-            AnomalyStat.created_at.desc()
-        ).first()
-
-        if stat is None:
-            payload.append(empty_data)
-            continue
-
-        data = stat.hist.filter(AnomalyData.step==step).first()
-        if data is None:
-            payload.append(empty_data)
-            continue
-
-        payload.append(data.to_dict())
+    rows = load_history(app, ranks, step)
+    payload = [rows.get(rank, empty_data) for rank in ranks]
 
     return jsonify(payload)
 
 
 @celery.task
-def push_execution(pid, rid, min_ts, max_ts, order, with_comm):
+def push_execution(pid, rid, min_ts, max_ts, order, with_comm,
+                   cursor=None, limit=None):
     from .wsgi_aux import app
     with app.app_context():
         min_ts = int(min_ts)
@@ -86,16 +123,16 @@ def push_execution(pid, rid, min_ts, max_ts, order, with_comm):
             rid = int(rid)
             execdata = execdata.filter(ExecData.rid == rid)
 
-        if order == 'asc':
-            execdata = execdata.order_by(ExecData.entry.asc())
-        else:
-            execdata = execdata.order_by(ExecData.entry.desc())
+        execdata, next_cursor = keyset_page(
+            execdata, ExecData, order, cursor, limit)
 
-        execdata = [d.to_dict(int(with_comm)) for d in execdata.all()]
+        execdata = [d.to_dict(int(with_comm)) for d in execdata]
         if len(execdata):
             push_data({
                 'type': 'execution',
-                'data': execdata
+                'data': execdata,
+                'cursor': cursor,
+                'next_cursor': next_cursor
             })
 
 
@@ -111,6 +148,11 @@ def get_execution():
         with_comm: 1 or (0)
         pid: program index, default None
         rid: rank index, default None
+        limit: page size, default None (all)
+        cursor: next_cursor of the previously pushed page
+
+    The page is pushed as an 'execution' event with its next_cursor (None
+    on the last page).
     """
     min_ts = request.args.get('min_ts', None)
     if min_ts is None:
@@ -122,8 +164,18 @@ def get_execution():
     with_comm = request.args.get('with_comm', 0)
     pid = request.args.get('pid', None)
     rid = request.args.get('rid', None)
-
-    push_execution.delay(pid, rid, min_ts, max_ts, order, with_comm)
+    limit = request.args.get('limit', None, type=int)
+    cursor = request.args.get('cursor', None)
+    if limit is not None and limit <= 0:
+        abort(400)
+    if cursor is not None:
+        try:
+            decode_cursor(cursor)
+        except InvalidCursor:
+            abort(400)
+
+    push_execution.delay(pid, rid, min_ts, max_ts, order, with_comm,
+                         cursor, limit)
     return jsonify({}), 200
 
 
@@ -147,32 +199,100 @@ def load_execution_db(pid, rid, min_ts, max_ts, order, with_comm):
     else:
         execdata = execdata.order_by(ExecData.entry.desc())
 
-    execdata = [d.to_dict(int(with_comm)) for d in execdata.all()]
-    return execdata
+    # generator over chunks of rows, to be streamed
+    return (d.to_dict(int(with_comm)) for d in execdata.yield_per(1000))
 
 
-def load_execution_file(pid, rid, step, order, with_comm):
+def load_execution_step(pid, rid, step):
+    """
+    Return the CachedStep of a step (executions sorted by entry in both
+    orders, communications), or None if it isn't stored
+    """
     path = current_app.config['EXECUTION_PATH']
     if path is None:
-        return []
+        return None
+
+    # segmented store first, then a legacy one-file-per-step layout
+    entry = execution_store.entry(pid, rid, step)
+    if entry is not None:
+        version = entry
+    else:
+        # the newest of the uncompressed/compressed files of the step
+        files = []
+        for codec, ext in EXTENSIONS.items():
+            filename = os.path.join(
+                path,
+                '{}'.format(pid),
+                '{}'.format(rid),
+                '{}.json{}'.format(step, ext))
+            if os.path.isfile(filename):
+                st = os.stat(filename)
+                files.append((st.st_mtime_ns, filename, codec))
+
+        if len(files) == 0:
+            return None
+
+        mtime, path, codec = max(files)
+        version = (path, mtime)
+
+    cached = step_cache.get(pid, rid, step, version)
+    if cached is None:
+        if entry is not None:
+            execdata, commdata = execution_store.read_entry(pid, rid, entry)
+        else:
+            with open_read(path, codec) as f:
+                data = json.load(f)
+
+            if data is None or not isinstance(data, dict):
+                return None
+            execdata, commdata = data.get('exec', []), data.get('comm', [])
+
+        cached = CachedStep(execdata, commdata)
+        step_cache.put(pid, rid, step, version, cached)
+
+    return cached
+
+
+def load_execution_file(pid, rid, step, order, with_comm):
+    """
+    Return the executions of a step sorted by entry in the given order, and
+    its communications. The returned lists are shared by the step cache.
+    """
+    cached = load_execution_step(pid, rid, step)
+    if cached is None:
+        return [], []
+    return cached.execdata(order), cached.comm
 
-    path = os.path.join(
-        path,
-        '{}'.format(pid),
-        '{}'.format(rid),
-        '{}.json'.format(step))
 
-    if not os.path.exists(path) or not os.path.isfile(path):
-        return []
+def filter_time_range(execdata, commdata, min_ts=None, max_ts=None):
+    """Keep executions intersecting [min_ts, max_ts] and comms within it"""
+    lo = float('-inf') if min_ts is None else min_ts
+    hi = float('inf') if max_ts is None else max_ts
+    return [d for d in execdata
+            if d.get('entry', lo) <= hi and d.get('exit', hi) >= lo], \
+        [d for d in commdata if lo <= d.get('timestamp', lo) <= hi]
 
-    with open(path) as f:
-        data = json.load(f)
 
-    if data is None or not isinstance(data, dict):
-        return []
+def load_execution_range(pid, rid, min_ts, max_ts, order, with_comm):
+    """
+    Return iterators over the executions intersecting [min_ts, max_ts],
+    sorted by entry, and over the communications within it. Only the steps
+    whose interval overlaps the window are read.
+    """
+    if max_ts is None:
+        max_ts = float('inf')
 
-    return data.get('exec', []), data.get('comm', [])
+    execdata, commdata = [], []
+    for step in execution_store.overlapping(pid, rid, min_ts, max_ts):
+        e, c = load_execution_file(pid, rid, step, order, with_comm)
+        e, c = filter_time_range(e, c, min_ts, max_ts)
+        execdata.append(e)
+        commdata.append(c)
 
+    # steps are sorted already and may overlap: merge them lazily
+    return heapq.merge(*execdata, key=lambda d: d['entry'],
+                       reverse=order == 'desc'), \
+        itertools.chain.from_iterable(commdata)
 
 
 @celery.task
@@ -191,48 +311,167 @@ def get_execution_file():
     """
     Return a list of execution data within a given time range
     - required:
-        min_ts: minimum timestamp
+        pid: program index
+        rid: rank index
+        step and/or min_ts: a step, or the steps overlapping a time range
     - options
         max_ts: maximum timestamp
         order: [(asc) | desc]
         with_comm: 1 or (0)
-        pid: program index, default None
-        rid: rank index, default None
+        format: (json) | ndjson, or Accept: application/x-ndjson
+
+    With a time range, only the executions intersecting it (and the
+    communications within it) are returned. The response is streamed as
+    chunked JSON, or as NDJSON lines of {"exec": ...} and {"comm": ...}.
     """
     pid = request.args.get('pid', None)
     rid = request.args.get('rid', None)
     step = request.args.get('step', None)
-    min_ts = request.args.get('min_ts', None)
-    max_ts = request.args.get('max_ts', None)
+    min_ts = request.args.get('min_ts', None, type=float)
+    max_ts = request.args.get('max_ts', None, type=float)
     if all(v is None for v in [pid, rid, step]):
         abort(400)
 
-    print(pid, rid, step, min_ts, max_ts)
-
     # parse options
     order = request.args.get('order', 'asc')
     with_comm = request.args.get('with_comm', 0)
 
-    from_file = False
     commdata = None
     # 1. check if DB has?
     execdata = []
     # execdata = load_execution_db(pid, rid, min_ts, max_ts, order, with_comm)
 
     # 2. look for file?
-    if len(execdata) == 0:
+    if len(execdata) == 0 and step is None and min_ts is not None:
+        execdata, commdata = load_execution_range(
+            pid, rid, min_ts, max_ts, order, with_comm)
+    elif len(execdata) == 0:
         execdata, commdata = load_execution_file(pid, rid, step, order, with_comm)
-        from_file = True
+        if min_ts is not None or max_ts is not None:
+            execdata, commdata = filter_time_range(
+                execdata, commdata, min_ts, max_ts)
 
     # 3. update & post processing
-    if from_file:
-        # update_execution_db.delay(execdata, commdata)
+    # (file data comes sorted by entry from the step cache)
+    # update_execution_db.delay(execdata, commdata)
+
+    if wants_ndjson():
+        return stream_ndjson(itertools.chain(
+            ({'exec': d} for d in execdata),
+            ({'comm': d} for d in commdata or [])))
+    return stream_json({"exec": execdata, "comm": commdata})
+    #return jsonify(execdata), 200
 
-        sort_desc = order == 'desc'
-        execdata.sort(key=lambda d: d['entry'], reverse=sort_desc)
 
-    return jsonify({"exec": execdata, "comm": commdata})
-    #return jsonify(execdata), 200
+@events.route('/query_cct', methods=['GET', 'POST'])
+def get_cct():
+    """
+    Return the calling-context tree aggregated over the executions of one
+    or more steps
+    - GET: pid, rid and step (may be repeated)
+    - POST: {"units": [{"pid": , "rid": , "step": }, ...]}
+    - options
+        max_depth: depth of the returned tree, default None (all)
+
+    Each node has its function-name path, call count, inclusive/exclusive
+    totals, anomaly count and children sorted by inclusive time. Returns
+    404 if none of the steps has execution data.
+    """
+    if request.method == 'POST':
+        units = (request.get_json() or {}).get('units', [])
+        units = [(u.get('pid'), u.get('rid'), u.get('step')) for u in units]
+    else:
+        pid = request.args.get('pid', None)
+        rid = request.args.get('rid', None)
+        units = [(pid, rid, step) for step in request.args.getlist('step')]
+    if len(units) == 0 or any(v is None for u in units for v in u):
+        abort(400)
+    max_depth = request.args.get('max_depth', None, type=int)
+
+    trees = []
+    for pid, rid, step in units:
+        cached = load_execution_step(pid, rid, step)
+        if cached is not None:
+            trees.append(cached.cct())
+
+    if len(trees) == 0:
+        abort(404)
+    tree = trees[0] if len(trees) == 1 else merge_cct(trees)
+    return Response(stream_with_context(tree.iter_json(max_depth)),
+                    mimetype='application/json')
+
+
+@events.route('/query_subtree', methods=['GET'])
+def get_subtree():
+    """
+    Return the call subtree rooted at an execution
+    - required:
+        pid, rid, step: step of the execution
+        key: key of the execution
+    - options
+        max_depth: depth below the execution, default None (all)
+        max_nodes: maximum number of executions, default 1000
+
+    Each execution has its `depth` and `children` (ordered by entry);
+    `truncated` marks the ones whose children were cut by the limits.
+    """
+    pid = request.args.get('pid', None)
+    rid = request.args.get('rid', None)
+    step = request.args.get('step', None)
+    key = request.args.get('key', None)
+    if any(v is None for v in [pid, rid, step, key]):
+        abort(400)
+    max_depth = request.args.get('max_depth', None, type=int)
+    max_nodes = request.args.get('max_nodes', 1000, type=int)
+    if max_nodes <= 0:
+        abort(400)
+
+    # the persisted child index of the segmented store, else one built
+    # over the cached step
+    view = execution_store.open_step(pid, rid, step)
+    if view is None:
+        cached = load_execution_step(pid, rid, step)
+        if cached is None:
+            abort(404)
+        view = ListView(cached.asc, cached.child_index())
+
+    with view:
+        root = view.index.find(key, view.key)
+        if root is None:
+            abort(404)
+        tree, n_nodes = subtree(view, root, max_depth, max_nodes)
+
+    return jsonify({'n_nodes': n_nodes, 'tree': tree})
+
+
+@events.route('/query_comm_matrix', methods=['GET'])
+def get_comm_matrix():
+    """
+    Return the rank-to-rank communication matrix as (src, tar) pairs with
+    their messages and bytes, heaviest first
+    - required:
+        pid: program index
+        step (may be repeated) and/or min_ts, max_ts: time range
+    - options
+        type: (SEND) | RECV
+        rid: reporting rank (may be repeated), default all
+        by_window: 1 or (0), per time window of COMM_MATRIX_WINDOW
+        top: number of pairs, default None (all)
+    """
+    pid = request.args.get('pid', None, type=int)
+    steps = request.args.getlist('step', type=int) or None
+    min_ts = request.args.get('min_ts', None, type=float)
+    max_ts = request.args.get('max_ts', None, type=float)
+    if pid is None or (steps is None and min_ts is None and max_ts is None):
+        abort(400)
+
+    pairs = query_matrix(
+        pid, steps, min_ts, max_ts,
+        type=request.args.get('type', 'SEND'),
+        ranks=request.args.getlist('rid', type=int) or None,
+        by_window=request.args.get('by_window', 0, type=int) > 0,
+        top=request.args.get('top', None, type=int))
+    return jsonify(pairs)
 
 
 @socketio.on('query_stats', namespace='/events')
@@ -240,15 +479,32 @@ def query_stats(q):
     nQueries = q.get('nQueries', 5)
     statKind = q.get('statKind', 'stddev')
     ranks = q.get('ranks', [])
+    app = q.get('app', 0)
 
+    # the session moves to the rooms of the ranks it watches
+    joined, left = subscriptions.set(
+        request.sid, [(app, rank) for rank in ranks])
+    encoding = subscriptions.encoding(request.sid)
+    for member in left:
+        leave_room(encoding_room(rank_room(*member), encoding))
+    for member in joined:
+        join_room(encoding_room(rank_room(*member), encoding))
+
+    save_stat_query(nQueries, statKind)
+
+
+def save_stat_query(nQueries, statKind):
+    """Store the query condition with the (app, rank) watched by any session"""
     q = AnomalyStatQuery.create({
         'nQueries': nQueries,
         'statKind': statKind,
-        'ranks': ranks
+        'ranks': sorted(subscriptions.watched())
     })
     db.session.add(q)
     db.session.commit()
 
+    # every worker drops its cached query condition
+    stat_query.invalidate(q)
 
 
 # @events.route('/query_stats', methods=['POST'])
@@ -268,11 +524,26 @@ def query_stats(q):
 
 @socketio.on('connect', namespace='/events')
 def events_connect():
+    """
+    Negotiate the payload encoding of the session, given as
+    ?encoding=(json)|msgpack, and reply with the one in use
+    """
     print('socketio.on.connect')
+    encoding = request.args.get('encoding', 'json')
+    if encoding not in push_scheduler.encodings():
+        encoding = 'json'
+    subscriptions.set_encoding(request.sid, encoding)
+    join_room(encoding_room(None, encoding))
+    emit('encoding', {'encoding': encoding})
 
 
 @socketio.on('disconnect', namespace='/events')
 def events_disconnect():
     print('socketio.on.disconnect')
+    watched = subscriptions.watched()
+    subscriptions.remove(request.sid)
+    if subscriptions.watched() != watched:
+        q = stat_query.get()
+        save_stat_query(q.nQueries, q.statKind)
 
 
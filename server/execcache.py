@@ -0,0 +1,156 @@
+"""
+LRU cache of decoded execution steps
+
+Analysts click back and forth between the same few (pid, rid, step)
+frames, so decoded steps are kept with their executions already sorted by
+entry in both orders. Each entry carries the version of the stored step
+(segment index entry or file mtime): a step rewritten by another process
+misses, and new_executions drops the step right away in this process.
+The capacity is counted in estimated bytes of the decoded step: its
+records sampled with sys.getsizeof, the two sorted lists, and an
+allowance for the CCT and child index that may be built later.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+from .cct import build_cct
+from .execstore import ChildIndex, build_child_index
+
+
+# bytes of a list slot
+POINTER_SIZE = 8
+# bytes per execution of a child index (see execstore.build_child_index)
+CHILD_INDEX_SIZE = 16
+# bytes of a CCT node (object and children dict), at most one per execution
+CCT_NODE_SIZE = 320
+# records sampled to estimate the size of a list of records
+SIZE_SAMPLE = 32
+
+
+def records_size(records: list):
+    """Estimated memory held by a list of flat records (dicts)"""
+    n = len(records)
+    if n == 0:
+        return 0
+    sample = records[::max(n // SIZE_SAMPLE, 1)][:SIZE_SAMPLE]
+    total = sum(
+        sys.getsizeof(d) + sum(sys.getsizeof(v) for v in d.values())
+        for d in sample)
+    return int(total * n / len(sample)) + POINTER_SIZE * n
+
+
+class CachedStep(object):
+    """
+    Executions of a step sorted by entry, its communications and, once
+    asked for, its calling-context tree and child index
+    """
+    __slots__ = ('asc', 'desc', 'comm', '_cct', '_children')
+
+    def __init__(self, execdata: list, commdata: list):
+        self.asc = sorted(execdata, key=lambda d: d['entry'])
+        self.desc = sorted(execdata, key=lambda d: d['entry'], reverse=True)
+        self.comm = commdata
+        self._cct = None
+        self._children = None
+
+    def footprint(self):
+        """Estimated bytes held by the step, once its indexes are built"""
+        n = len(self.asc)
+        return records_size(self.asc) + POINTER_SIZE * n + \
+            records_size(self.comm) + n * (CHILD_INDEX_SIZE + CCT_NODE_SIZE)
+
+    def execdata(self, order='asc'):
+        return self.desc if order == 'desc' else self.asc
+
+    def cct(self):
+        if self._cct is None:
+            self._cct = build_cct(self.asc)
+        return self._cct
+
+    def child_index(self):
+        """Child index over the ordinals of `asc`"""
+        if self._children is None:
+            self._children = ChildIndex(build_child_index(self.asc))
+        return self._children
+
+
+class StepCache(object):
+    """Bounded, memory aware LRU of CachedStep keyed by (pid, rid, step)"""
+
+    def __init__(self, app=None):
+        self.capacity = 256 * 1024 * 1024
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._size = 0
+        self._stats = {'n_hits': 0, 'n_misses': 0, 'n_evictions': 0,
+                       'n_invalidations': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.capacity = app.config.get('EXECUTION_CACHE_SIZE', self.capacity)
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def _key(pid, rid, step):
+        return '{}'.format(pid), '{}'.format(rid), '{}'.format(step)
+
+    def get(self, pid, rid, step, version):
+        """Return the cached step if it is still at `version`, else None"""
+        key = self._key(pid, rid, step)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != version:
+                self._stats['n_misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self._stats['n_hits'] += 1
+            return item[1]
+
+    def put(self, pid, rid, step, version, value: CachedStep):
+        size = value.footprint()
+        if size > self.capacity:
+            return
+        key = self._key(pid, rid, step)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old[2]
+            self._items[key] = (version, value, size)
+            self._size += size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.capacity and len(self._items):
+            _, (_, _, size) = self._items.popitem(last=False)
+            self._size -= size
+            self._stats['n_evictions'] += 1
+
+    def invalidate(self, pid, rid, step):
+        key = self._key(pid, rid, step)
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None:
+                self._size -= item[2]
+                self._stats['n_invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._items = OrderedDict()
+            self._size = 0
+
+    def stats(self):
+        """Return hit/miss/eviction counters and the current size (bytes)"""
+        with self._lock:
+            d = dict(self._stats)
+            d.update({
+                'n_items': len(self._items),
+                'size': self._size,
+                'capacity': self.capacity
+            })
+        return d
+
+
+step_cache = StepCache()
@@ -0,0 +1,745 @@
+"""
+Segmented binary store of execution data
+
+Each (app, rank) directory under EXECUTION_PATH holds
+
+- exec-NNNNNN.seg: append-only data segments, one blob per step, made of
+  fixed-width records for the `exec` and `comm` entries followed by the
+  step's own table of the strings unique to a call (keys, parents)
+- strings.jsonl: side dictionary of the other string fields (function
+  names, comm types), one JSON string per line, referenced by line number
+- index.dat: fixed-width step -> (segment, offset, length) records; a
+  rewritten step is appended again and the last record wins
+- intervals.dat: step -> [min entry, max exit] of its executions, so that
+  a time-range query only reads the steps overlapping the window; the
+  last record of a step wins, NaN bounds removing its interval
+- tree.dat/tree.idx: child-adjacency index of each step (execution
+  ordinal -> children ordinals ordered by entry), so that a subtree is
+  read in time proportional to its size
+
+Reads mmap the segment and decode only the requested step. Payloads that
+don't fit the record layout (unknown fields, non-integer numbers) are
+stored as a JSON blob instead, so the store is lossless. Blobs are
+compressed with EXECUTION_COMPRESSION; the codec is kept in the index.
+"""
+import bisect
+import fcntl
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict, deque
+
+from flask import current_app
+
+from .compression import CODECS, CODEC_NAMES, resolve_codec, \
+    compress, decompress
+
+
+# blob formats, the upper 4 bits hold the compression codec id
+FORMAT_BINARY = 0  # every string in the dictionary (older steps)
+FORMAT_JSON = 1
+FORMAT_LOCAL = 2   # strings of the local fields in a table of the step
+FORMAT_MASK = 0x0f
+
+
+class RecordCodec(object):
+    """
+    Fixed-width record: presence bitmask, int64 per integer field and
+    int32 string id (-1: None) per string field. The ids of the local
+    fields refer to a table of the step instead of the dictionary.
+    """
+
+    def __init__(self, int_fields, str_fields, local_fields=()):
+        self.fields = tuple(int_fields) + tuple(str_fields)
+        self.n_int = len(int_fields)
+        self.local = frozenset(local_fields)
+        self.index = {f: i for i, f in enumerate(self.fields)}
+        self.struct = struct.Struct(
+            '<I' + 'q' * len(int_fields) + 'i' * len(str_fields))
+        self.size = self.struct.size
+
+    def encode(self, d: dict, string_id, local_id):
+        """Pack a dictionary, raise ValueError if it doesn't fit"""
+        values = [0] * len(self.fields)
+        mask = 0
+        for k, v in d.items():
+            i = self.index.get(k)
+            if i is None:
+                raise ValueError('unknown field: {}'.format(k))
+            if i < self.n_int:
+                if type(v) is not int:
+                    raise ValueError('not an integer: {}'.format(k))
+            elif v is None:
+                v = -1
+            elif isinstance(v, str):
+                v = local_id(v) if k in self.local else string_id(v)
+            else:
+                raise ValueError('not a string: {}'.format(k))
+            values[i] = v
+            mask |= 1 << i
+        return self.struct.pack(mask, *values)
+
+    def decode(self, buf, strings: list, local: list = None):
+        """
+        Unpack all records of a buffer, given the dictionary and the
+        table of the step (None: the local fields are in the dictionary)
+        """
+        fields = self.fields
+        n_int = self.n_int
+        tables = [local if local is not None and f in self.local
+                  else strings for f in fields[n_int:]]
+        str_fields = list(zip(fields[n_int:], tables))
+        full = (1 << len(fields)) - 1
+        records = []
+        for values in self.struct.iter_unpack(buf):
+            mask = values[0]
+            if mask == full:
+                # every field present: no per-field mask test
+                d = dict(zip(fields, values[1:]))
+                for f, table in str_fields:
+                    v = d[f]
+                    d[f] = table[v] if v >= 0 else None
+            else:
+                d = {}
+                for i, f in enumerate(fields):
+                    if mask & (1 << i):
+                        v = values[i + 1]
+                        if i >= n_int:
+                            v = tables[i - n_int][v] if v >= 0 else None
+                        d[f] = v
+            records.append(d)
+        return records
+
+
+EXEC_CODEC = RecordCodec(
+    ('pid', 'rid', 'tid', 'fid', 'entry', 'exit', 'runtime', 'exclusive',
+     'label', 'n_children', 'n_messages'),
+    ('key', 'name', 'parent'),
+    ('key', 'parent')
+)
+
+COMM_CODEC = RecordCodec(
+    ('pid', 'rid', 'tid', 'src', 'tar', 'bytes', 'size', 'tag',
+     'timestamp', 'fid'),
+    ('type', 'execdata_key', 'name'),
+    ('execdata_key',)
+)
+
+def local_table(buf):
+    """Decode the string table at the end of a FORMAT_LOCAL blob"""
+    return json.loads(buf.decode('utf-8')) if len(buf) else []
+
+
+# step, segment, offset, length, n_exec, n_comm, format
+INDEX_STRUCT = struct.Struct('<qiqqiiB')
+
+# step, min entry, max exit (NaN: the step has no interval anymore)
+INTERVAL_STRUCT = struct.Struct('<qdd')
+NO_INTERVAL = (float('nan'), float('nan'))
+
+
+class IntervalIndex(object):
+    """Step intervals, searchable for the ones overlapping a time window"""
+
+    def __init__(self):
+        self._intervals = {}
+        self._sorted = None
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def set(self, step, lo, hi):
+        self._intervals[step] = (lo, hi)
+        self._sorted = None
+
+    def remove(self, step):
+        if self._intervals.pop(step, None) is not None:
+            self._sorted = None
+
+    def get(self, step):
+        return self._intervals.get(step)
+
+    def _build(self):
+        # intervals sorted by start, with the running maximum of their end
+        # (non-decreasing, so it can be bisected as well)
+        items = sorted((lo, hi, step)
+                       for step, (lo, hi) in self._intervals.items())
+        los, max_his, running = [], [], float('-inf')
+        for lo, hi, _ in items:
+            running = max(running, hi)
+            los.append(lo)
+            max_his.append(running)
+        self._sorted = (items, los, max_his)
+
+    def overlapping(self, min_ts, max_ts):
+        """Return the steps whose interval intersects [min_ts, max_ts]"""
+        if self._sorted is None:
+            self._build()
+        items, los, max_his = self._sorted
+        start = bisect.bisect_left(max_his, min_ts)
+        end = bisect.bisect_right(los, max_ts)
+        return sorted(step for lo, hi, step in items[start:end]
+                      if hi >= min_ts)
+
+
+def time_interval(execdata: list):
+    """Return [min entry, max exit] of executions, or None"""
+    lo, hi = None, None
+    for d in execdata:
+        start, end = d.get('entry'), d.get('exit')
+        if isinstance(start, (int, float)):
+            lo = start if lo is None else min(lo, start)
+        if isinstance(end, (int, float)):
+            hi = end if hi is None else max(hi, end)
+    if lo is None or hi is None:
+        return None
+    return lo, hi
+
+
+# child-adjacency index of a step: header, then int32 arrays of the roots,
+# start/count per execution into `order` (children grouped by parent and
+# sorted by entry) and `keys` (ordinals sorted by key)
+TREE_HEADER = struct.Struct('<iii')  # n_exec, n_roots, n_keyed
+# step, offset, length, segment and offset of the step data it indexes
+TREE_INDEX_STRUCT = struct.Struct('<qqqiq')
+INT32 = struct.Struct('<i')
+
+
+def build_child_index(execdata: list):
+    """Return the encoded child-adjacency index of a step's executions"""
+    n = len(execdata)
+    ordinal = {}
+    for i, d in enumerate(execdata):
+        key = d.get('key')
+        if isinstance(key, str) and key not in ordinal:
+            ordinal[key] = i
+
+    def entry_of(i):
+        v = execdata[i].get('entry')
+        return v if isinstance(v, (int, float)) else 0
+
+    roots = []
+    children = [[] for _ in range(n)]
+    for i, d in enumerate(execdata):
+        parent = d.get('parent')
+        p = ordinal.get(parent) if isinstance(parent, str) else None
+        if p is None or p == i:
+            roots.append(i)
+        else:
+            children[p].append(i)
+
+    roots.sort(key=entry_of)
+    start, count, order = [], [], []
+    for c in children:
+        c.sort(key=entry_of)
+        start.append(len(order))
+        count.append(len(c))
+        order.extend(c)
+    keys = [i for _, i in sorted(ordinal.items())]
+
+    values = roots + start + count + order + keys
+    return TREE_HEADER.pack(n, len(roots), len(keys)) + \
+        struct.pack('<{}i'.format(len(values)), *values)
+
+
+class ChildIndex(object):
+    """Read access to an encoded child-adjacency index, without decoding it"""
+
+    def __init__(self, buf, offset=0):
+        self.n_exec, self.n_roots, self.n_keyed = \
+            TREE_HEADER.unpack_from(buf, offset)
+        self._buf = buf
+        self._roots = offset + TREE_HEADER.size
+        self._start = self._roots + 4 * self.n_roots
+        self._count = self._start + 4 * self.n_exec
+        self._order = self._count + 4 * self.n_exec
+        self._keys = self._order + 4 * (self.n_exec - self.n_roots)
+
+    def _int(self, pos, i):
+        return INT32.unpack_from(self._buf, pos + 4 * i)[0]
+
+    def roots(self):
+        return list(struct.unpack_from(
+            '<{}i'.format(self.n_roots), self._buf, self._roots))
+
+    def children(self, i):
+        """Ordinals of the children of execution i, ordered by entry"""
+        start, count = self._int(self._start, i), self._int(self._count, i)
+        return list(struct.unpack_from(
+            '<{}i'.format(count), self._buf, self._order + 4 * start))
+
+    def find(self, key, key_of):
+        """Ordinal of the execution with a key, given an ordinal -> key"""
+        lo, hi = 0, self.n_keyed
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key_of(self._int(self._keys, mid)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_keyed:
+            i = self._int(self._keys, lo)
+            if key_of(i) == key:
+                return i
+        return None
+
+
+class ListView(object):
+    """Executions of a step held in memory, with their child index"""
+
+    def __init__(self, execdata: list, index: ChildIndex):
+        self.execdata = execdata
+        self.index = index
+
+    def record(self, i):
+        return self.execdata[i]
+
+    def key(self, i):
+        return self.execdata[i].get('key')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StepView(object):
+    """
+    Random access to the executions of a stored step: records of an
+    uncompressed binary step are decoded one at a time from the segment
+    """
+
+    def __init__(self, store, entry, tree_entry):
+        self._maps = []
+        _, segment, offset, length, n_exec, n_comm, fmt = entry
+        with store._lock:
+            self._strings = store._strings
+
+        if fmt in (FORMAT_BINARY, FORMAT_LOCAL):
+            # an empty step may sit in an empty segment, which can't be
+            # mapped
+            self._mm = self._map(store._segment_file(segment)) \
+                if length else None
+            self._offset = offset
+            self._local = None
+            if fmt == FORMAT_LOCAL:
+                end = n_exec * EXEC_CODEC.size + n_comm * COMM_CODEC.size
+                self._local = local_table(
+                    self._mm[offset + end:offset + length] if length else b'')
+            self.execdata = None
+        else:
+            self.execdata, _ = store.read_entry(entry)
+
+        if tree_entry is not None:
+            self.index = ChildIndex(
+                self._map(store._file('tree.dat')), tree_entry[1])
+        else:
+            # steps written before the index existed
+            self.index = ChildIndex(build_child_index(
+                [self.record(i) for i in range(n_exec)]))
+
+    def _map(self, path):
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mm)
+        return mm
+
+    def record(self, i):
+        if self.execdata is not None:
+            return self.execdata[i]
+        size = EXEC_CODEC.size
+        pos = self._offset + i * size
+        return EXEC_CODEC.decode(self._mm[pos:pos + size], self._strings,
+                                 self._local)[0]
+
+    def key(self, i):
+        return self.record(i).get('key')
+
+    def close(self):
+        for mm in self._maps:
+            mm.close()
+        self._maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def subtree(view, root, max_depth=None, max_nodes=1000):
+    """
+    Return the subtree rooted at ordinal `root` as nested executions with
+    their `depth` and `children`, breadth first within the limits. Nodes
+    whose children were cut by the limits are marked `truncated`.
+    """
+    top = dict(view.record(root), depth=0, children=[])
+    queue = deque([(root, top)])
+    seen = {root}
+    while len(queue):
+        i, node = queue.popleft()
+        children = view.index.children(i)
+        if len(children) == 0:
+            continue
+        if max_depth is not None and node['depth'] >= max_depth:
+            node['truncated'] = True
+            continue
+        for c in children:
+            if c in seen:
+                continue
+            if len(seen) >= max_nodes:
+                node['truncated'] = True
+                break
+            seen.add(c)
+            child = dict(view.record(c), depth=node['depth'] + 1,
+                         children=[])
+            node['children'].append(child)
+            queue.append((c, child))
+    return top, len(seen)
+
+
+class RankStore(object):
+    """Execution data of one (app, rank)"""
+
+    def __init__(self, path, segment_size):
+        self.path = path
+        self.segment_size = segment_size
+
+        self._lock = threading.Lock()
+        self._strings = []
+        self._string_ids = {}
+        self._strings_pos = 0
+        self._index = {}
+        self._index_pos = 0
+        self._intervals = IntervalIndex()
+        self._intervals_pos = 0
+        self._trees = {}
+        self._trees_pos = 0
+        self._last_segment = 0
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _segment_file(self, segment):
+        return self._file('exec-{:06d}.seg'.format(segment))
+
+    def _read_tail(self, name, pos):
+        path = self._file(name)
+        if not os.path.exists(path) or os.path.getsize(path) <= pos:
+            return b''
+        with open(path, 'rb') as f:
+            f.seek(pos)
+            return f.read()
+
+    def _refresh(self):
+        """Read what other processes appended to the dictionary/indexes"""
+        buf = self._read_tail('strings.jsonl', self._strings_pos)
+        end = buf.rfind(b'\n') + 1
+        if end:
+            # one json document for all the new lines
+            lines = buf[:end].rstrip(b'\n').split(b'\n')
+            for s in json.loads(
+                    (b'[' + b','.join(lines) + b']').decode('utf-8')):
+                self._string_ids[s] = len(self._strings)
+                self._strings.append(s)
+        self._strings_pos += end
+
+        buf = self._read_tail('index.dat', self._index_pos)
+        end = len(buf) - len(buf) % INDEX_STRUCT.size
+        for entry in INDEX_STRUCT.iter_unpack(buf[:end]):
+            self._index[entry[0]] = entry
+            self._last_segment = entry[1]
+        self._index_pos += end
+
+        buf = self._read_tail('intervals.dat', self._intervals_pos)
+        end = len(buf) - len(buf) % INTERVAL_STRUCT.size
+        for step, lo, hi in INTERVAL_STRUCT.iter_unpack(buf[:end]):
+            if math.isnan(lo):
+                self._intervals.remove(step)
+            else:
+                self._intervals.set(step, lo, hi)
+        self._intervals_pos += end
+
+        buf = self._read_tail('tree.idx', self._trees_pos)
+        end = len(buf) - len(buf) % TREE_INDEX_STRUCT.size
+        for entry in TREE_INDEX_STRUCT.iter_unpack(buf[:end]):
+            self._trees[entry[0]] = entry
+        self._trees_pos += end
+
+    def steps(self):
+        with self._lock:
+            self._refresh()
+            return sorted(self._index.keys())
+
+    def entry(self, step):
+        """Return the index entry of a step, or None"""
+        with self._lock:
+            self._refresh()
+            return self._index.get(int(step))
+
+    def overlapping(self, min_ts, max_ts):
+        """Return the steps with executions within [min_ts, max_ts]"""
+        with self._lock:
+            self._refresh()
+            return self._intervals.overlapping(min_ts, max_ts)
+
+    def write(self, step, execdata: list, commdata: list,
+              codec=None, level=None):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+
+        with self._lock, open(self._file('lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._write(int(step), execdata, commdata, codec, level)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _truncate_partial(self):
+        """
+        Cut what a writer that crashed mid-append left after the last
+        complete line or record, so that the next append stays aligned
+        (called with the file lock held, after _refresh)
+        """
+        for name, pos in (('strings.jsonl', self._strings_pos),
+                          ('index.dat', self._index_pos),
+                          ('intervals.dat', self._intervals_pos),
+                          ('tree.idx', self._trees_pos)):
+            path = self._file(name)
+            if os.path.exists(path) and os.path.getsize(path) > pos:
+                os.truncate(path, pos)
+
+    def _write(self, step, execdata: list, commdata: list, codec, level):
+        self._refresh()
+
+        self._truncate_partial()
+
+        new_strings = []
+        local_ids = {}
+
+        def string_id(s):
+            i = self._string_ids.get(s)
+            if i is None:
+                i = len(self._strings)
+                self._string_ids[s] = i
+                self._strings.append(s)
+                new_strings.append(s)
+            return i
+
+        def local_id(s):
+            return local_ids.setdefault(s, len(local_ids))
+
+        try:
+            blob = b''.join(
+                [EXEC_CODEC.encode(d, string_id, local_id)
+                 for d in execdata] +
+                [COMM_CODEC.encode(d, string_id, local_id)
+                 for d in commdata])
+            if len(local_ids):
+                blob += json.dumps(list(local_ids)).encode('utf-8')
+            fmt = FORMAT_LOCAL
+        except (ValueError, TypeError, struct.error, AttributeError):
+            for s in new_strings:
+                del self._string_ids[s]
+            del self._strings[len(self._strings) - len(new_strings):]
+            new_strings = []
+            blob = json.dumps({'exec': execdata, 'comm': commdata}).encode()
+            fmt = FORMAT_JSON
+
+        blob = compress(blob, codec, level)
+        fmt |= CODECS[codec] << 4
+
+        if len(new_strings):
+            buf = b''.join(json.dumps(s).encode('utf-8') + b'\n'
+                           for s in new_strings)
+            with open(self._file('strings.jsonl'), 'ab') as f:
+                f.write(buf)
+            self._strings_pos += len(buf)
+
+        segment = self._last_segment
+        path = self._segment_file(segment)
+        if os.path.exists(path) and os.path.getsize(path) > 0 and \
+                os.path.getsize(path) + len(blob) > self.segment_size:
+            segment += 1
+            path = self._segment_file(segment)
+
+        with open(path, 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(blob)
+
+        # a rewritten step without executions drops its old interval
+        interval = time_interval(execdata)
+        if interval is None and self._intervals.get(step) is not None:
+            interval = NO_INTERVAL
+        if interval is not None:
+            with open(self._file('intervals.dat'), 'ab') as f:
+                f.write(INTERVAL_STRUCT.pack(step, *interval))
+            self._intervals_pos += INTERVAL_STRUCT.size
+            if interval is NO_INTERVAL:
+                self._intervals.remove(step)
+            else:
+                self._intervals.set(step, *interval)
+
+        tree = build_child_index(execdata)
+        with open(self._file('tree.dat'), 'ab') as f:
+            tree_offset = f.seek(0, os.SEEK_END)
+            f.write(tree)
+        tree_entry = (step, tree_offset, len(tree), segment, offset)
+        with open(self._file('tree.idx'), 'ab') as f:
+            f.write(TREE_INDEX_STRUCT.pack(*tree_entry))
+        self._trees_pos += TREE_INDEX_STRUCT.size
+        self._trees[step] = tree_entry
+
+        # the index entry goes last: once it is visible, so is the rest
+        entry = (step, segment, offset, len(blob),
+                 len(execdata), len(commdata), fmt)
+        with open(self._file('index.dat'), 'ab') as f:
+            f.write(INDEX_STRUCT.pack(*entry))
+        self._index_pos += INDEX_STRUCT.size
+        self._index[step] = entry
+        self._last_segment = segment
+
+    def open_step(self, step):
+        """Return a StepView of a step, or None if it isn't stored"""
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(int(step))
+            tree_entry = self._trees.get(int(step))
+        if entry is None:
+            return None
+        if tree_entry is not None and tree_entry[3:] != entry[1:3]:
+            # not written along with this version of the step
+            tree_entry = None
+        return StepView(self, entry, tree_entry)
+
+    def read(self, step):
+        """Return (exec, comm) of a step, or None if it isn't stored"""
+        entry = self.entry(step)
+        if entry is None:
+            return None
+        return self.read_entry(entry)
+
+    def read_entry(self, entry):
+        """Return (exec, comm) of the step version of an index entry"""
+        with self._lock:
+            strings = self._strings
+
+        _, segment, offset, length, n_exec, n_comm, fmt = entry
+        if length == 0:
+            return [], []
+        with open(self._segment_file(segment), 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                buf = mm[offset:offset + length]
+            finally:
+                mm.close()
+
+        buf = decompress(buf, CODEC_NAMES[fmt >> 4])
+        if fmt & FORMAT_MASK == FORMAT_JSON:
+            data = json.loads(buf.decode('utf-8'))
+            return data.get('exec', []), data.get('comm', [])
+
+        split = n_exec * EXEC_CODEC.size
+        end = split + n_comm * COMM_CODEC.size
+        local = None
+        if fmt & FORMAT_MASK == FORMAT_LOCAL:
+            local = local_table(buf[end:])
+        return EXEC_CODEC.decode(buf[:split], strings, local), \
+            COMM_CODEC.decode(buf[split:end], strings, local)
+
+
+class ExecutionStore(object):
+    """
+    Segmented execution store rooted at EXECUTION_PATH. The settings are
+    read from the current app on every call, since requests may be served
+    by the Celery app as well.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ranks = OrderedDict()  # path -> RankStore, least recent first
+
+    @property
+    def enabled(self):
+        return current_app.config.get('EXECUTION_FORMAT', 'segment') == \
+            'segment'
+
+    def _path(self, app, rank):
+        root = current_app.config.get('EXECUTION_PATH', None)
+        if root is None:
+            return None
+        return os.path.join(root, '{}'.format(app), '{}'.format(rank))
+
+    def rank(self, app, rank):
+        """Return the store of an (app, rank), or None without a path"""
+        path = self._path(app, rank)
+        if path is None:
+            return None
+        with self._lock:
+            store = self._ranks.get(path)
+            if store is None:
+                store = RankStore(path, current_app.config.get(
+                    'EXECUTION_SEGMENT_SIZE', 256 * 1024 * 1024))
+                self._ranks[path] = store
+                # the dictionaries and indexes of the least recently used
+                # ranks are read again when needed
+                limit = current_app.config.get('EXECUTION_OPEN_RANKS', 1024)
+                while len(self._ranks) > max(limit, 1):
+                    self._ranks.popitem(last=False)
+            else:
+                self._ranks.move_to_end(path)
+        return store
+
+    def write_step(self, app, rank, step, execdata: list, commdata: list):
+        self.rank(app, rank).write(
+            step, execdata or [], commdata or [],
+            resolve_codec(current_app.config.get('EXECUTION_COMPRESSION')),
+            current_app.config.get('EXECUTION_COMPRESSION_LEVEL'))
+
+    def _stored(self, app, rank):
+        path = self._path(app, rank)
+        return path is not None and \
+            os.path.exists(os.path.join(path, 'index.dat'))
+
+    def read_step(self, app, rank, step):
+        """Return (exec, comm) of a step, or None if it isn't stored"""
+        if not self._stored(app, rank):
+            return None
+        return self.rank(app, rank).read(step)
+
+    def entry(self, app, rank, step):
+        """Return the index entry of a step, or None if it isn't stored"""
+        if not self._stored(app, rank):
+            return None
+        return self.rank(app, rank).entry(step)
+
+    def overlapping(self, app, rank, min_ts, max_ts):
+        """Return the steps of an (app, rank) overlapping a time window"""
+        if not self._stored(app, rank):
+            return []
+        return self.rank(app, rank).overlapping(min_ts, max_ts)
+
+    def read_entry(self, app, rank, entry):
+        """Return (exec, comm) of the step version of an index entry"""
+        return self.rank(app, rank).read_entry(entry)
+
+    def open_step(self, app, rank, step):
+        """Return a StepView of a step, or None if it isn't stored"""
+        if not self._stored(app, rank):
+            return None
+        return self.rank(app, rank).open_step(step)
+
+    def clear(self):
+        """Forget the cached dictionaries and indexes"""
+        with self._lock:
+            self._ranks = OrderedDict()
+
+
+execution_store = ExecutionStore()
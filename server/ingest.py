@@ -0,0 +1,435 @@
+"""
+Write-behind ingest stage for anomaly snapshots
+
+Parsed AnomalyStat, AnomalyData and FuncStat rows are written with one
+transaction per bind. The same transaction upserts the latest snapshot
+per rank/function into the *_latest tables and adds AnomalyData to the
+multi-resolution rollups (see rollup.py).
+
+With INGEST_WRITE_BEHIND, the rows are buffered in-process and the
+requests are acknowledged once their rows are queued. The buffer is
+flushed when it holds INGEST_BATCH_SIZE rows or INGEST_FLUSH_INTERVAL
+after its first row, so that the requests handled by a process meanwhile
+share a transaction per bind (group commit). The trade-off is durability:
+acknowledged rows are only in memory until then, and are lost if the
+process is killed (they are flushed at exit and when a Celery worker
+process shuts down). Without write-behind, each request commits its rows
+before it is acknowledged, and gets the error if they can't be written.
+
+When the transaction of a flush fails, the rows of each request are
+written again on their own, so that a bad row only loses the rows sent
+with it: those are dropped, logged and kept among the last DEAD_LETTERS
+failed batches (see IngestQueue.dead_letters), never retried.
+"""
+import atexit
+import threading
+import time
+from collections import deque
+from itertools import repeat
+
+from . import db
+from .models import AnomalyStat, AnomalyStatLatest, AnomalyData, \
+    FuncStat, FuncStatLatest
+from .rollup import update_rollups
+from .tracing import tracer
+
+
+# bind key -> model whose table receives the buffered rows
+INGEST_MODELS = {
+    'anomaly_stats': AnomalyStat,
+    'anomaly_data': AnomalyData,
+    'func_stats': FuncStat
+}
+
+# failed batches kept for inspection
+DEAD_LETTERS = 100
+
+# bind key -> (latest-state model, unique key columns)
+LATEST_MODELS = {
+    'anomaly_stats': (AnomalyStatLatest, ('app', 'rank')),
+    'func_stats': (FuncStatLatest, ('fid',))
+}
+
+
+def column_length(columns: dict):
+    """Return the number of rows held by a column batch"""
+    for v in columns.values():
+        return len(v)
+    return 0
+
+
+def execute_columns(conn, table, stmt, columns: dict, column_keys=None):
+    """
+    Execute a statement for every row of a column batch (field name ->
+    list of values) with a positional executemany of the value tuples, so
+    that no per-row dictionary is built. Bind parameters named '_' + a
+    column take the values of that column (see upsert_statements), and
+    the columns that are not given take their default value.
+    """
+    compiled = stmt.compile(dialect=conn.dialect, column_keys=column_keys)
+    names = compiled.positiontup if compiled.positional \
+        else list(compiled.binds)
+    values = []
+    for name in names:
+        v = columns.get(name)
+        if v is None and name.startswith('_'):
+            v = columns.get(name[1:])
+        process = compiled.binds[name].type._cached_bind_processor(
+            conn.dialect)
+        if v is None:
+            column = table.c[name]
+            default = column.onupdate if compiled.isupdate \
+                else column.default
+            value = None
+            if default is not None:
+                value = default.arg(None) if default.is_callable \
+                    else default.arg
+            v = repeat(process(value) if process else value)
+        elif process:
+            v = map(process, v)
+        values.append(v)
+
+    params = zip(*values)
+    if not compiled.positional:
+        # named paramstyles (e.g. psycopg2) take a mapping per row
+        params = (dict(zip(names, row)) for row in params)
+    conn.execute(compiled.string, list(params))
+
+
+def upsert_statements(dialect, table, keys, names):
+    """
+    Return the statements of an upsert of rows holding the given columns,
+    as (statement, None) for the statements taking the rows as inserted
+    values and (statement, columns) for those binding the columns as
+    '_' + column.
+    """
+    from sqlalchemy import and_, bindparam, func
+
+    values = [c.name for c in table.columns
+              if c.name != 'id' and c.name not in keys]
+
+    if dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table)
+        return [(stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={c: stmt.excluded[c] for c in values},
+            where=stmt.excluded.created_at >= table.c.created_at), None)]
+
+    if dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        newer = stmt.inserted.created_at >= table.c.created_at
+        # assigned in order: created_at is compared before it changes
+        return [(stmt.on_duplicate_key_update([
+            (c, func.IF(newer, stmt.inserted[c], table.c[c]))
+            for c in sorted(values, key=lambda c: c == 'created_at')
+        ]), None)]
+
+    # SQLAlchemy 1.3 has no ON CONFLICT for sqlite: insert the new keys,
+    # then update the rows whose snapshot is not newer
+    updated = [c for c in values if c in names]
+    cond = [table.c[k] == bindparam('_' + k) for k in keys]
+    cond.append(table.c.created_at <= bindparam('_created_at'))
+    stmt = table.update().where(and_(*cond)).values(
+        {c: bindparam('_' + c) for c in updated})
+    return [(table.insert().prefix_with('OR IGNORE'), None),
+            (stmt, list(keys) + updated)]
+
+
+def upsert(conn, table, keys, rows: list):
+    """
+    Insert rows, or update the row having the same unique keys unless it
+    holds a newer snapshot, so that a delayed or re-sent snapshot never
+    replaces a newer one. Rows are applied in order: of two snapshots
+    with the same created_at, the last one wins.
+    """
+    if len(rows) == 0:
+        return
+    names = {c for row in rows for c in row}
+    for stmt, bound in upsert_statements(conn.dialect, table, keys, names):
+        if bound is None:
+            conn.execute(stmt, rows)
+        else:
+            conn.execute(stmt, [{'_' + c: row.get(c) for c in bound}
+                                for row in rows])
+
+
+def upsert_columns(conn, table, keys, columns: dict):
+    """upsert() of a column batch, without building per-row dictionaries"""
+    if column_length(columns) == 0:
+        return
+    names = list(columns.keys())
+    for stmt, bound in upsert_statements(conn.dialect, table, keys, names):
+        execute_columns(conn, table, stmt, columns,
+                        names if bound is None else None)
+
+
+def insert_columns(conn, table, columns: dict):
+    """
+    Bulk insert a column batch (field name -> list of values) with a
+    positional executemany (see execute_columns)
+    """
+    execute_columns(conn, table, table.insert(), columns,
+                    list(columns.keys()))
+
+
+def update_latest(conn, bind, rows: list, batches: list):
+    """Upsert the snapshots of a flush into the latest-state table"""
+    model, keys = LATEST_MODELS[bind]
+    table = model.__table__
+    upsert(conn, table, keys, rows)
+    for columns in batches:
+        upsert_columns(conn, table, keys, columns)
+
+
+def rebuild_latest(app=None):
+    """
+    Fill the latest-state tables from the snapshot history, e.g. for
+    databases created before the latest-state tables existed.
+    """
+    from sqlalchemy import func, select, and_
+
+    for bind, (model, keys) in LATEST_MODELS.items():
+        history = INGEST_MODELS[bind].__table__
+        latest = model.__table__
+        names = [c.name for c in history.columns if c.name != 'id']
+
+        subq = select(
+            [history.c[k] for k in keys] +
+            [func.max(history.c.created_at).label('max_ts')]
+        ).group_by(*[history.c[k] for k in keys]).alias('t2')
+        cond = [history.c[k] == subq.c[k] for k in keys]
+        cond.append(history.c.created_at == subq.c.max_ts)
+        query = select([history.c[n] for n in names]).select_from(
+            history.join(subq, and_(*cond))
+        ).order_by(history.c.id)
+
+        engine = db.get_engine(app=app, bind=bind)
+        with engine.begin() as conn:
+            conn.execute(latest.delete())
+            rows = [dict(zip(names, r)) for r in conn.execute(query)]
+            upsert(conn, latest, keys, rows)
+
+
+class IngestQueue(object):
+    """Buffer rows per bind and flush them in group commits"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.batch_size = 0
+        self.flush_interval = 0
+        self.rollup_resolutions = ()
+
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._pending = {bind: [] for bind in INGEST_MODELS}
+        self._pending_columns = {bind: [] for bind in INGEST_MODELS}
+        self._n_pending = 0
+        self._first_ts = None
+        self._thread = None
+        self._registered = False
+        # (time, bind, rows or column batch, error) of the dropped batches
+        self.dead_letters = deque(maxlen=DEAD_LETTERS)
+
+        self._stats = {
+            'n_flushes': 0,
+            'n_rows': 0,
+            'n_errors': 0,
+            'n_dropped': 0,
+            'last_flush_ms': 0.,
+            'max_flush_ms': 0.,
+            'total_flush_ms': 0.
+        }
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('INGEST_WRITE_BEHIND', False)
+        self.batch_size = app.config.get('INGEST_BATCH_SIZE', 1000)
+        self.flush_interval = app.config.get('INGEST_FLUSH_INTERVAL', 1.0)
+        self.rollup_resolutions = app.config.get('ROLLUP_RESOLUTIONS', ())
+        if not self._registered:
+            atexit.register(self.flush)
+            self._registered = True
+
+    def put(self, bind, rows: list):
+        """Queue rows for the given bind, flushing if a threshold is hit"""
+        if rows is None or len(rows) == 0:
+            return
+
+        if not self.enabled:
+            self._write({bind: [rows]}, {}, raise_errors=True)
+            return
+
+        with self._lock:
+            self._pending[bind].append(rows)
+            full = self._queued(len(rows))
+        self._ensure_thread()
+
+        if full:
+            self.flush()
+
+    def put_columns(self, bind, columns: dict):
+        """Queue a column batch (field name -> list of values)"""
+        n_rows = column_length(columns)
+        if n_rows == 0:
+            return
+
+        if not self.enabled:
+            self._write({}, {bind: [columns]}, raise_errors=True)
+            return
+
+        with self._lock:
+            self._pending_columns[bind].append(columns)
+            full = self._queued(n_rows)
+        self._ensure_thread()
+
+        if full:
+            self.flush()
+
+    def _queued(self, n_rows):
+        self._n_pending += n_rows
+        if self._first_ts is None:
+            self._first_ts = time.time()
+        return self._n_pending >= self.batch_size
+
+    def flush(self):
+        """
+        Write all pending rows, one transaction per bind. The rows that
+        cannot be written are dropped (see _write).
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._n_pending == 0:
+                    return
+                pending = self._pending
+                pending_columns = self._pending_columns
+                self._pending = {bind: [] for bind in INGEST_MODELS}
+                self._pending_columns = {bind: [] for bind in INGEST_MODELS}
+                self._n_pending = 0
+                self._first_ts = None
+            self._write(pending, pending_columns)
+
+    def _write_bind(self, bind, rows: list, batches: list):
+        """Write rows and column batches of a bind in one transaction"""
+        table = INGEST_MODELS[bind].__table__
+        engine = db.get_engine(app=self.app, bind=bind)
+        with tracer.span('ingest.write.{}'.format(bind)), \
+                engine.begin() as conn:
+            if len(rows):
+                conn.execute(table.insert(), rows)
+            for columns in batches:
+                insert_columns(conn, table, columns)
+            if bind in LATEST_MODELS:
+                update_latest(conn, bind, rows, batches)
+            if bind == 'anomaly_data':
+                update_rollups(conn, rows, batches, self.rollup_resolutions)
+
+    def _drop(self, bind, batch, n_rows, error):
+        """Give up on the rows of a request, keeping them as a dead letter"""
+        print('Exception on ingest flush ({}), dropping {} rows: '.format(
+            bind, n_rows), error)
+        with self._lock:
+            self._stats['n_dropped'] += n_rows
+            self.dead_letters.append((time.time(), bind, batch, str(error)))
+
+    def _write_each(self, bind, units: list, batches: list, error):
+        """
+        Write the rows of each request on their own after the transaction
+        of the bind failed, drop those failing again. Return the number
+        of rows written.
+        """
+        n_rows = 0
+        single = len(units) + len(batches) == 1
+        for rows, columns in [(u, []) for u in units] + \
+                [([], [c]) for c in batches]:
+            n = len(rows) + sum(column_length(c) for c in columns)
+            if not single:
+                try:
+                    self._write_bind(bind, rows, columns)
+                    n_rows += n
+                    continue
+                except Exception as e:
+                    error = e
+            self._drop(bind, rows or columns[0], n, error)
+        return n_rows
+
+    def _write(self, pending: dict, pending_columns: dict,
+               raise_errors=False):
+        """
+        Write the pending rows (lists of rows and column batches, one per
+        request) of each bind in one transaction. If it fails, each
+        request's rows are written on their own and those failing again
+        are dropped, or the error is raised if raise_errors.
+        """
+        t0 = time.time()
+        n_rows = 0
+        for bind in INGEST_MODELS:
+            units = pending.get(bind, [])
+            batches = pending_columns.get(bind, [])
+            if len(units) == 0 and len(batches) == 0:
+                continue
+            rows = [row for unit in units for row in unit]
+            try:
+                self._write_bind(bind, rows, batches)
+                n_rows += len(rows) + sum(column_length(c) for c in batches)
+            except Exception as e:
+                with self._lock:
+                    self._stats['n_errors'] += 1
+                if raise_errors:
+                    print('Exception on ingest write ({}): '.format(bind), e)
+                    raise
+                n_rows += self._write_each(bind, units, batches, e)
+        elapsed = (time.time() - t0) * 1000.
+
+        with self._lock:
+            self._stats['n_flushes'] += 1
+            self._stats['n_rows'] += n_rows
+            self._stats['last_flush_ms'] = elapsed
+            self._stats['total_flush_ms'] += elapsed
+            self._stats['max_flush_ms'] = max(
+                self._stats['max_flush_ms'], elapsed)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='ingest-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval / 2.)
+            with self._lock:
+                due = self._first_ts is not None and \
+                    time.time() - self._first_ts >= self.flush_interval
+            if due:
+                self.flush()
+
+    def stats(self):
+        """Return queue depth and flush counters"""
+        with self._lock:
+            d = dict(self._stats)
+            d.update({
+                'enabled': self.enabled,
+                'queue_depth': self._n_pending,
+                'queue_depth_per_bind': {
+                    bind: sum(len(unit) for unit in units) + sum(
+                        column_length(c) for c in self._pending_columns[bind])
+                    for bind, units in self._pending.items()
+                },
+                'n_dead_letters': len(self.dead_letters)
+            })
+        n = d['n_flushes']
+        d['mean_flush_ms'] = d['total_flush_ms'] / n if n else 0.
+        return d
+
+
+ingest_queue = IngestQueue()
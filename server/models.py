@@ -66,9 +66,8 @@ class Base(db.Model):
         }
 
 
-class AnomalyStat(Base):
-    __bind_key__ = 'anomaly_stats'
-    __tablename__ = 'anomalystat'
+class AnomalyStatBase(Base):
+    __abstract__ = True
 
     # application & rank id's
     app = db.Column(db.Integer, default=0)  # application id
@@ -101,9 +100,30 @@ class AnomalyStat(Base):
         return d
 
 
+class AnomalyStat(AnomalyStatBase):
+    __bind_key__ = 'anomaly_stats'
+    __tablename__ = 'anomalystat'
+    __table_args__ = (
+        db.Index('ix_anomalystat_app_rank_created_at',
+                 'app', 'rank', 'created_at'),
+    )
+
+
+class AnomalyStatLatest(AnomalyStatBase):
+    """Latest AnomalyStat snapshot per (app, rank), upserted at ingest"""
+    __bind_key__ = 'anomaly_stats'
+    __tablename__ = 'anomalystat_latest'
+    __table_args__ = (
+        db.UniqueConstraint('app', 'rank', name='uq_anomalystat_latest'),
+    )
+
+
 class AnomalyData(Base):
     __bind_key__ = 'anomaly_data'
     __tablename__ = 'anomalydata'
+    __table_args__ = (
+        db.Index('ix_anomalydata_app_rank_step', 'app', 'rank', 'step'),
+    )
 
     # application & rank id's
     app = db.Column(db.Integer, default=0)  # application id
@@ -128,9 +148,52 @@ class AnomalyData(Base):
         return d
 
 
-class FuncStat(Base):
-    __bind_key__ = 'func_stats'
-    __tablename__ = 'funcstat'
+class AnomalyDataRollup(db.Model):
+    """
+    AnomalyData aggregated over buckets of `resolution` steps per rank,
+    maintained incrementally at ingest
+    """
+    __bind_key__ = 'anomaly_data'
+    __tablename__ = 'anomalydata_rollup'
+    __table_args__ = (
+        db.UniqueConstraint('app', 'rank', 'resolution', 'bucket',
+                            name='uq_anomalydata_rollup'),
+    )
+    id = db.Column(INTEGER(unsigned=True), primary_key=True)
+
+    app = db.Column(db.Integer, default=0)
+    rank = db.Column(db.Integer, default=0)
+    resolution = db.Column(db.Integer, default=1)  # steps per bucket
+    bucket = db.Column(db.Integer, default=0)  # step // resolution
+
+    n_steps = db.Column(db.Integer, default=0)
+    min_step = db.Column(db.Integer, default=0)
+    max_step = db.Column(db.Integer, default=0)
+    sum_anomalies = db.Column(db.Integer, default=0)
+    min_anomalies = db.Column(db.Integer, default=0)
+    max_anomalies = db.Column(db.Integer, default=0)
+    min_timestamp = db.Column(db.Float, default=0)  # usec
+    max_timestamp = db.Column(db.Float, default=0)  # usec
+
+    def to_dict(self):
+        return {
+            'app': self.app,
+            'rank': self.rank,
+            'resolution': self.resolution,
+            'step': self.bucket * self.resolution,
+            'n_steps': self.n_steps,
+            'min_step': self.min_step,
+            'max_step': self.max_step,
+            'n_anomalies': self.sum_anomalies,
+            'min_anomalies': self.min_anomalies,
+            'max_anomalies': self.max_anomalies,
+            'min_timestamp': self.min_timestamp,
+            'max_timestamp': self.max_timestamp
+        }
+
+
+class FuncStatBase(Base):
+    __abstract__ = True
     fid = db.Column(db.Integer)
     name = db.Column(db.String())
 
@@ -203,8 +266,29 @@ class FuncStat(Base):
         return d
 
 
+class FuncStat(FuncStatBase):
+    __bind_key__ = 'func_stats'
+    __tablename__ = 'funcstat'
+    __table_args__ = (
+        db.Index('ix_funcstat_fid_created_at', 'fid', 'created_at'),
+    )
+
+
+class FuncStatLatest(FuncStatBase):
+    """Latest FuncStat snapshot per fid, upserted at ingest"""
+    __bind_key__ = 'func_stats'
+    __tablename__ = 'funcstat_latest'
+    __table_args__ = (
+        db.UniqueConstraint('fid', name='uq_funcstat_latest'),
+    )
+
+
 class ExecData(Base):
     __tablename__ = 'execdata'
+    __table_args__ = (
+        # keyset pagination of execution queries
+        db.Index('ix_execdata_entry_id', 'entry', 'id'),
+    )
 
     pid = db.Column(db.Integer, default=0)
     rid = db.Column(db.Integer, default=0)
@@ -256,6 +340,35 @@ class ExecData(Base):
         return d
 
 
+class CommMatrix(db.Model):
+    """
+    Messages and bytes per (src, tar) of the comm data of a step reported
+    by a rank, per time window, maintained incrementally at ingest
+    """
+    __tablename__ = 'commmatrix'
+    __table_args__ = (
+        db.UniqueConstraint('app', 'rank', 'step', 'type', 'window',
+                            'src', 'tar', name='uq_commmatrix'),
+        db.Index('ix_commmatrix_app_step', 'app', 'step'),
+        db.Index('ix_commmatrix_app_timestamp',
+                 'app', 'min_timestamp', 'max_timestamp'),
+    )
+    id = db.Column(INTEGER(unsigned=True), primary_key=True)
+
+    app = db.Column(db.Integer, default=0)
+    rank = db.Column(db.Integer, default=0)  # reporting rank
+    step = db.Column(db.Integer, default=0)
+    type = db.Column(db.String(), default='')  # SEND or RECV
+    window = db.Column(db.Integer, default=0)  # timestamp // window width
+
+    src = db.Column(db.Integer, default=0)
+    tar = db.Column(db.Integer, default=0)
+    n_messages = db.Column(db.Integer, default=0)
+    bytes = db.Column(db.BigInteger, default=0)
+    min_timestamp = db.Column(db.Float, default=0)  # usec
+    max_timestamp = db.Column(db.Float, default=0)  # usec
+
+
 class CommData(Base):
     __tablename__ = 'commdata'
     execdata_key = db.Column(db.String(), db.ForeignKey('execdata.key'))
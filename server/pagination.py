@@ -0,0 +1,67 @@
+"""
+Keyset pagination of execution queries on (entry, id)
+
+A page ends with the (entry, id) of its last row, handed to the client as
+an opaque cursor. The next page starts strictly after that key in the
+query order, so it costs an index seek whatever the page number is, and
+rows inserted meanwhile don't shift the pages.
+"""
+import base64
+import json
+
+from sqlalchemy import and_, or_
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(entry, id):
+    raw = json.dumps([entry, id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (entry, id) of a cursor, raise InvalidCursor if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        entry, id = json.loads(raw.decode())
+        if not isinstance(entry, (int, float)) or not isinstance(id, int):
+            raise ValueError
+        return entry, id
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise InvalidCursor('invalid cursor: {}'.format(cursor))
+
+
+def keyset_page(query, model, order='asc', cursor=None, limit=None):
+    """
+    Order a query by (entry, id) and restrict it to the page after
+    `cursor`. Return (rows, next_cursor); without a limit, all remaining
+    rows are returned as a query (not loaded) and next_cursor is None.
+    """
+    desc = order == 'desc'
+    if cursor is not None:
+        entry, id = decode_cursor(cursor)
+        if desc:
+            query = query.filter(or_(
+                model.entry < entry,
+                and_(model.entry == entry, model.id < id)))
+        else:
+            query = query.filter(or_(
+                model.entry > entry,
+                and_(model.entry == entry, model.id > id)))
+
+    if desc:
+        query = query.order_by(model.entry.desc(), model.id.desc())
+    else:
+        query = query.order_by(model.entry.asc(), model.id.asc())
+
+    if limit is None:
+        return query, None
+
+    # one extra row tells whether there is a next page
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].entry, rows[-1].id)
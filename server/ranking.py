@@ -0,0 +1,337 @@
+"""
+Global top-K/bottom-K ranking of anomaly statistics
+
+The ranking keeps the current statistics of every (app, rank) and, for
+each supported statKind, an ordered index over them. An update costs
+O(log n) per rank and kind, and top/bottom-k extraction costs O(k), no
+matter how many ranks were sent with the last snapshot. Column batches
+(field name -> list of values) are indexed as they are, the rows being
+built only for the ranks that are returned. Like the latest-state tables
+(see ingest.upsert), an (app, rank) only takes statistics at least as
+recent (created_at) as those it holds.
+"""
+import json
+import random
+import threading
+
+
+# statistics that can be selected as statKind in the query condition
+STAT_KINDS = ('count', 'accumulate', 'minimum', 'maximum',
+              'mean', 'stddev', 'skewness', 'kurtosis')
+
+# KEYS: rows hash, created_at hash, sorted set of each kind
+# ARGV: per member: member, created_at, json row, value of each kind
+UPDATE_SCRIPT = """
+local n = #KEYS - 2
+local updated = 0
+for j = 1, #ARGV, n + 3 do
+    local member = ARGV[j]
+    local current = redis.call('HGET', KEYS[2], member)
+    if not current or tonumber(current) <= tonumber(ARGV[j + 1]) then
+        redis.call('HSET', KEYS[2], member, ARGV[j + 1])
+        redis.call('HSET', KEYS[1], member, ARGV[j + 2])
+        for i = 1, n do
+            redis.call('ZADD', KEYS[i + 2], ARGV[j + 2 + i], member)
+        end
+        updated = updated + 1
+    end
+end
+return updated
+"""
+
+
+class _Node(object):
+    __slots__ = ('key', 'forward', 'prev')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.forward = [None] * level
+        self.prev = None
+
+
+class SortedIndex(object):
+    """Skip list of unique, comparable keys"""
+    MAX_LEVEL = 32
+    P = 0.25
+
+    def __init__(self):
+        self._head = _Node(None, self.MAX_LEVEL)
+        self._tail = None
+        self._level = 1
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _random_level(self):
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < self.P:
+            level += 1
+        return level
+
+    def _find(self, key):
+        update = [self._head] * self.MAX_LEVEL
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            while node.forward[i] is not None and node.forward[i].key < key:
+                node = node.forward[i]
+            update[i] = node
+        return update
+
+    def insert(self, key):
+        update = self._find(key)
+        nxt = update[0].forward[0]
+        if nxt is not None and nxt.key == key:
+            return
+
+        level = self._random_level()
+        self._level = max(self._level, level)
+        node = _Node(key, level)
+        for i in range(level):
+            node.forward[i] = update[i].forward[i]
+            update[i].forward[i] = node
+
+        node.prev = update[0] if update[0] is not self._head else None
+        if node.forward[0] is None:
+            self._tail = node
+        else:
+            node.forward[0].prev = node
+        self._size += 1
+
+    def remove(self, key):
+        update = self._find(key)
+        node = update[0].forward[0]
+        if node is None or node.key != key:
+            return False
+
+        for i in range(len(node.forward)):
+            update[i].forward[i] = node.forward[i]
+
+        if node.forward[0] is None:
+            self._tail = node.prev
+        else:
+            node.forward[0].prev = node.prev
+        while self._level > 1 and self._head.forward[self._level - 1] is None:
+            self._level -= 1
+        self._size -= 1
+        return True
+
+    def first(self, k):
+        """Return the k smallest keys in ascending order"""
+        keys = []
+        node = self._head.forward[0]
+        while node is not None and len(keys) < k:
+            keys.append(node.key)
+            node = node.forward[0]
+        return keys
+
+    def last(self, k):
+        """Return the k largest keys in descending order"""
+        keys = []
+        node = self._tail
+        while node is not None and len(keys) < k:
+            keys.append(node.key)
+            node = node.prev
+        return keys
+
+
+class LocalRanking(object):
+    """In-process ranking, used by a single worker or for testing"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}  # member -> (row, None) or (column batch, index)
+        self._index = {kind: SortedIndex() for kind in STAT_KINDS}
+
+    def __len__(self):
+        return len(self._rows)
+
+    @staticmethod
+    def _value(entry, kind):
+        source, i = entry
+        if i is None:
+            return source.get(kind) or 0
+        values = source.get(kind)
+        return (values[i] if values is not None else None) or 0
+
+    @staticmethod
+    def _row(entry):
+        source, i = entry
+        if i is None:
+            return source
+        return {k: v[i] for k, v in source.items()}
+
+    def _set(self, member, entry):
+        # called with the lock held
+        old = self._rows.get(member)
+        if old is not None and \
+                self._value(old, 'created_at') > \
+                self._value(entry, 'created_at'):
+            return
+        for kind, index in self._index.items():
+            if old is not None:
+                index.remove((self._value(old, kind), member))
+            index.insert((self._value(entry, kind), member))
+        self._rows[member] = entry
+
+    def update(self, rows: list):
+        with self._lock:
+            for row in rows:
+                self._set((row['app'], row['rank']), (row, None))
+
+    def update_columns(self, columns: dict):
+        with self._lock:
+            for i, member in enumerate(zip(columns['app'], columns['rank'])):
+                self._set(member, (columns, i))
+
+    def top(self, kind, k):
+        """Rows with the k largest values, in descending order"""
+        with self._lock:
+            return [self._row(self._rows[m])
+                    for _, m in self._index[kind].last(k)]
+
+    def bottom(self, kind, k):
+        """Rows with the k smallest values, in descending order"""
+        with self._lock:
+            keys = self._index[kind].first(k)
+            return [self._row(self._rows[m]) for _, m in reversed(keys)]
+
+    def clear(self):
+        with self._lock:
+            self._rows = {}
+            self._index = {kind: SortedIndex() for kind in STAT_KINDS}
+
+
+class RedisRanking(object):
+    """Ranking kept in Redis sorted sets, shared by all workers"""
+
+    def __init__(self, url, prefix='chimbuko:ranking'):
+        import redis
+        self._redis = redis.StrictRedis.from_url(url)
+        self._update = self._redis.register_script(UPDATE_SCRIPT)
+        self._rows_key = '{}:rows'.format(prefix)
+        self._created_key = '{}:created_at'.format(prefix)
+        self._prefix = prefix
+
+    def _key(self, kind):
+        return '{}:{}'.format(self._prefix, kind)
+
+    def __len__(self):
+        return self._redis.hlen(self._rows_key)
+
+    def _apply(self, args: list):
+        """Compare-and-set members not holding newer statistics, at once"""
+        self._update(keys=[self._rows_key, self._created_key] +
+                     [self._key(kind) for kind in STAT_KINDS], args=args)
+
+    def update(self, rows: list):
+        if len(rows) == 0:
+            return
+        args = []
+        for row in rows:
+            args.append('{}:{}'.format(row['app'], row['rank']))
+            args.append(row.get('created_at') or 0)
+            args.append(json.dumps(row))
+            args.extend(row.get(kind) or 0 for kind in STAT_KINDS)
+        self._apply(args)
+
+    def update_columns(self, columns: dict):
+        members = ['{}:{}'.format(app, rank)
+                   for app, rank in zip(columns['app'], columns['rank'])]
+        if len(members) == 0:
+            return
+        names = list(columns.keys())
+        created_at = columns.get('created_at') or [0] * len(members)
+        values = [columns.get(kind) or [0] * len(members)
+                  for kind in STAT_KINDS]
+        args = []
+        for i, (m, row) in enumerate(zip(members, zip(*columns.values()))):
+            args.append(m)
+            args.append(created_at[i] or 0)
+            args.append(json.dumps(dict(zip(names, row))))
+            args.extend(v[i] or 0 for v in values)
+        self._apply(args)
+
+    def _rows(self, members):
+        if len(members) == 0:
+            return []
+        return [json.loads(r) for r in self._redis.hmget(self._rows_key, members)
+                if r is not None]
+
+    def top(self, kind, k):
+        return self._rows(self._redis.zrevrange(self._key(kind), 0, k - 1))
+
+    def bottom(self, kind, k):
+        members = self._redis.zrange(self._key(kind), 0, k - 1)
+        return self._rows(list(reversed(members)))
+
+    def clear(self):
+        self._redis.delete(self._rows_key, self._created_key,
+                           *[self._key(kind) for kind in STAT_KINDS])
+
+
+class Ranking(object):
+    """Ranking backend selected by the RANKING_REDIS_URL config"""
+
+    def __init__(self, app=None):
+        self.backend = LocalRanking()
+        self._seeded = False
+        self._warned = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('RANKING_REDIS_URL', None)
+        self.backend = LocalRanking() if url is None else RedisRanking(url)
+        self._seeded = False
+
+        # tasks run by separate Celery workers: each process would only
+        # rank the rows it ingested itself
+        eager = app.config.get('CELERY_CONFIG', {}).get(
+            'CELERY_ALWAYS_EAGER', False)
+        if url is None and not eager and not self._warned:
+            app.logger.warning(
+                'RANKING_REDIS_URL is not set: the top/bottom ranking is '
+                'kept per process and is wrong with several workers')
+            self._warned = True
+
+    def seed(self):
+        """Load the latest statistics once, e.g. after a restart"""
+        if self._seeded:
+            return
+        self._seeded = True
+        if len(self.backend):
+            return
+        from .models import AnomalyStatLatest
+        try:
+            self.backend.update(
+                [st.to_dict() for st in AnomalyStatLatest.query.all()])
+        except Exception as e:
+            print('Exception on ranking seed: ', e)
+
+    def __len__(self):
+        return len(self.backend)
+
+    def update(self, rows: list):
+        self.seed()
+        self.backend.update(rows)
+
+    def update_columns(self, columns: dict):
+        """Update from a column batch of AnomalyStat"""
+        self.seed()
+        self.backend.update_columns(columns)
+
+    def top(self, kind, k):
+        self.seed()
+        return self.backend.top(kind, k)
+
+    def bottom(self, kind, k):
+        self.seed()
+        return self.backend.bottom(kind, k)
+
+    def clear(self):
+        self.backend.clear()
+        self._seeded = True
+
+
+ranking = Ranking()
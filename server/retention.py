@@ -0,0 +1,197 @@
+"""
+Background retention and compaction of snapshot tables
+
+Old AnomalyStat/FuncStat snapshots are deleted off the request path,
+in bounded chunks with one short transaction per chunk, following either
+of two policies:
+
+- keep the last RETENTION_KEEP_SNAPSHOTS snapshots per (app, rank)/fid
+- keep the snapshots within RETENTION_WINDOW of the newest one
+  (same unit as created_at)
+
+Both are off by default. The loop is started by the serving entrypoints
+(run_server.py, manager.py runserver, server/wsgi.py), not by
+create_app, so that maintenance commands and Celery workers never delete
+concurrently. Free pages of sqlite databases are reclaimed with
+incremental vacuum.
+"""
+import threading
+import time
+
+from sqlalchemy import select, and_, func
+
+from . import db
+from .models import AnomalyStat, FuncStat
+
+
+# bind key -> (snapshot model, group columns)
+RETENTION_MODELS = {
+    'anomaly_stats': (AnomalyStat, ('app', 'rank')),
+    'func_stats': (FuncStat, ('fid',))
+}
+
+
+def enable_incremental_vacuum(engine, full=False):
+    """
+    Switch a sqlite database to incremental auto-vacuum. This only takes
+    effect before any table is created, unless full=True runs a VACUUM
+    to rebuild an existing file (expensive for large databases).
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.connect() as conn:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        if full:
+            conn.execute('VACUUM')
+
+
+class RetentionService(object):
+    """Periodically delete old snapshots and reclaim disk space"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 0
+        self.keep_snapshots = None
+        self.window = None
+        self.chunk_size = 1000
+        self.vacuum_pages = 0
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {
+            'n_runs': 0,
+            'n_deleted': {bind: 0 for bind in RETENTION_MODELS},
+            'n_vacuum_pages': 0,
+            'last_run_ms': 0.,
+            'total_run_ms': 0.,
+            'last_run_at': None,
+            'n_errors': 0
+        }
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('RETENTION_INTERVAL', 0)
+        keep = app.config.get('RETENTION_KEEP_SNAPSHOTS', None)
+        window = app.config.get('RETENTION_WINDOW', None)
+        self.keep_snapshots = max(int(keep), 1) if keep is not None else None
+        self.window = float(window) if window is not None else None
+        self.chunk_size = app.config.get('RETENTION_CHUNK_SIZE', 1000)
+        self.vacuum_pages = app.config.get('RETENTION_VACUUM_PAGES', 0)
+
+    def start(self):
+        """Run the retention loop in a background thread"""
+        if self.interval <= 0 or \
+                (self.keep_snapshots is None and self.window is None):
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, name='retention', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception as e:
+                print('Exception on retention: ', e)
+                with self._lock:
+                    self._stats['n_errors'] += 1
+
+    def run_once(self):
+        """Apply the retention policies once and return a report"""
+        t0 = time.time()
+        report = {'deleted': {}, 'vacuum_pages': 0}
+        for bind, (model, keys) in RETENTION_MODELS.items():
+            engine = db.get_engine(app=self.app, bind=bind)
+            report['deleted'][bind] = self._delete(engine, model, keys)
+            if self.vacuum_pages > 0:
+                report['vacuum_pages'] += self._vacuum(engine)
+        elapsed = (time.time() - t0) * 1000.
+        report['elapsed_ms'] = elapsed
+
+        with self._lock:
+            self._stats['n_runs'] += 1
+            for bind, n in report['deleted'].items():
+                self._stats['n_deleted'][bind] += n
+            self._stats['n_vacuum_pages'] += report['vacuum_pages']
+            self._stats['last_run_ms'] = elapsed
+            self._stats['total_run_ms'] += elapsed
+            self._stats['last_run_at'] = int(t0 * 1000)
+        return report
+
+    def _stale_ids(self, conn, table, keys):
+        """Select one chunk of snapshot ids violating the policies"""
+        conds = []
+        if self.keep_snapshots is not None:
+            # created_at of the N-th newest snapshot of the same group
+            b = table.alias('b')
+            nth = select([b.c.created_at]).where(
+                and_(*[b.c[k] == table.c[k] for k in keys])
+            ).order_by(b.c.created_at.desc()).limit(1).offset(
+                self.keep_snapshots - 1).as_scalar()
+            conds.append(table.c.created_at < nth)
+
+        if self.window is not None:
+            newest = conn.execute(
+                select([func.max(table.c.created_at)])).scalar()
+            if newest is not None:
+                conds.append(table.c.created_at < newest - self.window)
+
+        if len(conds) == 0:
+            return []
+
+        query = select([table.c.id]).where(and_(*conds)).order_by(
+            table.c.id).limit(self.chunk_size)
+        return [r[0] for r in conn.execute(query)]
+
+    def _delete(self, engine, model, keys):
+        table = model.__table__
+        n_deleted = 0
+        while True:
+            with engine.begin() as conn:
+                ids = self._stale_ids(conn, table, keys)
+                if len(ids):
+                    conn.execute(table.delete().where(table.c.id.in_(ids)))
+            n_deleted += len(ids)
+            if len(ids) < self.chunk_size:
+                break
+        return n_deleted
+
+    def _vacuum(self, engine):
+        if engine.dialect.name != 'sqlite':
+            return 0
+        with engine.connect() as conn:
+            if conn.execute('PRAGMA auto_vacuum').scalar() != 2:
+                return 0
+            n_free = conn.execute('PRAGMA freelist_count').scalar()
+            # the pragma frees one page per step, so all of its (empty)
+            # rows have to be fetched from the DBAPI cursor
+            cursor = conn.connection.cursor()
+            try:
+                cursor.execute('PRAGMA incremental_vacuum({:d})'.format(
+                    int(self.vacuum_pages)))
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return n_free - conn.execute('PRAGMA freelist_count').scalar()
+
+    def stats(self):
+        """Return counters of rows removed and time spent"""
+        with self._lock:
+            d = dict(self._stats)
+            d['n_deleted'] = dict(self._stats['n_deleted'])
+        d.update({
+            'interval': self.interval,
+            'keep_snapshots': self.keep_snapshots,
+            'window': self.window
+        })
+        return d
+
+
+retention = RetentionService()
@@ -0,0 +1,352 @@
+"""
+Multi-resolution rollups of AnomalyData for the history view
+
+Each ingest flush adds its AnomalyData rows to buckets of 16, 256, 4096
+(ROLLUP_RESOLUTIONS) steps per rank, holding the step count, sum/min/max
+of n_anomalies and min/max timestamps. A history query then reads the
+coarsest resolution that still yields the requested number of points
+instead of every raw step.
+
+A step posted again replaces the previous one: the buckets holding it are
+recomputed from AnomalyData (latest row of each step) instead of being
+added to. Missing timestamps, stored as 0 by the AnomalyData defaults,
+are left out of the min/max.
+"""
+from itertools import repeat
+
+from sqlalchemy import text, func, and_, select
+
+from . import db
+from .models import AnomalyData, AnomalyDataRollup
+
+
+# AnomalyData fields used by the rollups
+ROLLUP_FIELDS = ('app', 'rank', 'step', 'n_anomalies',
+                 'min_timestamp', 'max_timestamp')
+
+# number of ranks or steps per IN (...) clause, below the sqlite variable
+# limit
+ROLLUP_CHUNK_SIZE = 500
+
+ROLLUP_COLUMNS = ('app', 'rank', 'resolution', 'bucket',
+                  'n_steps', 'min_step', 'max_step',
+                  'sum_anomalies', 'min_anomalies', 'max_anomalies',
+                  'min_timestamp', 'max_timestamp')
+
+
+def sent(timestamp):
+    """A timestamp, or None if it wasn't sent (None or the default 0)"""
+    return timestamp or None
+
+
+def flush_steps(rows: list, batches: list):
+    """
+    Return the AnomalyData of a flush as (app, rank, step) -> (n_anomalies,
+    min_timestamp, max_timestamp), the last row of a step winning, and the
+    number of rows per step
+    """
+    steps = {}
+    counts = {}
+
+    def add(app, rank, step, n, t0, t1):
+        key = (app or 0, rank or 0, step or 0)
+        steps[key] = (n or 0, sent(t0), sent(t1))
+        counts[key] = counts.get(key, 0) + 1
+
+    for row in rows:
+        add(*[row.get(f) for f in ROLLUP_FIELDS])
+
+    for columns in batches:
+        if 'step' not in columns:
+            raise ValueError('AnomalyData column batch without steps')
+        n_rows = len(columns['step'])
+        values = [columns[f] if f in columns else repeat(None, n_rows)
+                  for f in ROLLUP_FIELDS]
+        for v in zip(*values):
+            add(*v)
+
+    return steps, counts
+
+
+def _least(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _greatest(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+
+def add_step(buckets: dict, app, rank, step, n, t0, t1, resolutions,
+             skip=frozenset()):
+    """Add a step to the buckets of each resolution, but those in skip"""
+    for res in resolutions:
+        key = (app, rank, res, step // res)
+        if key in skip:
+            continue
+        b = buckets.get(key)
+        if b is None:
+            buckets[key] = [1, step, step, n, n, n, t0, t1]
+            continue
+        b[0] += 1
+        b[1] = min(b[1], step)
+        b[2] = max(b[2], step)
+        b[3] += n
+        b[4] = min(b[4], n)
+        b[5] = max(b[5], n)
+        b[6] = _least(b[6], t0)
+        b[7] = _greatest(b[7], t1)
+
+
+def bucket_rows(buckets: dict):
+    return [
+        dict(zip(ROLLUP_COLUMNS, key + tuple(b)))
+        for key, b in buckets.items()
+    ]
+
+
+def aggregate(steps: dict, resolutions, skip=frozenset()):
+    """
+    Aggregate steps ((app, rank, step) -> (n, t0, t1)) into buckets, but
+    the (app, rank, resolution, bucket) in skip
+    """
+    buckets = {}
+    for key, value in steps.items():
+        add_step(buckets, *key, *value, resolutions, skip)
+    return bucket_rows(buckets)
+
+
+def rollup_upsert(dialect):
+    """
+    Return the statement that merges a pre-aggregated bucket into the
+    stored one (sqlite >= 3.24, postgresql or mysql)
+    """
+    quote = dialect.identifier_preparer.quote
+    table = quote(AnomalyDataRollup.__tablename__)
+    keys = ROLLUP_COLUMNS[:4]
+
+    if dialect.name == 'mysql':
+        least, greatest = 'LEAST', 'GREATEST'
+        new = 'VALUES({})'.format
+        conflict = 'ON DUPLICATE KEY UPDATE'
+    else:
+        if dialect.name == 'sqlite':
+            least, greatest = 'MIN', 'MAX'
+        else:
+            least, greatest = 'LEAST', 'GREATEST'
+        new = 'excluded.{}'.format
+        conflict = 'ON CONFLICT ({}) DO UPDATE SET'.format(
+            ', '.join(quote(k) for k in keys))
+
+    # timestamps may be NULL, which LEAST/MIN would return
+    nullable = '({}(COALESCE({{old}}, {{new}}), COALESCE({{new}}, {{old}})))'
+    merge = {
+        'n_steps': '{old} + {new}',
+        'min_step': least + '({old}, {new})',
+        'max_step': greatest + '({old}, {new})',
+        'sum_anomalies': '{old} + {new}',
+        'min_anomalies': least + '({old}, {new})',
+        'max_anomalies': greatest + '({old}, {new})',
+        'min_timestamp': nullable.format(least),
+        'max_timestamp': nullable.format(greatest)
+    }
+    updates = [
+        '{} = {}'.format(quote(c), expr.format(
+            old='{}.{}'.format(table, quote(c)), new=new(quote(c))))
+        for c, expr in merge.items()
+    ]
+    return text('INSERT INTO {} ({}) VALUES ({}) {} {}'.format(
+        table,
+        ', '.join(quote(c) for c in ROLLUP_COLUMNS),
+        ', '.join(':' + c for c in ROLLUP_COLUMNS),
+        conflict,
+        ', '.join(updates)
+    ))
+
+
+def reposted_steps(conn, counts: dict):
+    """
+    Steps of a flush (already inserted) that AnomalyData held before, i.e.
+    that have more rows than the flush brought. Per app, the lookup goes
+    over the ranks of each step (or the steps of each rank, whichever is
+    shorter), ROLLUP_CHUNK_SIZE values per IN (...) clause.
+    """
+    table = AnomalyData.__table__
+    by_app = {}
+    for app, rank, step in counts:
+        by_app.setdefault(app, []).append((rank, step))
+
+    reposted = set()
+    for app, keys in by_app.items():
+        by_step = len({step for _, step in keys}) <= \
+            len({rank for rank, _ in keys})
+        fixed_column, listed_column = (table.c.step, table.c.rank) \
+            if by_step else (table.c.rank, table.c.step)
+        groups = {}
+        for rank, step in keys:
+            if by_step:
+                groups.setdefault(step, []).append(rank)
+            else:
+                groups.setdefault(rank, []).append(step)
+
+        for fixed, listed in groups.items():
+            for i in range(0, len(listed), ROLLUP_CHUNK_SIZE):
+                query = select([
+                    table.c.rank, table.c.step, func.count()
+                ]).where(and_(
+                    table.c.app == app,
+                    fixed_column == fixed,
+                    listed_column.in_(listed[i:i + ROLLUP_CHUNK_SIZE])
+                )).group_by(
+                    table.c.rank, table.c.step
+                ).having(func.count() > 1)
+
+                for rank, step, n in conn.execute(query):
+                    key = (app, rank, step)
+                    if n > counts.get(key, n):
+                        reposted.add(key)
+    return reposted
+
+
+def recompute_buckets(conn, keys):
+    """Replace (app, rank, resolution, bucket) by the latest row per step"""
+    table = AnomalyData.__table__
+    rollup = AnomalyDataRollup.__table__
+    for app, rank, res, bucket in keys:
+        query = select([
+            table.c.step, table.c.n_anomalies,
+            table.c.min_timestamp, table.c.max_timestamp
+        ]).where(and_(
+            table.c.app == app,
+            table.c.rank == rank,
+            table.c.step >= bucket * res,
+            table.c.step < (bucket + 1) * res
+        )).order_by(table.c.id)
+        steps = {(app, rank, step): (n or 0, sent(t0), sent(t1))
+                 for step, n, t0, t1 in conn.execute(query)}
+
+        conn.execute(rollup.delete().where(and_(
+            rollup.c.app == app,
+            rollup.c.rank == rank,
+            rollup.c.resolution == res,
+            rollup.c.bucket == bucket
+        )))
+        buckets = aggregate(steps, [res])
+        if len(buckets):
+            conn.execute(rollup.insert(), buckets)
+
+
+def update_rollups(conn, rows: list, batches: list, resolutions):
+    """
+    Add the AnomalyData of a flush, already inserted in the same
+    transaction, to the rollup tables
+    """
+    if len(resolutions) == 0:
+        return
+    steps, counts = flush_steps(rows, batches)
+    if len(steps) == 0:
+        return
+
+    # buckets of re-posted steps are recomputed, the others added to
+    stale = {(app, rank, res, step // res)
+             for app, rank, step in reposted_steps(conn, counts)
+             for res in resolutions}
+    buckets = aggregate(steps, resolutions, stale)
+    if len(buckets):
+        conn.execute(rollup_upsert(conn.dialect), buckets)
+    recompute_buckets(conn, stale)
+
+
+def rebuild_rollups(app=None, resolutions=(16, 256, 4096)):
+    """Recompute the rollup tables from the stored AnomalyData"""
+    engine = db.get_engine(app=app, bind='anomaly_data')
+    table = AnomalyData.__table__
+    query = select([table.c[f] for f in ROLLUP_FIELDS]).order_by(
+        table.c.app, table.c.rank, table.c.step, table.c.id)
+    with engine.begin() as conn:
+        conn.execute(AnomalyDataRollup.__table__.delete())
+        # the rows of a step are adjacent: only the last one is added
+        buckets = {}
+        last = None
+        for app, rank, step, n, t0, t1 in conn.execute(query):
+            key = (app or 0, rank or 0, step or 0)
+            if last is not None and last[:3] != key:
+                add_step(buckets, *last, resolutions)
+            last = key + (n or 0, sent(t0), sent(t1))
+        if last is not None:
+            add_step(buckets, *last, resolutions)
+        if len(buckets):
+            conn.execute(AnomalyDataRollup.__table__.insert(),
+                         bucket_rows(buckets))
+
+
+def choose_resolution(span, points, resolutions):
+    """Coarsest resolution giving at least `points` buckets over `span` steps"""
+    best = 1
+    for res in sorted(resolutions):
+        if (span + res - 1) // res >= points:
+            best = res
+    return best
+
+
+def query_history(app, rank, points, min_step=None, max_step=None,
+                  resolutions=(16, 256, 4096)):
+    """
+    Return the anomaly history of a rank at the coarsest resolution that
+    still has `points` buckets within [min_step, max_step]
+    """
+    if min_step is None or max_step is None:
+        coarsest = max(resolutions) if len(resolutions) else 1
+        lo, hi = db.session.query(
+            func.min(AnomalyDataRollup.min_step),
+            func.max(AnomalyDataRollup.max_step)
+        ).filter(and_(
+            AnomalyDataRollup.app == app,
+            AnomalyDataRollup.rank == rank,
+            AnomalyDataRollup.resolution == coarsest
+        )).one()
+        if lo is None:
+            lo, hi = db.session.query(
+                func.min(AnomalyData.step), func.max(AnomalyData.step)
+            ).filter(and_(
+                AnomalyData.app == app, AnomalyData.rank == rank
+            )).one()
+        if lo is None:
+            return 1, []
+        min_step = lo if min_step is None else min_step
+        max_step = hi if max_step is None else max_step
+
+    res = choose_resolution(max_step - min_step + 1, points, resolutions)
+
+    if res == 1:
+        # the latest row of a re-posted step, like in the rollups
+        latest = {}
+        for d in AnomalyData.query.filter(and_(
+            AnomalyData.app == app,
+            AnomalyData.rank == rank,
+            AnomalyData.step >= min_step,
+            AnomalyData.step <= max_step
+        )).order_by(AnomalyData.step, AnomalyData.id):
+            latest[d.step] = d
+        return res, [{
+            'app': d.app,
+            'rank': d.rank,
+            'resolution': 1,
+            'step': d.step,
+            'n_steps': 1,
+            'min_step': d.step,
+            'max_step': d.step,
+            'n_anomalies': d.n_anomalies,
+            'min_anomalies': d.n_anomalies,
+            'max_anomalies': d.n_anomalies,
+            'min_timestamp': d.min_timestamp,
+            'max_timestamp': d.max_timestamp
+        } for d in latest.values()]
+
+    data = AnomalyDataRollup.query.filter(and_(
+        AnomalyDataRollup.app == app,
+        AnomalyDataRollup.rank == rank,
+        AnomalyDataRollup.resolution == res,
+        AnomalyDataRollup.bucket >= min_step // res,
+        AnomalyDataRollup.bucket <= max_step // res
+    )).order_by(AnomalyDataRollup.bucket).all()
+    return res, [d.to_dict() for d in data]
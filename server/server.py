@@ -4,6 +4,11 @@ from flask import Blueprint, jsonify, render_template, Response, json
 from . import stats as req_stats
 from . import socketio, celery as mycelery
 from .utils import url_for
+from .ingest import ingest_queue
+from .retention import retention
+from .execcache import step_cache
+from .emitter import push_scheduler
+from .admission import admission
 
 main = Blueprint('main', __name__)
 
@@ -20,6 +25,13 @@ def before_request():
     req_stats.add_request()
 
 
+@main.after_app_request
+def after_request(response):
+    """Record the latency of the request."""
+    req_stats.end_request()
+    return response
+
+
 @main.route('/stop')
 def stop():
     import time
@@ -73,4 +85,19 @@ def index():
 
 @main.route('/stats', methods=['GET'])
 def get_stats():
-    return jsonify({'requests_per_second': req_stats.requests_per_second()})
+    return jsonify({
+        'requests_per_second': req_stats.requests_per_second(),
+        'endpoints': req_stats.metrics.snapshot(),
+        'ingest': ingest_queue.stats(),
+        'retention': retention.stats(),
+        'execution_cache': step_cache.stats(),
+        'push': push_scheduler.stats(),
+        'admission': admission.stats()
+    })
+
+
+@main.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request metrics in the Prometheus text format"""
+    return Response(req_stats.metrics.prometheus(),
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,123 @@
+"""
+Process-local cache of the active AnomalyStatQuery
+
+The active query condition is read on every ingest, so it is kept in
+memory instead of being queried and unpickled each time. When a Redis URL
+is configured, a version counter in Redis lets every worker notice that
+the query_stats handler replaced the condition.
+"""
+import threading
+
+from . import db
+
+
+DEFAULT_QUERY = {
+    'nQueries': 5,
+    'statKind': 'stddev',
+    'ranks': []
+}
+
+
+class ActiveQuery(object):
+    """
+    Immutable snapshot of a query condition, ranks held as a set of
+    (app, rank) (plain ranks of older conditions being taken as app 0)
+    """
+
+    def __init__(self, nQueries, statKind, ranks, created_at=None):
+        self.nQueries = nQueries
+        self.statKind = statKind
+        self.ranks = frozenset(
+            tuple(r) if isinstance(r, (list, tuple)) else (0, r)
+            for r in ranks)
+        self.created_at = created_at
+
+    @staticmethod
+    def from_model(q):
+        d = q.to_dict()
+        return ActiveQuery(d['nQueries'], d['statKind'], d['ranks'],
+                           d['created_at'])
+
+    def to_dict(self):
+        return {
+            'nQueries': self.nQueries,
+            'statKind': self.statKind,
+            'ranks': sorted(self.ranks),
+            'created_at': self.created_at
+        }
+
+
+class StatQueryCache(object):
+    """Cache the latest AnomalyStatQuery row of the main database"""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._query = None
+        self._version = None
+        self._redis = None
+        self._version_key = 'chimbuko:statquery:version'
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('STAT_QUERY_REDIS_URL', None)
+        if url is not None:
+            import redis
+            self._redis = redis.StrictRedis.from_url(url)
+        else:
+            self._redis = None
+        self._query = None
+        self._version = None
+
+    def _remote_version(self):
+        if self._redis is None:
+            return None
+        try:
+            return self._redis.get(self._version_key)
+        except Exception as e:
+            print('Exception on stat query version: ', e)
+            return None
+
+    def get(self):
+        """Return the active query, loading it only if it has changed"""
+        version = self._remote_version()
+        with self._lock:
+            if self._query is not None and version == self._version:
+                return self._query
+
+        q = self.load()
+        with self._lock:
+            self._query = q
+            self._version = version
+        return q
+
+    def load(self):
+        """Read the active query from database, creating a default one"""
+        from .models import AnomalyStatQuery
+        q = AnomalyStatQuery.query. \
+            order_by(AnomalyStatQuery.created_at.desc()).first()
+
+        if q is None:
+            q = AnomalyStatQuery.create(DEFAULT_QUERY)
+            db.session.add(q)
+            db.session.commit()
+        return ActiveQuery.from_model(q)
+
+    def invalidate(self, q=None):
+        """
+        Drop the cached query in every process. If the new query model is
+        given, this process starts using it right away.
+        """
+        version = None
+        if self._redis is not None:
+            try:
+                version = str(self._redis.incr(self._version_key)).encode()
+            except Exception as e:
+                print('Exception on stat query invalidate: ', e)
+
+        with self._lock:
+            self._query = ActiveQuery.from_model(q) if q is not None else None
+            self._version = version
+
+
+stat_query = StatQueryCache()
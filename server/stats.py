@@ -1,18 +1,207 @@
-from flask import current_app
-from .utils import timestamp
+"""
+Request metrics: per-endpoint rates and latency histograms
 
+Each endpoint gets a ring buffer of per-second request counts over the
+last REQUEST_STATS_WINDOW seconds and a log-bucketed (HDR-style) latency
+histogram, both updated in constant time without taking a lock. Races
+between threads may lose an increment, which is fine for monitoring.
+The metrics are reported at /stats and, in the Prometheus text format,
+at /metrics.
+"""
+import math
+import time
 
-# list to calculate request per second
-request_stats = []
+from flask import g, request
+
+
+# sub-buckets per power of two of the latency histograms: the relative
+# error of a percentile is below 1 / LATENCY_SUB_BUCKETS
+LATENCY_SUB_BUCKETS = 16
+
+# latencies are recorded in usec, up to 2 ** LATENCY_MAX_EXPONENT
+LATENCY_MAX_EXPONENT = 40
+
+LATENCY_N_BUCKETS = (LATENCY_MAX_EXPONENT + 1) * LATENCY_SUB_BUCKETS
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class RateCounter(object):
+    """Requests per second over a sliding window of whole seconds"""
+
+    __slots__ = ('window', '_seconds', '_counts')
+
+    def __init__(self, window=15):
+        self.window = max(int(window), 1)
+        # one extra slot for the second in progress
+        self._seconds = [0] * (self.window + 1)
+        self._counts = [0] * (self.window + 1)
+
+    def add(self, now=None):
+        second = int(now if now is not None else time.time())
+        i = second % len(self._seconds)
+        if self._seconds[i] != second:
+            self._seconds[i] = second
+            self._counts[i] = 0
+        self._counts[i] += 1
+
+    def rate(self, now=None):
+        second = int(now if now is not None else time.time())
+        n = sum(c for s, c in zip(self._seconds, self._counts)
+                if second - self.window < s <= second)
+        return n / self.window
+
+
+class LatencyHistogram(object):
+    """Latency counts in logarithmic buckets, with percentile estimates"""
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * LATENCY_N_BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    @staticmethod
+    def _index(usec):
+        if usec < 1:
+            return 0
+        m, e = math.frexp(usec)  # usec = m * 2 ** e, 0.5 <= m < 1
+        if e > LATENCY_MAX_EXPONENT:
+            return LATENCY_N_BUCKETS - 1
+        return e * LATENCY_SUB_BUCKETS + \
+            int((m - 0.5) * 2 * LATENCY_SUB_BUCKETS)
+
+    @staticmethod
+    def _upper(i):
+        """Upper bound of bucket i, in usec"""
+        e, sub = divmod(i, LATENCY_SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 1) / (2. * LATENCY_SUB_BUCKETS), e)
+
+    def add(self, seconds):
+        self.counts[self._index(seconds * 1e6)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-quantile, in seconds"""
+        if self.count == 0:
+            return 0.
+        rank = q * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if c and n >= rank:
+                return min(self._upper(i) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        d = {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.,
+            'max': self.max
+        }
+        for q in QUANTILES:
+            d['p{:g}'.format(q * 100)] = self.percentile(q)
+        return d
+
+
+class EndpointMetrics(object):
+    __slots__ = ('rate', 'latency')
+
+    def __init__(self, window):
+        self.rate = RateCounter(window)
+        self.latency = LatencyHistogram()
+
+
+class MetricsRegistry(object):
+    """Rate counters and latency histograms per Flask endpoint"""
+
+    def __init__(self, app=None, window=15):
+        self.window = window
+        self.total = RateCounter(window)
+        self._endpoints = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        window = app.config.get('REQUEST_STATS_WINDOW', self.window)
+        if window != self.window:
+            self.window = window
+            self.total = RateCounter(window)
+            self._endpoints = {}
+
+    def endpoint(self, name):
+        m = self._endpoints.get(name)
+        if m is None:
+            # setdefault keeps the first one if two threads race here
+            m = self._endpoints.setdefault(name, EndpointMetrics(self.window))
+        return m
+
+    def observe(self, name, seconds, now=None):
+        m = self.endpoint(name)
+        m.rate.add(now)
+        m.latency.add(seconds)
+        self.total.add(now)
+
+    def snapshot(self):
+        now = time.time()
+        endpoints = {}
+        for name, m in list(self._endpoints.items()):
+            d = m.latency.to_dict()
+            d['requests_per_second'] = m.rate.rate(now)
+            endpoints[name] = d
+        return endpoints
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        now = time.time()
+        lines = [
+            '# HELP chimbuko_requests_per_second Requests per second over '
+            'the last {} seconds'.format(self.window),
+            '# TYPE chimbuko_requests_per_second gauge'
+        ]
+        items = sorted(self._endpoints.items())
+        for name, m in items:
+            lines.append('chimbuko_requests_per_second{{endpoint="{}"}} {}'
+                         .format(name, m.rate.rate(now)))
+        lines += [
+            '# HELP chimbuko_request_latency_seconds Request latency',
+            '# TYPE chimbuko_request_latency_seconds summary'
+        ]
+        for name, m in items:
+            h = m.latency
+            for q in QUANTILES:
+                lines.append(
+                    'chimbuko_request_latency_seconds{{endpoint="{}",'
+                    'quantile="{:g}"}} {}'.format(name, q, h.percentile(q)))
+            lines.append('chimbuko_request_latency_seconds_sum'
+                         '{{endpoint="{}"}} {}'.format(name, h.total))
+            lines.append('chimbuko_request_latency_seconds_count'
+                         '{{endpoint="{}"}} {}'.format(name, h.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
 
 
 def add_request():
-    t = timestamp()
-    while len(request_stats) > 0 and \
-            request_stats[0] < t - current_app.config['REQUEST_STATS_WINDOW']:
-        del request_stats[0]
-    request_stats.append(t)
+    """Mark the start of a request (before_request)"""
+    # requests re-dispatched by a Celery task were counted by the server
+    if not getattr(g, 'in_celery', False):
+        g.request_started = time.perf_counter()
+
+
+def end_request():
+    """Record the rate and latency of the request (after_request)"""
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        metrics.observe(request.endpoint or 'unknown',
+                        time.perf_counter() - started)
 
 
 def requests_per_second():
-    return len(request_stats) / current_app.config['REQUEST_STATS_WINDOW']
+    return metrics.total.rate()
@@ -0,0 +1,159 @@
+"""
+Socket.IO subscriptions of the sessions to ranks
+
+Each session watching a rank joins the room of its (app, rank), so that
+a history update is emitted once per room and reaches only the sessions
+watching that rank. The union of the watched (app, rank) is kept as the
+ranks of the active AnomalyStatQuery, which tells the ingest workers what
+to push.
+
+Sessions also pick a payload encoding when they connect (see emitter.py)
+and join the rooms of that encoding. The sessions in the rooms of the
+other encodings than the default are counted, so that the emitter only
+encodes a payload for the rooms someone listens to. With
+SUBSCRIPTIONS_REDIS_URL, the counts are kept in Redis so that the
+workers, which emit without holding any session, see them too; they are
+read at most once per second per room.
+"""
+import threading
+import time
+from collections import Counter
+
+
+# payload encodings a session can ask for, the first being the default
+ENCODINGS = ('json', 'msgpack')
+
+
+def rank_room(app, rank):
+    return 'rank:{}:{}'.format(app, rank)
+
+
+def encoding_room(room, encoding):
+    """Room of the sessions of `room` (None: all) using `encoding`"""
+    if room is None:
+        return 'encoding:{}'.format(encoding)
+    if encoding == ENCODINGS[0]:
+        return room
+    return '{}:{}'.format(room, encoding)
+
+
+class Subscriptions(object):
+    """(app, rank) watched by each session connected to this server"""
+
+    def __init__(self, app=None):
+        self.cache_ttl = 1.
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._encodings = {}
+        self._rooms = Counter()  # room of a non-default encoding -> sessions
+        self._redis = None
+        self._key = 'chimbuko:subscriptions:rooms'
+        self._cache = {}         # room -> (time, sessions)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('SUBSCRIPTIONS_REDIS_URL', None)
+        if url is not None:
+            import redis
+            self._redis = redis.StrictRedis.from_url(url)
+        else:
+            self._redis = None
+        self._cache = {}
+
+    def _encoded_rooms(self, sid):
+        # called with the lock held
+        encoding = self._encodings.get(sid, ENCODINGS[0])
+        if encoding == ENCODINGS[0]:
+            return set()
+        rooms = {encoding_room(None, encoding)}
+        rooms.update(encoding_room(rank_room(*member), encoding)
+                     for member in self._sessions.get(sid, ()))
+        return rooms
+
+    def _count(self, joined, left):
+        """Count the sessions joining and leaving encoded rooms"""
+        if not len(joined) and not len(left):
+            return
+        with self._lock:
+            self._rooms.update(joined)
+            self._rooms.subtract(left)
+            self._rooms += Counter()  # drop the empty rooms
+        if self._redis is None:
+            return
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for room in joined:
+                pipe.hincrby(self._key, room, 1)
+            for room in left:
+                pipe.hincrby(self._key, room, -1)
+            pipe.execute()
+        except Exception as e:
+            print('Exception on subscription count: ', e)
+
+    def set(self, sid, members):
+        """Replace the members of a session, return (joined, left)"""
+        members = set(members)
+        with self._lock:
+            rooms = self._encoded_rooms(sid)
+            old = self._sessions.get(sid, set())
+            if len(members):
+                self._sessions[sid] = members
+            else:
+                self._sessions.pop(sid, None)
+            new_rooms = self._encoded_rooms(sid)
+        self._count(new_rooms - rooms, rooms - new_rooms)
+        return members - old, old - members
+
+    def remove(self, sid):
+        """Forget a session, return the members it left"""
+        with self._lock:
+            rooms = self._encoded_rooms(sid)
+            self._encodings.pop(sid, None)
+            members = self._sessions.pop(sid, set())
+        self._count(set(), rooms)
+        return members
+
+    def set_encoding(self, sid, encoding):
+        with self._lock:
+            rooms = self._encoded_rooms(sid)
+            self._encodings[sid] = encoding
+            new_rooms = self._encoded_rooms(sid)
+        self._count(new_rooms - rooms, rooms - new_rooms)
+
+    def encoding(self, sid):
+        with self._lock:
+            return self._encodings.get(sid, ENCODINGS[0])
+
+    def listened(self, room, encoding):
+        """True if any session gets the `encoding` payloads of `room`"""
+        room = encoding_room(room, encoding)
+        if self._redis is None:
+            with self._lock:
+                return self._rooms[room] > 0
+
+        now = time.time()
+        cached = self._cache.get(room)
+        if cached is not None and now - cached[0] < self.cache_ttl:
+            return cached[1] > 0
+        try:
+            n = int(self._redis.hget(self._key, room) or 0)
+        except Exception as e:
+            # rather encode for nobody than miss a session
+            print('Exception on subscription lookup: ', e)
+            return True
+        self._cache[room] = (now, n)
+        return n > 0
+
+    def members(self, sid):
+        with self._lock:
+            return set(self._sessions.get(sid, set()))
+
+    def watched(self):
+        """Union of the (app, rank) watched by any session"""
+        with self._lock:
+            return {member for members in self._sessions.values()
+                    for member in members}
+
+
+subscriptions = Subscriptions()
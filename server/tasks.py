@@ -1,3 +1,4 @@
+import time
 from functools import wraps
 try:
     from io import BytesIO
@@ -7,9 +8,14 @@ except ImportError:  # pragma:  no cover
 from flask import Blueprint, abort, g, request
 from werkzeug.exceptions import InternalServerError
 from celery import states
+from celery.signals import worker_process_shutdown
+from celery.worker.control import inspect_command
 
 from . import celery
 from .utils import url_for
+from .ingest import ingest_queue
+from .admission import admission
+from .tracing import tracer
 
 text_types = (str, bytes)
 try:
@@ -22,7 +28,19 @@ tasks_bp = Blueprint('tasks', __name__)
 
 
 @celery.task
-def run_flask_request(environ):
+def run_flask_request(environ, lease=None):
+    enqueued_at = environ.get('chimbuko.enqueued_at', None)
+    if enqueued_at is not None:
+        tracer.observe('celery.queue', time.time() - float(enqueued_at))
+    try:
+        with tracer.span('celery.dispatch'):
+            return _run_flask_request(environ)
+    finally:
+        # the request no longer counts as queued work (see admission.py)
+        admission.release(tuple(lease) if lease else None)
+
+
+def _run_flask_request(environ):
     from .wsgi_aux import app
 
     if '_wsgi.input' in environ:
@@ -74,8 +92,16 @@ def make_async(f):
         }
         if 'wsgi.input' in request.environ:
             environ['_wsgi.input'] = request.get_data()
+        environ['chimbuko.enqueued_at'] = repr(time.time())
 
-        t = run_flask_request.apply_async(args=(environ, ))
+        # shared leases are released by the task once done, the others
+        # at the end of this request
+        lease = admission.hand_over()
+        try:
+            t = run_flask_request.apply_async(args=(environ, lease))
+        except Exception:
+            admission.release(lease)
+            raise
 
         # Return a 202 response, with a link that the client can use
         # to obtain task status
@@ -91,6 +117,27 @@ def make_async(f):
     return wrapped
 
 
+@inspect_command()
+def ingest_stats(state):
+    """Report the write-behind ingest counters of a celery worker"""
+    return ingest_queue.stats()
+
+
+@worker_process_shutdown.connect
+def flush_ingest_queue(**kwargs):
+    """Write what is left in the ingest queue of a recycled worker"""
+    try:
+        ingest_queue.flush()
+    except Exception as e:
+        print('Exception on ingest flush at shutdown: ', e)
+
+
+@inspect_command()
+def trace_stats(state):
+    """Report the timing spans of a celery worker"""
+    return tracer.stats()
+
+
 @tasks_bp.route('/status/<id>', methods=['GET'])
 def get_status(id):
     """
@@ -120,6 +167,24 @@ def get_info():
         'stats': stats,
         'registered': i.registered(),
         'active': i.active(),
-        'scheduled': i.scheduled()
+        'scheduled': i.scheduled(),
+        'ingest': celery.control.broadcast('ingest_stats', reply=True)
     }
     return result
+
+
+@tasks_bp.route('/traces', methods=['GET'])
+def get_traces():
+    """
+    Return the timing spans of the ingest pipeline, aggregated by this
+    server and by each celery worker
+    """
+    try:
+        workers = celery.control.broadcast('trace_stats', reply=True)
+    except Exception as e:
+        print('Exception on /traces: ', e)
+        workers = None
+    return {
+        'server': tracer.stats(),
+        'workers': workers
+    }
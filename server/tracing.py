@@ -0,0 +1,87 @@
+"""
+Timing spans of the ingest pipeline
+
+The stages of an ingest request are wrapped in named spans, e.g.
+
+    with tracer.span('anomalydata.parse'):
+        ...
+
+and their durations are aggregated per name in the latency histograms of
+stats.py, in the process running them (the web server for the Celery
+queueing, the workers for the rest). The `created_at` of a payload gives
+the end-to-end latency from the AD module to the Socket.IO push, taken in
+TRACING_CREATED_AT_UNIT seconds (default: msec since the epoch, like
+utils.timestamp). Celery workers report their spans through the
+trace_stats remote control command, gathered at /tasks/traces.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from .stats import LatencyHistogram
+
+
+# end-to-end latencies beyond this are taken as clock or unit mismatches
+MAX_END_TO_END = 24 * 3600.  # sec
+
+
+class Tracer(object):
+    """Aggregate the durations of named spans in this process"""
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.created_at_unit = 0.001
+        self._lock = threading.Lock()
+        self._spans = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('TRACING', True)
+        self.created_at_unit = float(
+            app.config.get('TRACING_CREATED_AT_UNIT', 0.001))
+
+    def _histogram(self, name):
+        h = self._spans.get(name)
+        if h is None:
+            with self._lock:
+                h = self._spans.setdefault(name, LatencyHistogram())
+        return h
+
+    def observe(self, name, seconds):
+        if self.enabled and seconds >= 0:
+            self._histogram(name).add(seconds)
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block as span `name`"""
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    def since(self, name, created_at):
+        """Record the time elapsed since `created_at` (payload timestamp)"""
+        if created_at is None:
+            return
+        try:
+            seconds = time.time() - float(created_at) * self.created_at_unit
+        except (TypeError, ValueError):
+            return
+        if seconds <= MAX_END_TO_END:
+            self.observe(name, seconds)
+
+    def clear(self):
+        with self._lock:
+            self._spans = {}
+
+    def stats(self):
+        """Return count, mean, max and percentiles (sec) per span"""
+        return {name: h.to_dict() for name, h in sorted(self._spans.items())}
+
+
+tracer = Tracer()
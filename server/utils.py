@@ -1,5 +1,11 @@
 import time
-from flask import url_for as _url_for, current_app, _request_ctx_stack
+from flask import url_for as _url_for, current_app, _request_ctx_stack, \
+    request, json, Response, stream_with_context
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# records encoded per chunk of a streamed response
+STREAM_CHUNK_SIZE = 1000
 
 
 def timestamp():
@@ -21,3 +27,69 @@ def url_for(*args, **kwargs):
         with current_app.test_request_context():
             return _url_for(*args, **kwargs)
     return _url_for(*args, **kwargs)
+
+
+def wants_ndjson():
+    """True if the request asks for newline-delimited JSON"""
+    if request.args.get('format', None) == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def _json_array(items):
+    """Yield a JSON array of items, a chunk of records at a time"""
+    yield '['
+    chunk = []
+    first = True
+    for d in items:
+        chunk.append(json.dumps(d))
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield ('' if first else ',') + ','.join(chunk)
+            chunk = []
+            first = False
+    if len(chunk):
+        yield ('' if first else ',') + ','.join(chunk)
+    yield ']'
+
+
+def _json_object(fields: dict):
+    """Yield a JSON object whose values may be iterators of records"""
+    yield '{'
+    for i, (k, v) in enumerate(fields.items()):
+        yield '{}{}:'.format(',' if i else '', json.dumps(k))
+        if v is None or isinstance(v, (dict, str, int, float)):
+            yield json.dumps(v)
+        else:
+            yield from _json_array(v)
+    yield '}'
+
+
+def _ndjson(items):
+    chunk = []
+    for d in items:
+        chunk.append(json.dumps(d))
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if len(chunk):
+        yield '\n'.join(chunk) + '\n'
+
+
+def stream_json(data, status=200):
+    """
+    Stream a list (or any iterator of records), or a dictionary of them,
+    as a chunked JSON response without building the whole body in memory
+    """
+    if isinstance(data, dict):
+        gen = _json_object(data)
+    else:
+        gen = _json_array(data)
+    return Response(stream_with_context(gen), status=status,
+                    mimetype='application/json')
+
+
+def stream_ndjson(items, status=200):
+    """Stream an iterator of records as newline-delimited JSON"""
+    return Response(stream_with_context(_ndjson(items)), status=status,
+                    mimetype=NDJSON_MIMETYPE)
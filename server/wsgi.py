@@ -1,6 +1,7 @@
 import os
 
 from server import create_app
+from server.retention import retention
 
 
 # Create an application instance that web servers can use. We store it as
@@ -8,3 +9,5 @@ from server import create_app
 # "app".
 application = app = create_app(os.environ.get('SERVER_CONFIG', 'production'))
 
+# Only the serving process deletes old snapshots in the background
+retention.start()
@@ -337,3 +337,1195 @@ class ServerTests(unittest.TestCase):
                 else:
                     self.assertEqual(r[i][k], v)
 
+    def test_ingest_queue(self):
+        from server.ingest import ingest_queue
+        from server.models import AnomalyStat
+
+        enabled = ingest_queue.enabled
+        batch_size = ingest_queue.batch_size
+        ingest_queue.enabled = True
+        ingest_queue.batch_size = 10
+        try:
+            rows = [
+                {'app': 0, 'rank': rank, 'created_at': 1,
+                 'key': '0:{}'.format(rank), 'key_ts': '0:{}:1'.format(rank)}
+                for rank in range(4)
+            ]
+            ingest_queue.put('anomaly_stats', rows)
+            self.assertEqual(ingest_queue.stats()['queue_depth'], 4)
+            self.assertEqual(AnomalyStat.query.count(), 0)
+
+            # reaching the batch size triggers a group commit
+            ingest_queue.put('anomaly_stats', rows + rows)
+            self.assertEqual(ingest_queue.stats()['queue_depth'], 0)
+            self.assertEqual(AnomalyStat.query.count(), 12)
+
+            # a bad row only loses the rows sent with it, which are dropped
+            # instead of failing the next flushes
+            ingest_queue.put('anomaly_stats', rows[:2])
+            ingest_queue.put('anomaly_stats', [{'app': object()}])
+            ingest_queue.put('anomaly_stats', rows[2:])
+            ingest_queue.flush()
+            stats = ingest_queue.stats()
+            self.assertEqual(stats['queue_depth'], 0)
+            self.assertEqual(stats['n_dropped'], 1)
+            self.assertEqual(stats['n_dead_letters'], 1)
+            self.assertEqual(AnomalyStat.query.count(), 16)
+
+            ingest_queue.put('anomaly_stats', rows)
+            ingest_queue.flush()
+            self.assertEqual(AnomalyStat.query.count(), 20)
+            self.assertEqual(ingest_queue.stats()['n_dropped'], 1)
+
+            # without write-behind, the request owning the rows gets the error
+            ingest_queue.enabled = False
+            with self.assertRaises(Exception):
+                ingest_queue.put('anomaly_stats', [{'app': object()}])
+        finally:
+            ingest_queue.flush()
+            ingest_queue.enabled = enabled
+            ingest_queue.batch_size = batch_size
+
+    def test_ingest_group_commit(self):
+        from sqlalchemy import event
+        from server.ingest import ingest_queue
+        from server.models import AnomalyStat
+
+        def payload(ts):
+            return {'created_at': ts, 'anomaly': [{
+                'key': '0:{}'.format(rank),
+                'stats': {'count': 1, 'mean': 1.},
+                'data': []
+            } for rank in range(2)]}
+
+        engine = db.get_engine(app=ingest_queue.app, bind='anomaly_stats')
+        commits = []
+
+        def on_commit(conn):
+            commits.append(conn)
+
+        enabled = ingest_queue.enabled
+        batch_size = ingest_queue.batch_size
+        ingest_queue.enabled = True
+        ingest_queue.batch_size = 1000
+        event.listen(engine, 'commit', on_commit)
+        try:
+            # requests are acknowledged once their rows are queued
+            for ts in range(3):
+                r, s, h = self.post('/api/anomalydata', payload(ts))
+                self.assertIn(s, (201, 202))
+            self.assertEqual(ingest_queue.stats()['queue_depth'], 6)
+            self.assertEqual(AnomalyStat.query.count(), 0)
+
+            # and committed together
+            ingest_queue.flush()
+            self.assertEqual(len(commits), 1)
+            self.assertEqual(AnomalyStat.query.count(), 6)
+        finally:
+            event.remove(engine, 'commit', on_commit)
+            ingest_queue.flush()
+            ingest_queue.enabled = enabled
+            ingest_queue.batch_size = batch_size
+
+    def test_anomalydata_columns(self):
+        import msgpack
+        from server.models import AnomalyStat, AnomalyData, FuncStat
+
+        n_ranks = 4
+        payload = {
+            'created_at': 123,
+            'anomaly': {
+                'app': [0] * n_ranks,
+                'rank': list(range(n_ranks)),
+                'count': [10, 20, 30, 40],
+                'stddev': [1.5, 0.5, 3.0, 2.0]
+            },
+            'data': {
+                'app': [0] * n_ranks,
+                'rank': list(range(n_ranks)),
+                'step': [7] * n_ranks,
+                'min_timestamp': [100, 101, 102, 103],
+                'max_timestamp': [200, 201, 202, 203],
+                'n_anomalies': [1, 2, 3, 4]
+            },
+            'func': {
+                'fid': [0, 1],
+                'name': ['func 0', 'func 1'],
+                'a_count': [5, 6],
+                'i_mean': [1.0, 2.0]
+            }
+        }
+        rv = self.client.post('/api/anomalydata',
+                              data=msgpack.packb(payload),
+                              content_type='application/x-msgpack')
+        self.assertIn(rv.status_code, (201, 202))
+
+        stats = AnomalyStat.query.order_by(AnomalyStat.rank).all()
+        self.assertEqual(len(stats), n_ranks)
+        for i, st in enumerate(stats):
+            self.assertEqual(st.key_ts, '0:{}:123'.format(i))
+            self.assertEqual(st.stddev, payload['anomaly']['stddev'][i])
+            self.assertEqual(st.mean, 0)
+
+        data = AnomalyData.query.order_by(AnomalyData.rank).all()
+        self.assertEqual([d.n_anomalies for d in data], [1, 2, 3, 4])
+
+        funcs = FuncStat.query.order_by(FuncStat.fid).all()
+        self.assertEqual([f.name for f in funcs], ['func 0', 'func 1'])
+        self.assertEqual(funcs[1].i_mean, 2.0)
+
+        # the ranking takes the column batch as it is
+        from server.ranking import ranking
+        ranked = {(d['app'], d['rank']): d
+                  for d in ranking.top('stddev', len(ranking))}
+        self.assertEqual(ranked[(0, 2)]['stddev'], 3.0)
+        self.assertEqual(ranked[(0, 2)]['count'], 30)
+
+        # arrays of different lengths are rejected (400 as task result)
+        from werkzeug.exceptions import BadRequest
+        from server.api.anomalystats import new_anomalydata_columns
+        payload['data']['step'] = [8] * (n_ranks - 1)
+        with self.app.test_request_context(
+                '/api/anomalydata', method='POST',
+                data=msgpack.packb(payload),
+                content_type='application/x-msgpack'):
+            with self.assertRaises(BadRequest):
+                new_anomalydata_columns()
+        self.assertEqual(AnomalyData.query.count(), n_ranks)
+
+        # and so are steps without their step numbers
+        del payload['data']['step']
+        with self.app.test_request_context(
+                '/api/anomalydata', method='POST',
+                data=msgpack.packb(payload),
+                content_type='application/x-msgpack'):
+            with self.assertRaises(BadRequest):
+                new_anomalydata_columns()
+
+        # and so is a body that isn't a map
+        with self.app.test_request_context(
+                '/api/anomalydata', method='POST',
+                data=msgpack.packb([1, 2]),
+                content_type='application/x-msgpack'):
+            with self.assertRaises(BadRequest):
+                new_anomalydata_columns()
+
+        # the columns that are not given take their default value
+        self.assertEqual(stats[0].created_at, 123)
+        self.assertIsNotNone(stats[0].updated_at)
+        self.assertEqual(data[0].step, 7)
+
+    def test_latest_stats(self):
+        from server.ingest import ingest_queue, rebuild_latest
+        from server.models import AnomalyStatLatest
+
+        def rows(ts):
+            return [
+                {'app': 0, 'rank': rank, 'created_at': ts, 'stddev': ts + rank,
+                 'key': '0:{}'.format(rank),
+                 'key_ts': '0:{}:{}'.format(rank, ts)}
+                for rank in range(3)
+            ]
+
+        ingest_queue.put('anomaly_stats', rows(1))
+        ingest_queue.put('anomaly_stats', rows(2))
+        ingest_queue.put_columns('anomaly_stats', {
+            'app': [0], 'rank': [1], 'created_at': [3], 'stddev': [30.],
+            'key': ['0:1'], 'key_ts': ['0:1:3']
+        })
+
+        latest = AnomalyStatLatest.query.order_by(AnomalyStatLatest.rank).all()
+        self.assertEqual([st.created_at for st in latest], [2, 3, 2])
+        self.assertEqual(latest[1].stddev, 30.)
+
+        # a delayed older snapshot doesn't replace the newer one
+        ingest_queue.put('anomaly_stats', rows(1))
+        ingest_queue.put_columns('anomaly_stats', {
+            'app': [0], 'rank': [1], 'created_at': [2], 'stddev': [99.],
+            'key': ['0:1'], 'key_ts': ['0:1:2']
+        })
+        latest = AnomalyStatLatest.query.order_by(AnomalyStatLatest.rank).all()
+        self.assertEqual([st.created_at for st in latest], [2, 3, 2])
+        self.assertEqual(latest[1].stddev, 30.)
+
+        rebuild_latest(self.app)
+        db.session.expire_all()  # rows were replaced under new ids
+        latest = AnomalyStatLatest.query.order_by(AnomalyStatLatest.rank).all()
+        self.assertEqual([st.created_at for st in latest], [2, 3, 2])
+
+    def test_ranking(self):
+        import random
+        from server.ranking import LocalRanking
+
+        ranking = LocalRanking()
+        current = {}
+        for _ in range(20):
+            rows = [{'app': 0, 'rank': random.randint(0, 49),
+                     'stddev': random.random()} for _ in range(10)]
+            ranking.update(rows)
+            current.update({row['rank']: row for row in rows})
+
+            expected = sorted(current.values(),
+                              key=lambda d: (d['stddev'], d['rank']),
+                              reverse=True)
+            self.assertEqual(len(ranking), len(current))
+            self.assertEqual(ranking.top('stddev', 5), expected[:5])
+            self.assertEqual(ranking.bottom('stddev', 5), expected[-5:])
+
+        # a delayed older snapshot doesn't replace the newer one
+        ranking = LocalRanking()
+        ranking.update([{'app': 0, 'rank': 0, 'created_at': 2, 'stddev': 1.}])
+        ranking.update([{'app': 0, 'rank': 0, 'created_at': 1, 'stddev': 9.}])
+        ranking.update_columns({'app': [0], 'rank': [0], 'created_at': [1],
+                                'stddev': [8.]})
+        self.assertEqual(ranking.top('stddev', 1)[0]['stddev'], 1.)
+        ranking.update_columns({'app': [0], 'rank': [0], 'created_at': [2],
+                                'stddev': [3.]})
+        self.assertEqual(ranking.top('stddev', 1)[0]['stddev'], 3.)
+        self.assertEqual(ranking.bottom('stddev', 1)[0]['stddev'], 3.)
+
+        # the in-process fallback is reported when tasks run in workers
+        from flask import Flask
+        from server.ranking import Ranking
+        app = Flask('ranking')
+        app.config.update(RANKING_REDIS_URL=None, CELERY_CONFIG={})
+        with self.assertLogs(app.logger, 'WARNING'):
+            Ranking(app)
+
+    def test_stat_query_cache(self):
+        from server import socketio
+        from server.statquery import stat_query
+
+        q = stat_query.get()
+        self.assertIs(stat_query.get(), q)
+        self.assertEqual(q.ranks, frozenset())
+        self.assertEqual(q.statKind, 'stddev')
+
+        client = socketio.test_client(self.app, namespace='/events')
+        client.emit('query_stats',
+                    {'nQueries': 3, 'statKind': 'mean', 'ranks': [1, 2]},
+                    namespace='/events')
+
+        q = stat_query.get()
+        self.assertEqual(q.nQueries, 3)
+        self.assertEqual(q.statKind, 'mean')
+        self.assertEqual(q.ranks, frozenset([(0, 1), (0, 2)]))
+
+        # the ranks of a session are dropped when it leaves
+        client.disconnect(namespace='/events')
+        q = stat_query.get()
+        self.assertEqual(q.statKind, 'mean')
+        self.assertEqual(q.ranks, frozenset())
+
+        # conditions stored with plain ranks watch them in app 0
+        from server.statquery import ActiveQuery
+        self.assertEqual(ActiveQuery(5, 'stddev', [1, [2, 3]]).ranks,
+                         frozenset([(0, 1), (2, 3)]))
+
+    def test_retention(self):
+        from server.ingest import ingest_queue
+        from server.retention import RetentionService
+        from server.models import AnomalyStat, FuncStat
+
+        for ts in range(1, 6):
+            ingest_queue.put('anomaly_stats', [
+                {'app': 0, 'rank': rank, 'created_at': ts}
+                for rank in range(2)
+            ])
+            ingest_queue.put('func_stats', [{'fid': 0, 'created_at': ts}])
+
+        retention = RetentionService()
+        self.app.config.update({
+            'RETENTION_KEEP_SNAPSHOTS': 2,
+            'RETENTION_CHUNK_SIZE': 3
+        })
+        retention.init_app(self.app)
+        report = retention.run_once()
+        self.assertEqual(report['deleted'],
+                         {'anomaly_stats': 6, 'func_stats': 3})
+        self.assertEqual(
+            sorted((st.rank, st.created_at) for st in AnomalyStat.query.all()),
+            [(0, 4), (0, 5), (1, 4), (1, 5)])
+
+        self.app.config.update({
+            'RETENTION_KEEP_SNAPSHOTS': None,
+            'RETENTION_WINDOW': 0
+        })
+        retention.init_app(self.app)
+        retention.run_once()
+        self.assertEqual(
+            [st.created_at for st in FuncStat.query.all()], [5])
+        self.assertEqual(retention.stats()['n_deleted']['func_stats'], 4)
+
+    def test_anomaly_rollups(self):
+        from server.ingest import ingest_queue
+        from server.rollup import rebuild_rollups
+        from server.models import AnomalyDataRollup
+
+        ingest_queue.put('anomaly_data', [
+            {'app': 0, 'rank': 1, 'step': step, 'n_anomalies': step % 5,
+             'min_timestamp': step * 10, 'max_timestamp': step * 10 + 5}
+            for step in range(0, 300)
+        ])
+        ingest_queue.put_columns('anomaly_data', {
+            'app': [0] * 212, 'rank': [1] * 212,
+            'step': list(range(300, 512)),
+            'n_anomalies': [step % 5 for step in range(300, 512)],
+            'min_timestamp': [step * 10 for step in range(300, 512)],
+            'max_timestamp': [step * 10 + 5 for step in range(300, 512)]
+        })
+
+        r, s, h = self.get('/api/get_anomalyhistory?app=0&rank=1&points=20')
+        self.assertEqual(s, 200)
+        self.assertEqual(r['resolution'], 16)
+        self.assertEqual(len(r['data']), 32)
+        bucket = r['data'][1]
+        self.assertEqual(bucket['step'], 16)
+        self.assertEqual(bucket['n_steps'], 16)
+        self.assertEqual(bucket['n_anomalies'],
+                         sum(step % 5 for step in range(16, 32)))
+        self.assertEqual(bucket['max_anomalies'], 4)
+        self.assertEqual(bucket['min_timestamp'], 160)
+        self.assertEqual(bucket['max_timestamp'], 315)
+
+        r, s, h = self.get('/api/get_anomalyhistory?app=0&rank=1&points=2')
+        self.assertEqual(r['resolution'], 256)
+        self.assertEqual([d['n_steps'] for d in r['data']], [256, 256])
+
+        r, s, h = self.get(
+            '/api/get_anomalyhistory?app=0&rank=1&points=100&min_step=10&max_step=59')
+        self.assertEqual(r['resolution'], 1)
+        self.assertEqual(len(r['data']), 50)
+
+        n_rollups = AnomalyDataRollup.query.count()
+        rebuild_rollups(self.app, self.app.config['ROLLUP_RESOLUTIONS'])
+        self.assertEqual(AnomalyDataRollup.query.count(), n_rollups)
+
+        def bucket(step, resolution=16):
+            db.session.expire_all()
+            return AnomalyDataRollup.query.filter_by(
+                app=0, rank=1, resolution=resolution,
+                bucket=step // resolution).one()
+
+        # a step posted again replaces the previous one
+        ingest_queue.put('anomaly_data', [
+            {'app': 0, 'rank': 1, 'step': 17, 'n_anomalies': 100,
+             'min_timestamp': 170, 'max_timestamp': 175}])
+        expected = sum(step % 5 for step in range(16, 32)) - 2 + 100
+        for resolution in (16, 256):
+            b = bucket(17, resolution)
+            self.assertEqual(b.n_steps, resolution)
+            self.assertEqual(b.max_anomalies, 100)
+        self.assertEqual(bucket(17).sum_anomalies, expected)
+        self.assertEqual(bucket(17).min_timestamp, 160)
+        r, s, h = self.get(
+            '/api/get_anomalyhistory?app=0&rank=1&points=100&min_step=10&max_step=59')
+        self.assertEqual([d['step'] for d in r['data']], list(range(10, 60)))
+        self.assertEqual(r['data'][7]['n_anomalies'], 100)
+
+        # column batches without steps are not rolled up as step 0
+        from server.rollup import flush_steps
+        with self.assertRaises(ValueError):
+            flush_steps([], [{'rank': [1], 'n_anomalies': [1]}])
+
+        # missing timestamps don't drag the minimum to 0
+        ingest_queue.put('anomaly_data', [
+            {'app': 0, 'rank': 1, 'step': 512, 'n_anomalies': 1,
+             'min_timestamp': 5120, 'max_timestamp': 5125}])
+        ingest_queue.put('anomaly_data', [
+            {'app': 0, 'rank': 1, 'step': 513, 'n_anomalies': 1}])
+        self.assertEqual(bucket(513).min_timestamp, 5120)
+        self.assertEqual(bucket(513).n_steps, 2)
+        from server.models import AnomalyData
+        self.assertEqual(
+            AnomalyData.query.filter_by(step=513).one().min_timestamp, 0)
+
+        rebuild_rollups(self.app, self.app.config['ROLLUP_RESOLUTIONS'])
+        self.assertEqual(bucket(17).sum_anomalies, expected)
+        self.assertEqual(bucket(513).min_timestamp, 5120)
+
+        # re-posts are looked up per (app, rank), in chunks of ranks
+        def rows(ranks, n):
+            return [{'app': 1, 'rank': rank, 'step': 17, 'n_anomalies': n}
+                    for rank in ranks]
+        ingest_queue.put('anomaly_data', rows(range(1200), 1))
+        ingest_queue.put('anomaly_data', rows([1, 1199], 2))
+        db.session.expire_all()
+        for rank in (1, 1199):
+            b = AnomalyDataRollup.query.filter_by(
+                app=1, rank=rank, resolution=16, bucket=1).one()
+            self.assertEqual((b.n_steps, b.sum_anomalies), (1, 2))
+        self.assertEqual(bucket(17).sum_anomalies, expected)
+
+    def test_query_history(self):
+        from server.ingest import ingest_queue
+
+        n_ranks = 1000
+        ingest_queue.put('anomaly_data', [
+            {'app': 0, 'rank': rank, 'step': step, 'n_anomalies': rank + step}
+            for rank in range(0, n_ranks, 2) for step in range(3)
+        ])
+
+        ranks = list(range(n_ranks))
+        r, s, h = self.post('/events/query_history',
+                            {'qRanks': ranks, 'last_step': 1})
+        self.assertEqual(s, 200)
+        self.assertEqual(len(r), n_ranks)
+        for rank, d in zip(ranks, r):
+            if rank % 2:
+                self.assertEqual(d['id'], -1)
+                self.assertEqual(d['step'], 1)
+            else:
+                self.assertEqual(d['rank'], rank)
+                self.assertEqual(d['step'], 2)
+                self.assertEqual(d['n_anomalies'], rank + 2)
+
+    def test_execution_store(self):
+        import os
+        import tempfile
+        from server.execstore import ExecutionStore, RankStore, \
+            execution_store
+        from server.wsgi_aux import app as aux_app
+
+        execdata = [
+            {'key': 'exec {}'.format(i), 'name': 'func {}'.format(i % 3),
+             'pid': 0, 'rid': 1, 'tid': 0, 'fid': i % 3,
+             'entry': 100 - i, 'exit': 200 + i, 'runtime': 100 + 2 * i,
+             'exclusive': 10, 'label': 1 if i % 4 else -1,
+             'parent': 'exec {}'.format(i - 1) if i else 'root',
+             'n_children': 1, 'n_messages': 0}
+            for i in range(10)
+        ]
+        commdata = [
+            {'type': 'SEND', 'pid': 0, 'rid': 1, 'tid': 0, 'src': 1,
+             'tar': 2, 'bytes': 64, 'tag': 0, 'timestamp': 150, 'fid': 0,
+             'name': 'func 0', 'execdata_key': 'exec 0'}
+        ]
+
+        with tempfile.TemporaryDirectory() as path:
+            # posts are dispatched to the celery app
+            for app in (self.app, aux_app):
+                app.config.update({'EXECUTION_PATH': path,
+                                   'EXECUTION_SEGMENT_SIZE': 2048})
+            for step in range(3):
+                r, s, h = self.post('/api/executions', {
+                    'app': 0, 'rank': 1, 'step': step,
+                    'exec': execdata, 'comm': commdata})
+                self.assertEqual(s, 201)
+
+            # a step that doesn't fit the records is kept as json
+            odd = [{'key': 'x', 'entry': 1.5, 'extra': [1, 2]}]
+            execution_store.write_step(0, 1, 3, odd, [])
+            # a rewritten step replaces the previous one
+            execution_store.write_step(0, 1, 2, execdata[:2], [])
+
+            r, s, h = self.get(
+                '/events/query_executions_file?pid=0&rid=1&step=1')
+            self.assertEqual(s, 200)
+            self.assertEqual(r['exec'],
+                             sorted(execdata, key=lambda d: d['entry']))
+            self.assertEqual(r['comm'], commdata)
+
+            # read back by another process with an empty cache
+            store = ExecutionStore()
+            self.assertEqual(store.rank(0, 1).steps(), [0, 1, 2, 3])
+            self.assertEqual(store.read_step(0, 1, 2), (execdata[:2], []))
+            self.assertEqual(store.read_step(0, 1, 3), (odd, []))
+            self.assertIsNone(store.read_step(0, 1, 4))
+            self.assertGreater(store.rank(0, 1).entry(2)[1], 0)
+
+            # the dictionary only holds the names, keys stay with the step
+            with open(os.path.join(path, '0', '1', 'strings.jsonl')) as f:
+                self.assertEqual(sorted(json.loads(line) for line in f),
+                                 ['SEND', 'func 0', 'func 1', 'func 2'])
+
+            # a line cut by a crashed writer is dropped by the next write
+            with open(os.path.join(path, '0', '1', 'strings.jsonl'),
+                      'a') as f:
+                f.write('"func')
+            renamed = [dict(d, name='func 9') for d in execdata]
+            store.rank(0, 1).write(4, renamed, commdata)
+            store = ExecutionStore()
+            self.assertEqual(store.read_step(0, 1, 4), (renamed, commdata))
+            self.assertEqual(store.read_step(0, 1, 1), (execdata, commdata))
+
+            # an empty first step is stored as an empty blob
+            empty = RankStore(os.path.join(path, 'empty'), 2048)
+            empty.write(0, [], [], None, None)
+            self.assertEqual(empty.read(0), ([], []))
+            with empty.open_step(0) as view:
+                self.assertEqual(view.index.roots(), [])
+            execution_store.write_step(0, 2, 0, [], [])
+            r, s, h = self.get(
+                '/events/query_executions_file?pid=0&rid=2&step=0')
+            self.assertEqual(s, 200)
+            self.assertEqual((r['exec'], r['comm']), ([], []))
+
+        for app in (self.app, aux_app):
+            app.config['EXECUTION_PATH'] = None
+        execution_store.clear()
+
+        # the stores of the least recently used ranks are let go
+        with tempfile.TemporaryDirectory() as path:
+            self.app.config.update({'EXECUTION_PATH': path,
+                                    'EXECUTION_OPEN_RANKS': 2})
+            for rank in range(3):
+                execution_store.write_step(0, rank, 0, execdata, [])
+            self.assertEqual(len(execution_store._ranks), 2)
+            self.assertEqual(execution_store.read_step(0, 0, 0),
+                             (execdata, []))
+        self.app.config.update({'EXECUTION_PATH': None,
+                                'EXECUTION_OPEN_RANKS': 1024})
+        execution_store.clear()
+
+    def test_execution_cache(self):
+        import tempfile
+        from server.execcache import step_cache
+        from server.wsgi_aux import app as aux_app
+
+        def payload(step, n):
+            return {'app': 0, 'rank': 0, 'step': step, 'comm': [], 'exec': [
+                {'key': 'e{}'.format(i), 'entry': (i * 7) % n, 'exit': n}
+                for i in range(n)]}
+
+        with tempfile.TemporaryDirectory() as path:
+            for app in (self.app, aux_app):
+                app.config['EXECUTION_PATH'] = path
+            step_cache.clear()
+            self.post('/api/executions', payload(0, 5))
+            self.post('/api/executions', payload(1, 5))
+
+            stats = step_cache.stats()
+            url = '/events/query_executions_file?pid=0&rid=0&step={}&order={}'
+            r, s, h = self.get(url.format(0, 'asc'))
+            self.assertEqual([d['entry'] for d in r['exec']], [0, 1, 2, 3, 4])
+            r, s, h = self.get(url.format(0, 'desc'))
+            self.assertEqual([d['entry'] for d in r['exec']], [4, 3, 2, 1, 0])
+            self.get(url.format(1, 'asc'))
+            self.assertEqual(step_cache.stats()['n_hits'] - stats['n_hits'], 1)
+            self.assertEqual(
+                step_cache.stats()['n_misses'] - stats['n_misses'], 2)
+
+            # a rewritten step is read again
+            self.post('/api/executions', payload(0, 3))
+            r, s, h = self.get(url.format(0, 'asc'))
+            self.assertEqual(len(r['exec']), 3)
+
+            # least recently used steps are evicted beyond the capacity
+            capacity = step_cache.capacity
+            step_cache.capacity = step_cache.stats()['size']
+            self.get(url.format(1, 'asc'))
+            self.post('/api/executions', payload(2, 5))
+            self.get(url.format(2, 'asc'))
+            self.assertGreater(step_cache.stats()['n_evictions'], 0)
+            self.assertLessEqual(step_cache.stats()['size'], step_cache.capacity)
+            step_cache.capacity = capacity
+
+            r, s, h = self.get('/stats')
+            self.assertIn('execution_cache', r)
+
+        for app in (self.app, aux_app):
+            app.config['EXECUTION_PATH'] = None
+        step_cache.clear()
+
+        # charged by decoded size, growing with the number of records
+        from server.execcache import CachedStep
+        small = CachedStep(payload(0, 100)['exec'], []).footprint()
+        large = CachedStep(payload(0, 1000)['exec'], []).footprint()
+        self.assertGreater(small, 100 * 100)
+        self.assertAlmostEqual(large / small, 10., delta=1.)
+
+    def test_execution_time_range(self):
+        import tempfile
+        from server.execstore import execution_store
+        from server.execcache import step_cache
+
+        with tempfile.TemporaryDirectory() as path:
+            self.app.config['EXECUTION_PATH'] = path
+            # step s covers [100 s, 100 s + 120], overlapping the next one
+            for step in range(10):
+                execution_store.write_step(0, 1, step, [
+                    {'key': '{}-{}'.format(step, i), 'entry': 100 * step + i,
+                     'exit': 100 * step + 20 * i + 40}
+                    for i in range(5)
+                ], [{'type': 'SEND', 'timestamp': 100 * step + 50}])
+
+            self.assertEqual(execution_store.overlapping(0, 1, 210, 310),
+                             [1, 2, 3])
+            self.assertEqual(execution_store.overlapping(0, 1, 2000, 3000), [])
+
+            r, s, h = self.get(
+                '/events/query_executions_file?pid=0&rid=1&min_ts=250&max_ts=310')
+            self.assertEqual(s, 200)
+            self.assertEqual([d['key'] for d in r['exec']],
+                             ['2-1', '2-2', '2-3', '2-4',
+                              '3-0', '3-1', '3-2', '3-3', '3-4'])
+            self.assertEqual([d['timestamp'] for d in r['comm']], [250])
+
+            r, s, h = self.get(
+                '/events/query_executions_file?pid=0&rid=1&step=2&min_ts=280')
+            self.assertEqual([d['key'] for d in r['exec']],
+                             ['2-2', '2-3', '2-4'])
+
+            # a step rewritten without executions leaves the time index,
+            # also for a process reading the store afresh
+            execution_store.write_step(0, 1, 2, [], [])
+            self.assertEqual(execution_store.overlapping(0, 1, 210, 310),
+                             [1, 3])
+            execution_store.clear()
+            self.assertEqual(execution_store.overlapping(0, 1, 210, 310),
+                             [1, 3])
+
+        self.app.config['EXECUTION_PATH'] = None
+        execution_store.clear()
+        step_cache.clear()
+
+    def test_execution_compression(self):
+        import os
+        import tempfile
+        from server.execstore import execution_store
+        from server.execcache import step_cache
+        from server.wsgi_aux import app as aux_app
+
+        execdata = [{'key': 'e{}'.format(i), 'name': 'func', 'entry': i,
+                     'exit': i + 10} for i in range(100)]
+        url = '/events/query_executions_file?pid=0&rid=0&step={}'
+
+        for fmt in ('segment', 'json'):
+            with tempfile.TemporaryDirectory() as path:
+                for app in (self.app, aux_app):
+                    app.config.update({'EXECUTION_PATH': path,
+                                       'EXECUTION_FORMAT': fmt,
+                                       'EXECUTION_COMPRESSION': 'gzip'})
+                self.post('/api/executions', {
+                    'app': 0, 'rank': 0, 'step': 0,
+                    'exec': execdata, 'comm': []})
+                if fmt == 'json':
+                    self.assertEqual(os.listdir(os.path.join(path, '0', '0')),
+                                     ['0.json.gz'])
+
+                # readable whatever the current setting is
+                for app in (self.app, aux_app):
+                    app.config['EXECUTION_COMPRESSION'] = None
+                r, s, h = self.get(url.format(0))
+                self.assertEqual(r['exec'], execdata)
+
+        for app in (self.app, aux_app):
+            app.config.update({'EXECUTION_PATH': None,
+                               'EXECUTION_FORMAT': 'segment'})
+        execution_store.clear()
+        step_cache.clear()
+
+    def test_streaming_responses(self):
+        from server import utils
+        from server.models import ExecData
+
+        db.session.add_all([
+            ExecData(key='e{}'.format(i), rid=i % 2, entry=i, exit=i + 5)
+            for i in range(25)
+        ])
+        db.session.commit()
+
+        chunk_size = utils.STREAM_CHUNK_SIZE
+        utils.STREAM_CHUNK_SIZE = 4
+        try:
+            rv = self.client.get('/api/get_executions?min_ts=3&rid=1',
+                                 headers=self.get_headers())
+            self.assertTrue(rv.is_streamed)
+            r = json.loads(rv.get_data(as_text=True))
+            self.assertEqual([d['key'] for d in r],
+                             ['e{}'.format(i) for i in range(3, 25, 2)])
+
+            rv = self.client.get(
+                '/api/get_executions?min_ts=0&order=desc&format=ndjson')
+            self.assertEqual(rv.mimetype, 'application/x-ndjson')
+            lines = rv.get_data(as_text=True).splitlines()
+            self.assertEqual(len(lines), 25)
+            self.assertEqual(json.loads(lines[0])['key'], 'e24')
+
+            r, s, h = self.get('/api/get_executions?min_ts=100')
+            self.assertEqual(r, [])
+
+            r, s, h = self.get('/events/query_executions_file?pid=0&rid=0&step=0')
+            self.assertEqual(r, {'exec': [], 'comm': []})
+        finally:
+            utils.STREAM_CHUNK_SIZE = chunk_size
+
+    def test_execution_pagination(self):
+        from server.models import ExecData
+
+        # entries with ties, so that pages have to break them by id
+        db.session.add_all([
+            ExecData(key='e{}'.format(i), entry=i // 3, exit=i)
+            for i in range(20)
+        ])
+        db.session.commit()
+
+        for order in ('asc', 'desc'):
+            keys, cursor, n_pages = [], None, 0
+            while True:
+                url = '/api/get_executions?min_ts=0&limit=6&order=' + order
+                if cursor is not None:
+                    url += '&cursor=' + cursor
+                r, s, h = self.get(url)
+                self.assertEqual(s, 200)
+                keys += [d['key'] for d in r]
+                n_pages += 1
+                cursor = h.get('X-Next-Cursor')
+                if cursor is None:
+                    break
+
+            expected = ['e{}'.format(i) for i in range(20)]
+            if order == 'desc':
+                expected.reverse()
+            self.assertEqual(keys, expected)
+            self.assertEqual(n_pages, 4)
+
+        r, s, h = self.get('/api/get_executions?min_ts=0&cursor=nope')
+        self.assertEqual(s, 400)
+        r, s, h = self.get('/events/query_executions?min_ts=0&cursor=nope')
+        self.assertEqual(s, 400)
+
+    def test_cct(self):
+        import tempfile
+        from server.execstore import execution_store
+        from server.execcache import step_cache
+        from server.cct import merge_cct
+        from server.events import load_execution_step
+
+        def call(key, name, parent, entry, runtime, exclusive, label=1):
+            return {'key': key, 'name': name, 'parent': parent,
+                    'entry': entry, 'exit': entry + runtime,
+                    'runtime': runtime, 'exclusive': exclusive,
+                    'label': label}
+
+        with tempfile.TemporaryDirectory() as path:
+            self.app.config['EXECUTION_PATH'] = path
+            # main -> solve -> send (x2), main -> send; children listed first
+            execution_store.write_step(0, 1, 0, [
+                call('c', 'send', 'b', 2, 5, 5, -1),
+                call('d', 'send', 'b', 10, 5, 5),
+                call('b', 'solve', 'a', 1, 20, 10),
+                call('e', 'send', 'a', 30, 3, 3),
+                call('a', 'main', 'root', 0, 40, 17),
+            ], [])
+            # a call whose parent started in a previous step
+            execution_store.write_step(0, 1, 1, [
+                call('f', 'send', 'b', 50, 4, 4, -1),
+            ], [])
+
+            r, s, h = self.get('/events/query_cct?pid=0&rid=1&step=0')
+            self.assertEqual(s, 200)
+            self.assertEqual(r['count'], 5)
+            main = r['children'][0]
+            self.assertEqual((main['path'], main['inclusive']), ('main', 40))
+            solve, send = main['children']
+            self.assertEqual(solve['path'], 'main/solve')
+            self.assertEqual(send['path'], 'main/send')
+            leaf = solve['children'][0]
+            self.assertEqual(leaf['path'], 'main/solve/send')
+            self.assertEqual((leaf['count'], leaf['inclusive'],
+                              leaf['n_anomalies']), (2, 10, 1))
+
+            r, s, h = self.post('/events/query_cct?max_depth=1', {'units': [
+                {'pid': 0, 'rid': 1, 'step': 0},
+                {'pid': 0, 'rid': 1, 'step': 1}]})
+            self.assertEqual(r['count'], 6)
+            self.assertEqual(r['n_anomalies'], 2)
+            self.assertEqual([c['name'] for c in r['children']],
+                             ['main', 'send'])
+            self.assertNotIn('children', r['children'][0])
+
+            r, s, h = self.get('/events/query_cct?pid=0&rid=1')
+            self.assertEqual(s, 400)
+            r, s, h = self.get('/events/query_cct?pid=0&rid=1&step=7')
+            self.assertEqual(s, 404)
+
+            # a call stack deeper than the recursion limit
+            depth = 5000
+            execution_store.write_step(0, 1, 2, [
+                call(str(i), 'f{}'.format(i % 3), str(i - 1), i, 1, 1)
+                for i in range(depth)], [])
+            tree = load_execution_step(0, 1, 2).cct()
+            self.assertEqual(tree.size(), depth + 1)
+            merged = merge_cct([tree, tree])
+            self.assertEqual(merged.size(), depth + 1)
+            self.assertEqual(merged.count, 2 * depth)
+            d = merged.to_dict()
+            for _ in range(depth):
+                d = d['children'][0]
+            self.assertEqual((d['path'].count('/'), d['count']),
+                             (depth - 1, 2))
+            self.assertEqual(len(merged.to_dict(max_depth=2)['children']), 1)
+
+            r, s, h = self.get('/events/query_cct?pid=0&rid=1&step=2')
+            self.assertEqual(s, 200)
+            self.assertEqual(r.count('"count": 1,'), depth)
+            self.assertTrue(r.endswith(']}' * (depth + 1)))
+
+        self.app.config['EXECUTION_PATH'] = None
+        execution_store.clear()
+        step_cache.clear()
+
+    def test_subtree(self):
+        import tempfile
+        from server.execstore import execution_store
+        from server.execcache import step_cache
+        from server.wsgi_aux import app as aux_app
+
+        # binary tree of 31 calls: i has children 2i+1, 2i+2, stored
+        # in reverse order, the second child entering first
+        execdata = [{
+            'key': 'k{}'.format(i),
+            'parent': 'k{}'.format((i - 1) // 2) if i else 'root',
+            'entry': 100 - i if i % 2 == 0 else 100 + i,
+            'exit': 1000
+        } for i in range(31)][::-1]
+
+        url = '/events/query_subtree?pid=0&rid=0&step={}&key={}'
+        for fmt in ('segment', 'json'):
+            with tempfile.TemporaryDirectory() as path:
+                for app in (self.app, aux_app):
+                    app.config.update({'EXECUTION_PATH': path,
+                                       'EXECUTION_FORMAT': fmt})
+                self.post('/api/executions', {
+                    'app': 0, 'rank': 0, 'step': 0,
+                    'exec': execdata, 'comm': []})
+
+                r, s, h = self.get(url.format(0, 'k1'))
+                self.assertEqual(s, 200)
+                self.assertEqual(r['n_nodes'], 15)
+                tree = r['tree']
+                self.assertEqual(tree['key'], 'k1')
+                self.assertEqual([c['key'] for c in tree['children']],
+                                 ['k4', 'k3'])
+                self.assertEqual(tree['children'][0]['children'][0]['depth'], 2)
+
+                r, s, h = self.get(url.format(0, 'k0') + '&max_depth=1')
+                self.assertEqual(r['n_nodes'], 3)
+                self.assertTrue(r['tree']['children'][0]['truncated'])
+
+                r, s, h = self.get(url.format(0, 'k0') + '&max_nodes=5')
+                self.assertEqual(r['n_nodes'], 5)
+
+                r, s, h = self.get(url.format(0, 'nope'))
+                self.assertEqual(s, 404)
+
+        for app in (self.app, aux_app):
+            app.config.update({'EXECUTION_PATH': None,
+                               'EXECUTION_FORMAT': 'segment'})
+        execution_store.clear()
+        step_cache.clear()
+
+    def test_comm_matrix(self):
+        def comm(src, tar, size, ts, type='SEND'):
+            return {'type': type, 'src': src, 'tar': tar, 'bytes': size,
+                    'timestamp': ts}
+
+        for rank in range(2):
+            self.post('/api/executions', {
+                'app': 0, 'rank': rank, 'step': 0, 'exec': [], 'comm': [
+                    comm(rank, 1 - rank, 100, 10),
+                    comm(rank, 1 - rank, 50, 20),
+                    comm(1 - rank, rank, 100, 15, 'RECV')]})
+        self.post('/api/executions', {
+            'app': 0, 'rank': 0, 'step': 1, 'exec': [], 'comm': [
+                comm(0, 2, 1000, 2000), comm(0, 1, 10, 2500)]})
+
+        r, s, h = self.get('/events/query_comm_matrix?pid=0&step=0')
+        self.assertEqual(s, 200)
+        self.assertEqual([(d['src'], d['tar'], d['n_messages'], d['bytes'])
+                          for d in r], [(0, 1, 2, 150), (1, 0, 2, 150)])
+
+        r, s, h = self.get('/events/query_comm_matrix?pid=0&min_ts=0&top=2')
+        self.assertEqual([(d['src'], d['tar'], d['bytes']) for d in r],
+                         [(0, 2, 1000), (0, 1, 160)])
+
+        r, s, h = self.get(
+            '/events/query_comm_matrix?pid=0&min_ts=1000&max_ts=2200')
+        self.assertEqual([(d['src'], d['tar']) for d in r], [(0, 2)])
+
+        # a rewritten step replaces its cells
+        self.post('/api/executions', {
+            'app': 0, 'rank': 0, 'step': 1, 'exec': [], 'comm': []})
+        r, s, h = self.get('/events/query_comm_matrix?pid=0&step=1')
+        self.assertEqual(r, [])
+
+        r, s, h = self.get('/events/query_comm_matrix?pid=0')
+        self.assertEqual(s, 400)
+
+    def test_rank_rooms(self):
+        from server import socketio
+        from server.api.anomalystats import push_anomaly_data
+        from server.events import stat_query
+
+        clients = [socketio.test_client(self.app, namespace='/events')
+                   for _ in range(3)]
+        clients[0].emit('query_stats', {'ranks': [0, 1]}, namespace='/events')
+        clients[1].emit('query_stats', {'ranks': [1, 3]}, namespace='/events')
+        clients[2].emit('query_stats', {'app': 1, 'ranks': [2]},
+                        namespace='/events')
+        for c in clients:
+            c.get_received('/events')
+
+        def anomaly(step):
+            return [{'app': 0, 'rank': rank, 'step': step, 'n_anomalies': rank,
+                     'min_timestamp': 10 * step, 'max_timestamp': 10 * step + 5}
+                    for rank in range(4)]
+
+        self.assertEqual(stat_query.get().ranks,
+                         frozenset([(0, 0), (0, 1), (0, 3), (1, 2)]))
+        push_anomaly_data(stat_query.get(), anomaly(0))
+
+        def history(c):
+            return sorted(d['rank'] for m in c.get_received('/events')
+                          if m['name'] == 'update_history'
+                          for d in m['args'][0])
+
+        self.assertEqual(history(clients[0]), [0, 1])
+        self.assertEqual(history(clients[1]), [1, 3])
+        # rank 2 is watched in another app only
+        self.assertEqual(history(clients[2]), [])
+
+        # watching other ranks leaves the previous rooms
+        clients[0].emit('query_stats', {'ranks': [2]}, namespace='/events')
+        clients[0].get_received('/events')
+        push_anomaly_data(stat_query.get(), anomaly(1))
+        self.assertEqual(history(clients[0]), [2])
+
+        for c in clients:
+            c.disconnect(namespace='/events')
+
+    def test_push_coalescing(self):
+        from server.emitter import PushScheduler
+
+        emitted = []
+        scheduler = PushScheduler(emit=lambda event, data, **kwargs:
+                                  emitted.append((event, kwargs['room'], data)))
+        scheduler.max_rate = 0.001  # no flush by the background thread
+
+        def rows(step, ranks):
+            return [{'app': 0, 'rank': rank, 'step': step,
+                     'min_timestamp': 10 * step + rank} for rank in ranks]
+
+        # the first push of each (event, room) goes out right away
+        scheduler.push('update_stats', {'v': 0})
+        scheduler.push('update_history', rows(0, [0]), room='rank:0:0')
+        self.assertEqual(len(emitted), 2)
+
+        # the next ones are held and coalesced
+        for v in range(1, 4):
+            scheduler.push('update_stats', {'v': v})
+        scheduler.push('update_history', rows(1, [0]), room='rank:0:0')
+        scheduler.push('update_history', rows(2, [0]), room='rank:0:0')
+        scheduler.push('update_history', rows(2, [0]), room='rank:0:0')
+        scheduler.push('update_history', rows(1, [1]), room='rank:0:1')
+        scheduler.push('run_simulation', {})
+        self.assertEqual(len(emitted), 4)
+
+        scheduler.flush()
+        self.assertEqual(len(emitted), 6)
+        pushed = {(event, room): data for event, room, data in emitted[4:]}
+        self.assertEqual(pushed[('update_stats', None)], {'v': 3})
+        self.assertEqual(
+            [d['step'] for d in pushed[('update_history', 'rank:0:0')]],
+            [1, 2])
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['n_pushed'], 10)
+        self.assertEqual(stats['n_emitted'], 6)
+        self.assertEqual(stats['n_dropped'], 2)
+        self.assertEqual(stats['n_merged'], 2)
+        self.assertEqual(stats['n_pending'], 0)
+
+        r, s, h = self.get('/stats')
+        self.assertIn('push', r)
+
+        # with Redis, the rate of a room is shared by all the emitters
+        class SharedSlots(object):
+            def __init__(self):
+                self.keys = set()
+
+            def set(self, key, value, nx=False, px=None):
+                if nx and key in self.keys:
+                    return None
+                self.keys.add(key)
+                return True
+
+        slots = SharedSlots()
+        emitted = []
+        schedulers = [PushScheduler(emit=lambda event, data, **kwargs:
+                                    emitted.append(data)) for _ in range(2)]
+        for scheduler in schedulers:
+            scheduler.max_rate = 0.001
+            scheduler._redis = slots
+        schedulers[0].push('update_stats', {'v': 0})
+        schedulers[1].push('update_stats', {'v': 1})
+        self.assertEqual(emitted, [{'v': 0}])
+        self.assertEqual(schedulers[1].stats()['n_deferred'], 1)
+        self.assertEqual(schedulers[1].stats()['n_pending'], 1)
+
+        slots.keys.clear()  # the slot expired
+        schedulers[1]._last.clear()
+        schedulers[1].flush(due_only=True)
+        self.assertEqual(emitted, [{'v': 0}, {'v': 1}])
+
+    def test_msgpack_payloads(self):
+        import msgpack
+        from server import socketio
+        from server.api.anomalystats import push_anomaly_data
+        from server.emitter import COLUMNS_KEY
+        from server.events import push_data, stat_query
+
+        plain = socketio.test_client(self.app, namespace='/events')
+        binary = socketio.test_client(self.app, namespace='/events',
+                                      query_string='encoding=msgpack')
+        self.assertEqual(
+            binary.get_received('/events')[0]['args'][0]['encoding'],
+            'msgpack')
+        for c in (plain, binary):
+            c.emit('query_stats', {'ranks': [1]}, namespace='/events')
+            c.get_received('/events')
+
+        rows = [{'app': 0, 'rank': 1, 'step': step, 'n_anomalies': step,
+                 'min_timestamp': step, 'max_timestamp': step + 1}
+                for step in range(3)]
+        push_anomaly_data(stat_query.get(), rows)
+        push_data({'nQueries': 1, 'data': [{'name': 'TOP', 'stat': []}]},
+                  'update_stats')
+
+        received = {m['name']: m['args'][0]
+                    for m in plain.get_received('/events')}
+        self.assertEqual(received['update_history'], rows)
+        self.assertEqual(received['update_stats']['nQueries'], 1)
+
+        received = {m['name']: msgpack.unpackb(m['args'][0], raw=False)
+                    for m in binary.get_received('/events')}
+        history = received['update_history']
+        self.assertEqual(history[COLUMNS_KEY], 3)
+        self.assertEqual(history['step'], [0, 1, 2])
+        self.assertEqual(history['n_anomalies'], [0, 1, 2])
+        self.assertEqual(received['update_stats']['data'],
+                         {COLUMNS_KEY: 1, 'name': ['TOP'], 'stat': [[]]})
+
+        # nothing is encoded for rooms without msgpack sessions
+        from server.emitter import push_scheduler
+        from server.subscriptions import rank_room, subscriptions
+        self.assertTrue(subscriptions.listened(rank_room(0, 1), 'msgpack'))
+        binary.disconnect(namespace='/events')
+        self.assertFalse(subscriptions.listened(rank_room(0, 1), 'msgpack'))
+        self.assertFalse(subscriptions.listened(None, 'msgpack'))
+
+        n_bytes = push_scheduler.stats()['msgpack_bytes']
+        push_anomaly_data(stat_query.get(), rows)
+        self.assertEqual(push_scheduler.stats()['msgpack_bytes'], n_bytes)
+        received = {m['name']: m['args'][0]
+                    for m in plain.get_received('/events')}
+        self.assertEqual(received['update_history'], rows)
+
+        plain.disconnect(namespace='/events')
+
+    def test_admission_control(self):
+        from server.admission import admission
+        import server.wsgi_aux  # noqa: F401, its init_app resets the limits
+
+        payload = {'created_at': 0, 'anomaly': [], 'func': []}
+        high_water = admission.high_water
+        admission.high_water, admission.shed_ratio = 4, 0.5
+        leases = []
+        try:
+            # leases are given back at the end of each request
+            for _ in range(10):
+                r, s, h = self.post('/api/anomalydata', payload)
+                self.assertNotEqual(s, 429)
+            self.assertEqual(sum(admission.depth().values()), 0)
+
+            # executions are shed first
+            leases += [admission.admit('anomalydata') for _ in range(2)]
+            r, s, h = self.post('/api/executions', {})
+            self.assertEqual(s, 429)
+            self.assertGreaterEqual(int(h['Retry-After']), 1)
+
+            r, s, h = self.post('/api/anomalydata', payload)
+            self.assertNotEqual(s, 429)
+            self.assertEqual(admission.depth()['anomalydata'], 2)
+
+            leases += [admission.admit('anomalydata') for _ in range(2)]
+            self.assertIsNone(admission.admit('anomalydata'))
+            r, s, h = self.post('/api/anomalydata', payload)
+            self.assertEqual(s, 429)
+
+            r, s, h = self.get('/stats')
+            stats = r['admission']
+            self.assertEqual(stats['depth'], 4)
+            self.assertEqual(stats['classes']['executions']['n_rejected'], 1)
+            self.assertEqual(stats['classes']['anomalydata']['limit'], 4)
+            self.assertEqual(stats['classes']['executions']['limit'], 2)
+        finally:
+            for lease in leases:
+                admission.release(lease)
+            admission.high_water = high_water
+        self.assertEqual(sum(admission.depth().values()), 0)
+
+    def test_request_metrics(self):
+        from server.stats import LatencyHistogram, RateCounter
+
+        h = LatencyHistogram()
+        for ms in range(1, 101):
+            h.add(ms / 1000.)
+        self.assertEqual(h.count, 100)
+        self.assertAlmostEqual(h.percentile(0.5), 0.050, delta=0.050 / 16)
+        self.assertAlmostEqual(h.percentile(0.99), 0.099, delta=0.099 / 16)
+        self.assertEqual(h.percentile(1.), 0.1)
+
+        rate = RateCounter(window=10)
+        for t in range(100, 120):
+            rate.add(t + 0.5)
+            rate.add(t + 0.7)
+        self.assertEqual(rate.rate(119.9), 2.)
+        self.assertEqual(rate.rate(125), 0.8)  # 116..119 left
+        self.assertEqual(rate.rate(200), 0.)
+
+        # the registry is shared by the tests: count from here
+        r, s, h = self.get('/stats')
+        n = r['endpoints'].get('main.get_stats', {}).get('count', 0)
+        for _ in range(3):
+            self.get('/stats')
+        r, s, h = self.get('/stats')
+        self.assertEqual(r['endpoints']['main.get_stats']['count'], n + 4)
+
+        rv = self.client.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        text = rv.get_data(as_text=True)
+        self.assertIn('chimbuko_request_latency_seconds_count'
+                      '{{endpoint="main.get_stats"}} {}'.format(n + 5), text)
+        self.assertIn('quantile="0.99"', text)
+
+    def test_ingest_tracing(self):
+        from server.tracing import tracer
+        from server.utils import timestamp
+
+        tracer.clear()
+        payload = {
+            'created_at': timestamp(),
+            'anomaly': [{
+                'key': '0:0',
+                'stats': {'count': 1},
+                'data': [{'app': 0, 'rank': 0, 'step': 0, 'n_anomalies': 1,
+                          'min_timestamp': 0, 'max_timestamp': 1,
+                          'stat_id': '0:0'}]
+            }]
+        }
+        self.post('/api/anomalydata', payload)
+        # created_at that isn't a wall-clock time is left out
+        self.post('/api/anomalydata', dict(payload, created_at=123))
+
+        spans = tracer.stats()
+        for name in ('celery.queue', 'celery.dispatch', 'anomalydata.process',
+                     'anomalydata.put.anomaly_stats',
+                     'ingest.write.anomaly_data', 'anomalydata.stat_query'):
+            self.assertEqual(spans[name]['count'], 2, name)
+        self.assertEqual(spans['anomalydata.end_to_end']['count'], 1)
+        self.assertLess(spans['anomalydata.end_to_end']['max'], 60)
+        self.assertGreaterEqual(spans['celery.dispatch']['max'],
+                                spans['anomalydata.process']['max'])